@@ -17,6 +17,11 @@ Behavior:
   - Reads `design_data` JSONB: background_url, hero_url, overlay_url.
   - Creates folder `temp_assets/{card_id}/` next to this script.
   - Downloads as: background.jpg, hero.png, frame.png.
+
+Fetched files go through the content-addressed blob store (blob_store.py): identical bytes
+(the same hero or frame on several cards or orders) are stored once and hard-linked into
+each assets directory. URLs pointing at this backend's own /static/uploads/ are read from
+disk instead of over HTTP.
 """
 
 import base64
@@ -24,9 +29,12 @@ import os
 import re
 from pathlib import Path
 from typing import Optional
+from urllib.parse import urlparse
 
 import requests
 
+from blob_store import replace_file, store_bytes_at, store_file_at, store_temp_file_at
+
 # ---------- CONFIGURE THIS ----------
 # The card ID you want to fetch assets for
 CARD_ID = "c6a3c13f-49e9-466b-9331-ce158ac0b3cb"  # e.g. "d3b8b8a4-1234-5678-9abc-def012345678"
@@ -65,18 +73,44 @@ def get_supabase_client():
     return create_client(SUPABASE_URL, SUPABASE_KEY)
 
 
+UPLOADS_DIR = Path(__file__).resolve().parent / "static" / "uploads"
+_LOCAL_HOSTS = {"localhost", "127.0.0.1"}
+
+
+def _local_upload_path(url: str) -> Optional[Path]:
+    """Path of a /static/uploads/ file served by this backend, if url points at one that exists."""
+    parsed = urlparse(url)
+    if parsed.hostname not in _LOCAL_HOSTS or not parsed.path.startswith("/static/uploads/"):
+        return None
+    name = parsed.path[len("/static/uploads/"):]
+    path = UPLOADS_DIR / name
+    if not name or "/" in name or name.startswith(".") or not path.is_file():
+        return None
+    return path
+
+
 def download_image(url: str, dest_path: Path) -> bool:
-    """Download a single image to dest_path. Returns True on success, False on failure."""
+    """Download a single image to dest_path (via the blob store). Returns True on success, False on failure."""
     try:
+        local = _local_upload_path(url)
+        if local is not None:
+            digest = store_file_at(local, dest_path)
+            print(f"  Linked {local.name} -> {dest_path} (blob {digest[:12]})")
+            return True
+
         print(f"  Downloading {url} -> {dest_path}")
         resp = requests.get(url, stream=True, timeout=30)
         resp.raise_for_status()
 
         dest_path.parent.mkdir(parents=True, exist_ok=True)
-        with dest_path.open("wb") as f:
+        # Written under a temporary name, then stored and moved over dest_path: never in place,
+        # since dest_path may be a hard link to a shared blob from an earlier run
+        tmp_path = dest_path.with_name(f".{dest_path.name}.download")
+        with tmp_path.open("wb") as f:
             for chunk in resp.iter_content(chunk_size=8192):
                 if chunk:
                     f.write(chunk)
+        store_temp_file_at(tmp_path, dest_path)
         return True
     except Exception as e:
         print(f"  ERROR downloading {url}: {e}")
@@ -91,9 +125,8 @@ def _save_data_url(data_url: str, dest_path: Path) -> bool:
             print(f"  [DataURL] Regex did NOT match for {dest_path.name} (url starts with: {data_url[:80]}...)")
             return False
         raw = base64.b64decode(m.group(1), validate=True)
-        dest_path.parent.mkdir(parents=True, exist_ok=True)
-        dest_path.write_bytes(raw)
-        print(f"  [DataURL] Saved {dest_path.name}: {len(raw)} bytes")
+        digest = store_bytes_at(raw, dest_path)
+        print(f"  [DataURL] Saved {dest_path.name}: {len(raw)} bytes (blob {digest[:12]})")
         return True
     except Exception as e:
         print(f"  [DataURL] ERROR saving {dest_path.name}: {e}")
@@ -106,10 +139,11 @@ def _write_placeholder_image(dest_path: Path, width: int = 825, height: int = 11
         from PIL import Image
         dest_path.parent.mkdir(parents=True, exist_ok=True)
         img = Image.new("RGB", (width, height), rgb)
-        img.save(dest_path, "PNG" if dest_path.suffix.lower() == ".png" else "JPEG", quality=85)
+        fmt = "PNG" if dest_path.suffix.lower() == ".png" else "JPEG"
+        replace_file(dest_path, lambda tmp: img.save(tmp, fmt, quality=85))
     except Exception:
         dest_path.parent.mkdir(parents=True, exist_ok=True)
-        dest_path.write_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * 100)  # minimal fallback
+        replace_file(dest_path, lambda tmp: tmp.write_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * 100))  # minimal fallback
 
 
 def _write_transparent_placeholder(dest_path: Path, width: int = 825, height: int = 1125) -> None:
@@ -118,7 +152,7 @@ def _write_transparent_placeholder(dest_path: Path, width: int = 825, height: in
         from PIL import Image
         dest_path.parent.mkdir(parents=True, exist_ok=True)
         img = Image.new("RGBA", (width, height), (255, 255, 255, 0))
-        img.save(dest_path, "PNG")
+        replace_file(dest_path, lambda tmp: img.save(tmp, "PNG"))
     except Exception:
         _write_placeholder_image(dest_path, width, height, (240, 240, 240))
 
@@ -138,7 +172,7 @@ def _background_from_hero(hero_path: Path, dest_path: Path, tint_rgb: tuple = No
             tint = Image.new("RGB", blurred.size, tint_rgb)
             blurred = Image.blend(blurred, tint, alpha=0.4)
         dest_path.parent.mkdir(parents=True, exist_ok=True)
-        blurred.save(dest_path, "JPEG", quality=88)
+        replace_file(dest_path, lambda tmp: blurred.save(tmp, "JPEG", quality=88))
         return True
     except Exception:
         return False
@@ -175,7 +209,7 @@ def fetch_assets_for_card(card_id: str, client=None) -> Path:
     return out_dir
 
 
-def fetch_assets_from_design(design_snapshot: dict, dest_dir: Path) -> Path:
+def fetch_assets_from_design(design_snapshot: dict, dest_dir: Path, failures: Optional[list] = None) -> Path:
     """
     Fetch assets from design_snapshot into dest_dir.
 
@@ -186,10 +220,16 @@ def fetch_assets_from_design(design_snapshot: dict, dest_dir: Path) -> Path:
     When all three snapshots exist, the pipeline uses them as-is (no PIL compositing).
     When snapshots are missing, falls back to raw assets: background_url, hero_url, overlay_url
     (or playerImageUrl, logoDataUrl) and derives background from hero if needed.
+
+    A download or data URL that fails does not raise: a placeholder (or the fallback) is used so
+    the card still renders. Pass failures=[] to get the file names whose source could not be
+    saved, e.g. to retry them later instead of keeping the stand-ins.
     """
     dest_dir = Path(dest_dir)
     dest_dir.mkdir(parents=True, exist_ok=True)
     design = design_snapshot or {}
+    if failures is None:
+        failures = []
 
     def get_url(key: str, alt_key: str = None) -> Optional[str]:
         v = design.get(key) or (design.get(alt_key) if alt_key else None)
@@ -199,10 +239,14 @@ def fetch_assets_from_design(design_snapshot: dict, dest_dir: Path) -> Path:
         if not data_or_url or not isinstance(data_or_url, str):
             return False
         if data_or_url.startswith("data:"):
-            return _save_data_url(data_or_url, path)
-        if data_or_url.startswith("http://") or data_or_url.startswith("https://"):
-            return download_image(data_or_url, path)
-        return False
+            ok = _save_data_url(data_or_url, path)
+        elif data_or_url.startswith("http://") or data_or_url.startswith("https://"):
+            ok = download_image(data_or_url, path)
+        else:
+            return False
+        if not ok:
+            failures.append(path.name)
+        return ok
 
     # Pre-rendered blobs from frontend (exact card builder output). Text is foreground layer (on top of frame).
     snap_keys = [
@@ -225,38 +269,26 @@ def fetch_assets_from_design(design_snapshot: dict, dest_dir: Path) -> Path:
     if has_snapshots:
         # Still fetch hero raw asset when available so backend can build player layer from
         # clean masked hero (avoids legacy snapshots where logo was baked into player snapshot).
-        hero_url = get_url("hero_url", "playerImageUrl")
-        if hero_url:
-            if hero_url.startswith("data:"):
-                _save_data_url(hero_url, dest_dir / "hero.png")
-            elif hero_url.startswith("http://") or hero_url.startswith("https://"):
-                download_image(hero_url, dest_dir / "hero.png")
+        save_snapshot(get_url("hero_url", "playerImageUrl"), dest_dir / "hero.png")
         return dest_dir
 
     # Fallback: raw assets for rendering and cut paths
-    hero_url = get_url("hero_url", "playerImageUrl")
-    if hero_url:
-        if hero_url.startswith("data:"):
-            _save_data_url(hero_url, dest_dir / "hero.png")
-        elif hero_url.startswith("http://") or hero_url.startswith("https://"):
-            download_image(hero_url, dest_dir / "hero.png")
+    save_snapshot(get_url("hero_url", "playerImageUrl"), dest_dir / "hero.png")
     if not (dest_dir / "hero.png").is_file():
         _write_placeholder_image(dest_dir / "hero.png", rgb=(255, 255, 255))
 
-    frame_url = get_url("overlay_url", "logoDataUrl")
-    if frame_url and frame_url.startswith("data:"):
-        _save_data_url(frame_url, dest_dir / "frame.png")
-    elif frame_url and (frame_url.startswith("http://") or frame_url.startswith("https://")):
-        download_image(frame_url, dest_dir / "frame.png")
+    save_snapshot(get_url("overlay_url", "logoDataUrl"), dest_dir / "frame.png")
     if not (dest_dir / "frame.png").is_file():
         _write_transparent_placeholder(dest_dir / "frame.png")
 
     bg_url = get_url("background_url")
     if bg_url:
         if bg_url.startswith("data:"):
-            _save_data_url(bg_url, dest_dir / "background.jpg")
+            ok = _save_data_url(bg_url, dest_dir / "background.jpg")
         else:
-            download_image(bg_url, dest_dir / "background.jpg")
+            ok = download_image(bg_url, dest_dir / "background.jpg")
+        if not ok:
+            failures.append("background.jpg")
     if not (dest_dir / "background.jpg").is_file():
         hero_path = dest_dir / "hero.png"
         tint = None
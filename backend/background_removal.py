@@ -0,0 +1,866 @@
+"""
+Background removal pipeline (RemBG + vectorized alpha edge post-processing).
+
+Everything here is synchronous and CPU-bound: main.py runs it inside the
+bounded worker pool (see worker_pool.py) so the event loop is never blocked.
+Functions are module-level so they can also be shipped to a process pool.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+from rembg import remove, new_session
+
+from alpha_postprocess import postprocess_image_alpha
+from blob_store import get_blob_store, replace_file
+from color_extraction import COLOR_ENGINE, color_profile
+from upload_metadata import write_upload_metadata
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidImageError(ValueError):
+    """Raised when uploaded bytes cannot be decoded as an image."""
+
+
+# Initialize RemBG sessions for different models (lazy loaded)
+# All models are FREE and run locally - no API fees!
+# model -> ModelSessionPool, least recently used first. Bounded by REMBG_SESSION_MEMORY_MB.
+REMBG_SESSIONS: "OrderedDict[str, ModelSessionPool]" = OrderedDict()
+REMBG_SESSION_MEMORY_BYTES = int(os.getenv("REMBG_SESSION_MEMORY_MB", "2048")) * 1024 * 1024
+# Sessions per model; concurrent uploads for one model each check out their own session.
+REMBG_SESSIONS_PER_MODEL = max(1, int(os.getenv("REMBG_SESSIONS_PER_MODEL", os.getenv("REMBG_WORKERS", "2"))))
+_SESSIONS_LOCK = threading.Lock()
+AVAILABLE_MODELS = {
+    'u2net': 'General purpose - Fast and accurate',
+    'u2netp': 'Lightweight - Faster, lower memory',
+    'u2net_human_seg': 'Optimized for people in static poses',
+    'u2net_cloth_seg': 'Optimized for clothing details',
+    'silueta': 'High quality edges - Excellent for dynamic poses',
+    'isnet-general-use': 'Best overall - Recommended for athletes ⭐',
+    'isnet-anime': 'Cartoon/illustrated characters only',
+}
+
+
+def _process_rss_bytes() -> int:
+    """Resident set size of this process (Linux /proc); 0 when unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _model_file_bytes(model_name: str) -> int:
+    """Size of the downloaded .onnx file in U2NET_HOME (rembg's model cache); 0 if missing."""
+    home = os.path.expanduser(os.getenv("U2NET_HOME", os.path.join(os.getenv("XDG_DATA_HOME", "~"), ".u2net")))
+    try:
+        return os.path.getsize(os.path.join(home, f"{model_name}.onnx"))
+    except OSError:
+        return 0
+
+
+class ModelSessionPool:
+    """
+    Up to `size` independent sessions of one model. Callers check a session out, run
+    inference on it alone, and check it back in.
+
+    Loading is single-flight: while a session is being created, other callers wait for
+    it instead of starting a second new_session() for the same model. A further session
+    is only created when every existing one is busy.
+    """
+
+    def __init__(self, model_name: str, size: int):
+        self.model_name = model_name
+        self.size = size
+        self.memory_bytes = 0
+        self.loaded_at = None
+        self.last_used = time.time()
+        self.pinned = False
+        self.evicted = False
+        self._idle = []
+        self._created = 0
+        self._in_use = 0
+        self._loading = False
+        self._cond = threading.Condition()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def created(self) -> int:
+        return self._created
+
+    def checkout(self):
+        with self._cond:
+            while True:
+                if self._idle:
+                    self._in_use += 1
+                    self.last_used = time.time()
+                    return self._idle.pop()
+                if not self._loading and self._created < self.size:
+                    self._loading = True
+                    break
+                self._cond.wait()
+        try:
+            rss_before = _process_rss_bytes()
+            session = new_session(self.model_name)
+            used = _process_rss_bytes() - rss_before
+        except Exception:
+            with self._cond:
+                self._loading = False
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._loading = False
+            self._created += 1
+            self._in_use += 1
+            self.memory_bytes += used if used > 0 else _model_file_bytes(self.model_name)
+            self.loaded_at = self.loaded_at or time.time()
+            self.last_used = time.time()
+            self._cond.notify_all()
+        logger.info(f"Model {self.model_name} session {self._created}/{self.size} loaded")
+        return session
+
+    def checkin(self, session) -> None:
+        with self._cond:
+            self._in_use -= 1
+            if not self.evicted:
+                self._idle.append(session)
+            self._cond.notify()
+
+
+def _model_pool(model_name: str) -> ModelSessionPool:
+    """Registry entry for model_name (created empty if new), marked most recently used."""
+    with _SESSIONS_LOCK:
+        pool = REMBG_SESSIONS.get(model_name)
+        if pool is None:
+            pool = REMBG_SESSIONS[model_name] = ModelSessionPool(model_name, REMBG_SESSIONS_PER_MODEL)
+        REMBG_SESSIONS.move_to_end(model_name)
+        return pool
+
+
+def _evict_sessions(keep: str) -> None:
+    """Drop least recently used, unpinned, idle models until resident memory fits the budget."""
+    if REMBG_SESSION_MEMORY_BYTES <= 0:
+        return
+    with _SESSIONS_LOCK:
+        for name, pool in list(REMBG_SESSIONS.items()):
+            if sum(p.memory_bytes for p in REMBG_SESSIONS.values()) <= REMBG_SESSION_MEMORY_BYTES:
+                break
+            if name == keep or pool.pinned or pool.in_use:
+                continue
+            pool.evicted = True
+            del REMBG_SESSIONS[name]
+            logger.info(f"Evicted RemBG model {name} (~{pool.memory_bytes / 1024 / 1024:.0f}MB) to stay under session memory budget")
+
+
+def resident_session_bytes() -> int:
+    with _SESSIONS_LOCK:
+        return sum(p.memory_bytes for p in REMBG_SESSIONS.values())
+
+
+@contextmanager
+def checkout_session(model_name: str = 'u2net_human_seg'):
+    """
+    Check out a RemBG session for exclusive use during one inference.
+    Sessions are pooled per model (REMBG_SESSIONS_PER_MODEL) and cached for performance.
+    All models run locally with NO API fees!
+    """
+    pool = _model_pool(model_name)
+    try:
+        session = pool.checkout()
+    except Exception as e:
+        if model_name == 'u2net':
+            raise
+        logger.error(f"Failed to load model {model_name}: {e}")
+        # Fallback to default model
+        with _SESSIONS_LOCK:
+            if not pool.created and REMBG_SESSIONS.get(model_name) is pool:
+                del REMBG_SESSIONS[model_name]
+        pool = _model_pool('u2net')
+        session = pool.checkout()
+    _evict_sessions(keep=pool.model_name)
+    try:
+        yield session
+    finally:
+        pool.checkin(session)
+
+
+def preload_models(model_names: List[str]) -> None:
+    """
+    Load and pin models at startup, running one small dummy inference on each so
+    onnxruntime builds its graph before the first customer upload. Pinned models
+    are never evicted.
+    """
+    for name in model_names:
+        if name not in AVAILABLE_MODELS:
+            logger.warning(f"Skipping preload of unknown model {name}")
+            continue
+        start = time.time()
+        with checkout_session(name) as session:
+            try:
+                session.predict(Image.new("RGB", (64, 64), (128, 128, 128)))
+            except Exception as e:
+                logger.warning(f"Warm-up inference for {name} failed: {e}")
+        with _SESSIONS_LOCK:
+            if name in REMBG_SESSIONS:
+                REMBG_SESSIONS[name].pinned = True
+        logger.info(f"Preloaded model {name} in {time.time() - start:.1f}s")
+
+
+def session_registry_status() -> dict:
+    """Resident models (most recently used last) with their memory use, for /models."""
+    with _SESSIONS_LOCK:
+        pools = [p for p in REMBG_SESSIONS.values() if p.created]
+        resident = [
+            {
+                "id": p.model_name,
+                "memory_mb": round(p.memory_bytes / 1024 / 1024, 1),
+                "sessions": p.created,
+                "in_use": p.in_use,
+                "pinned": p.pinned,
+                "loaded_at": datetime.fromtimestamp(p.loaded_at).isoformat(timespec="seconds"),
+                "last_used": datetime.fromtimestamp(p.last_used).isoformat(timespec="seconds"),
+            }
+            for p in pools
+        ]
+        return {
+            "resident": resident,
+            "resident_memory_mb": round(sum(p.memory_bytes for p in pools) / 1024 / 1024, 1),
+            "memory_budget_mb": round(REMBG_SESSION_MEMORY_BYTES / 1024 / 1024, 1),
+            "sessions_per_model": REMBG_SESSIONS_PER_MODEL,
+        }
+
+
+def crop_transparent_edges(image: Image.Image) -> Image.Image:
+    """
+    Crop transparent edges from image to remove empty space.
+    This fixes the "wide handles" issue where background removal
+    leaves too much transparent padding.
+    """
+    bbox = image.getbbox()
+    if bbox:
+        return image.crop(bbox)
+    return image
+
+
+def refine_edges(image: Image.Image, feather: int = 2, smooth: bool = True) -> Image.Image:
+    """
+    Refine edges for crisp, smooth results - perfect for athlete photos.
+
+    Args:
+        image: RGBA image with transparent background
+        feather: Edge softening amount (0-5, default 2)
+        smooth: Apply smoothing filter to edges
+
+    Returns:
+        Image with refined edges (a new image; the input is not modified)
+    """
+    try:
+        if image.mode != 'RGBA':
+            return image
+        refined, _ = postprocess_image_alpha(image.copy(), "refine", feather=feather, smooth=smooth)
+        return refined
+
+    except Exception as e:
+        logger.warning(f"Edge refinement failed: {e}, returning original")
+        return image
+
+
+def enhance_edges_for_athletes(image: Image.Image) -> Image.Image:
+    """
+    Special edge enhancement for athlete/dynamic photos.
+    Focuses on crisp edges around limbs, hair, and equipment:
+    median denoise, +20% alpha contrast, then a slight blur (see alpha_postprocess).
+    """
+    try:
+        if image.mode != 'RGBA':
+            return image
+        enhanced, _ = postprocess_image_alpha(image.copy(), "athlete")
+        return enhanced
+
+    except Exception as e:
+        logger.warning(f"Edge enhancement failed: {e}, returning original")
+        return image
+
+
+# Per-model preprocessing used by rembg's predict(), so several images can be stacked into one
+# ONNX forward pass: (mean, std, model input size). Models not listed here (u2net_cloth_seg
+# returns several masks) always run one image at a time.
+BATCHABLE_MODELS = {
+    'u2net': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'u2netp': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'u2net_human_seg': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'silueta': ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    'isnet-general-use': ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+    'isnet-anime': ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+# Models whose ONNX graph has a fixed batch dimension; batch > 1 is never tried again for them.
+# Any other failure of a batched run only falls back to single images for that call.
+_UNBATCHABLE_MODELS = set()
+_UNBATCHABLE_LOCK = threading.Lock()
+
+
+def _is_fixed_batch_error(error: Exception) -> bool:
+    """onnxruntime's rejection of a batch size the graph was not exported for (input index 0)."""
+    message = str(error)
+    return "invalid dimensions" in message.lower() and "index: 0" in message
+
+
+def _has_fixed_batch_dim(inner_session) -> bool:
+    """True if the graph declares a concrete batch size (symbolic dimensions are strings or None)."""
+    shape = inner_session.get_inputs()[0].shape
+    return bool(shape) and isinstance(shape[0], int)
+
+
+def _mark_unbatchable(model_name: str, reason) -> None:
+    with _UNBATCHABLE_LOCK:
+        if model_name in _UNBATCHABLE_MODELS:
+            return
+        _UNBATCHABLE_MODELS.add(model_name)
+    logger.info(f"Batched inference not available for {model_name} ({reason}); running images one at a time")
+
+
+class _PrecomputedMaskSession:
+    """Stand-in session that hands rembg.remove() a mask predicted elsewhere (batched run)."""
+
+    def __init__(self, mask: Image.Image):
+        self.mask = mask
+
+    def predict(self, img, *args, **kwargs):
+        return [self.mask]
+
+
+def _pred_to_mask(pred: np.ndarray, size) -> Image.Image:
+    """Min-max normalise one model output map and resize it to the image size (as rembg does)."""
+    ma = np.max(pred)
+    mi = np.min(pred)
+    pred = (pred - mi) / (ma - mi)
+    mask = Image.fromarray((np.squeeze(pred) * 255).astype("uint8"), mode="L")
+    return mask.resize(size, Image.LANCZOS)
+
+
+def predict_masks_batch(session, model: str, images: List[Image.Image]) -> List[Image.Image]:
+    """
+    Predict alpha masks for several images with one ONNX forward pass.
+    Falls back to one predict() per image when the model is not batchable, the graph was
+    exported with a fixed batch dimension (remembered for the model), or the batched run
+    fails for another reason (this call only).
+    """
+    model_name = getattr(session, "model_name", model)
+    params = BATCHABLE_MODELS.get(model_name)
+    with _UNBATCHABLE_LOCK:
+        batchable = params is not None and len(images) > 1 and model_name not in _UNBATCHABLE_MODELS
+    if batchable and _has_fixed_batch_dim(session.inner_session):
+        _mark_unbatchable(model_name, "fixed batch dimension")
+        batchable = False
+    if batchable:
+        mean, std, size = params
+        try:
+            input_name = session.inner_session.get_inputs()[0].name
+            batch = np.concatenate(
+                [session.normalize(img, mean, std, size)[input_name] for img in images], axis=0
+            )
+            ort_outs = session.inner_session.run(None, {input_name: batch})
+            preds = ort_outs[0][:, 0, :, :]
+            return [_pred_to_mask(preds[i], img.size) for i, img in enumerate(images)]
+        except Exception as e:
+            if _is_fixed_batch_error(e):
+                _mark_unbatchable(model_name, e)
+            else:
+                logger.warning(f"Batched inference failed for {model_name} ({e}); running these images one at a time")
+    return [session.predict(img)[0] for img in images]
+
+
+# Proxy mask mode: segment a downscaled copy, then upsample the alpha to full resolution with a
+# guided filter (edges follow the full-res photo). Colour data stays at print resolution.
+MASK_MODES = ("auto", "full", "proxy")
+REMBG_PROXY_MAX_SIDE = int(os.getenv("REMBG_PROXY_MAX_SIDE", "1280"))
+# mask_mode=auto switches to the proxy once the longest side exceeds this
+REMBG_PROXY_TRIGGER_SIDE = int(os.getenv("REMBG_PROXY_TRIGGER_SIDE", "2000"))
+_GUIDED_RADIUS = 2
+_GUIDED_EPS = 1e-5
+_UPSAMPLE_STRIP_ROWS = 512
+
+
+def use_proxy_mask(size, mask_mode: str) -> bool:
+    """Whether an image of this size is segmented through a downscaled proxy."""
+    longest = max(size)
+    if mask_mode == "proxy":
+        return longest > REMBG_PROXY_MAX_SIDE
+    if mask_mode == "auto":
+        return longest > REMBG_PROXY_TRIGGER_SIDE
+    return False
+
+
+def make_proxy(image: Image.Image) -> Image.Image:
+    """RGB copy with its longest side scaled to REMBG_PROXY_MAX_SIDE."""
+    scale = REMBG_PROXY_MAX_SIDE / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.convert("RGB").resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+
+def _box_mean(a: np.ndarray, r: int) -> np.ndarray:
+    """Mean over a (2r+1)x(2r+1) window, edges replicated; O(1) per pixel via cumulative sums."""
+    k = 2 * r + 1
+    c = np.cumsum(np.pad(a, ((r + 1, r), (0, 0)), mode="edge"), axis=0)
+    a = (c[k:] - c[:-k]) / k
+    c = np.cumsum(np.pad(a, ((0, 0), (r + 1, r)), mode="edge"), axis=1)
+    return (c[:, k:] - c[:, :-k]) / k
+
+
+def guided_upsample_mask(mask: Image.Image, proxy: Image.Image, full_image: Image.Image) -> Image.Image:
+    """
+    Upsample a proxy-resolution alpha mask to full_image's size (fast guided filter).
+
+    The linear coefficients (alpha ~ a * luma + b) are fitted at proxy resolution, upsampled
+    bilinearly, and applied to the full-resolution luma, so the mask edge snaps to real image
+    edges instead of a blurred resize. Output rows are produced in strips to bound memory.
+    """
+    guide_lo = np.asarray(proxy.convert("L"), dtype=np.float32) / 255.0
+    p = np.asarray(mask.convert("L").resize(proxy.size, Image.BILINEAR), dtype=np.float32) / 255.0
+    r = _GUIDED_RADIUS
+    mean_i = _box_mean(guide_lo, r)
+    mean_p = _box_mean(p, r)
+    cov_ip = _box_mean(guide_lo * p, r) - mean_i * mean_p
+    var_i = _box_mean(guide_lo * guide_lo, r) - mean_i * mean_i
+    a = cov_ip / (var_i + _GUIDED_EPS)
+    b = mean_p - a * mean_i
+    a_img = Image.fromarray(_box_mean(a, r).astype(np.float32), mode="F")
+    b_img = Image.fromarray(_box_mean(b, r).astype(np.float32), mode="F")
+
+    full_w, full_h = full_image.size
+    lo_w, lo_h = proxy.size
+    sy = lo_h / full_h
+    guide_full = full_image.convert("L")
+    out = np.empty((full_h, full_w), dtype=np.uint8)
+    for y0 in range(0, full_h, _UPSAMPLE_STRIP_ROWS):
+        y1 = min(full_h, y0 + _UPSAMPLE_STRIP_ROWS)
+        box = (0, y0 * sy, lo_w, y1 * sy)
+        a_strip = np.asarray(a_img.resize((full_w, y1 - y0), Image.BILINEAR, box=box))
+        b_strip = np.asarray(b_img.resize((full_w, y1 - y0), Image.BILINEAR, box=box))
+        i_strip = np.asarray(guide_full.crop((0, y0, full_w, y1)), dtype=np.float32) / 255.0
+        q = a_strip * i_strip + b_strip
+        out[y0:y1] = np.clip(q * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(out, mode="L")
+
+
+# Output encoding. PNG keeps the old behaviour (compress_level 6 is Pillow's default; 1 encodes
+# several times faster for ~10-20% larger files). WebP is always lossless.
+OUTPUT_FORMATS = ("png", "webp")
+REMBG_OUTPUT_FORMAT = os.getenv("REMBG_OUTPUT_FORMAT", "png").strip().lower()
+REMBG_PNG_COMPRESS_LEVEL = int(os.getenv("REMBG_PNG_COMPRESS_LEVEL", "6"))
+REMBG_WEBP_METHOD = int(os.getenv("REMBG_WEBP_METHOD", "4"))  # 0 = fastest, 6 = smallest
+# Write the uncropped copy only when it is first requested (see materialize_uncropped).
+REMBG_LAZY_UNCROPPED = os.getenv("REMBG_LAZY_UNCROPPED", "false").strip().lower() in ("1", "true", "yes")
+# Pending lazy uncropped copies: <uncropped filename>.json with the cropped file and its offset.
+PENDING_UNCROPPED_DIR = ".pending"
+# Encodes release the GIL, so the cropped and uncropped files are written in parallel.
+_ENCODE_POOL = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv("REMBG_ENCODE_THREADS", "2"))), thread_name_prefix="encode"
+)
+
+
+def _save_options(output_format: str) -> dict:
+    if output_format == "webp":
+        return {"format": "WEBP", "lossless": True, "method": REMBG_WEBP_METHOD}
+    return {"format": "PNG", "compress_level": REMBG_PNG_COMPRESS_LEVEL}
+
+
+def _save_image(image: Image.Image, path: str, output_format: str) -> None:
+    """Written under a temporary name and renamed: never in place, as path may link a shared blob."""
+    replace_file(path, lambda tmp: image.save(tmp, **_save_options(output_format)))
+
+
+def _store_upload(path: str) -> Optional[str]:
+    """
+    Take a written result into the blob store (identical bytes share one copy on disk and are
+    linked, not copied, into production job directories). Returns the content digest, or None
+    if the store is unavailable; the upload itself is unaffected.
+    """
+    try:
+        return get_blob_store().ingest(path)
+    except Exception as e:
+        logger.warning(f"Could not add {os.path.basename(path)} to the blob store: {e}")
+        return None
+
+
+def _save_and_store(image: Image.Image, path: str, output_format: str) -> Optional[str]:
+    _save_image(image, path, output_format)
+    return _store_upload(path)
+
+
+def _pending_path(upload_dir: str, uncropped_filename: str) -> str:
+    return os.path.join(upload_dir, PENDING_UNCROPPED_DIR, uncropped_filename + ".json")
+
+
+def materialize_uncropped(upload_dir: str, uncropped_filename: str) -> Optional[str]:
+    """
+    Path of an uncropped result, writing it first if it was deferred (REMBG_LAZY_UNCROPPED):
+    the cropped file is pasted onto a transparent canvas of the original size at its offset.
+    Returns None if the file neither exists nor is pending.
+    """
+    if os.path.basename(uncropped_filename) != uncropped_filename:
+        return None
+    path = os.path.join(upload_dir, uncropped_filename)
+    if os.path.isfile(path):
+        return path
+    pending = _pending_path(upload_dir, uncropped_filename)
+    try:
+        with open(pending) as f:
+            info = json.load(f)
+        with Image.open(os.path.join(upload_dir, info["filename"])) as cropped:
+            canvas = Image.new("RGBA", tuple(info["size"]), (0, 0, 0, 0))
+            canvas.paste(cropped.convert("RGBA"), tuple(info["offset"]))
+    except FileNotFoundError:
+        return path if os.path.isfile(path) else None  # another request finished it first
+    # Written under a temporary name, so a concurrent request never serves a partial file
+    _save_image(canvas, path, info["format"])
+    _record_provenance(
+        upload_dir, uncropped_filename, "uncropped", info.get("source_sha256"),
+        cropped_filename=info["filename"], content_sha256=_store_upload(path),
+    )
+    try:
+        os.remove(pending)
+    except FileNotFoundError:
+        pass
+    logger.info(f"Materialized deferred uncropped copy {uncropped_filename}")
+    return path
+
+
+def _output_settings(output_format: Optional[str], lazy_uncropped: Optional[bool]) -> tuple:
+    output_format = (output_format or REMBG_OUTPUT_FORMAT).lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}; expected one of {OUTPUT_FORMATS}")
+    return output_format, REMBG_LAZY_UNCROPPED if lazy_uncropped is None else lazy_uncropped
+
+
+def _decode_upload(file_content: bytes) -> Image.Image:
+    try:
+        return Image.open(io.BytesIO(file_content))
+    except Exception as e:
+        logger.error(f"Error opening image: {e}")
+        raise InvalidImageError("Invalid image file") from e
+
+
+def _format_timings(timings: dict) -> str:
+    return ", ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in timings.items())
+
+
+def source_hash(file_content: bytes) -> str:
+    """SHA-256 of the uploaded bytes, recorded with every file written from them."""
+    return hashlib.sha256(file_content).hexdigest()
+
+
+def _record_provenance(upload_dir: str, filename: str, kind: str, source_sha256: Optional[str], **fields) -> None:
+    """
+    Creation time, source hash, kind (cropped/uncropped/preview), sibling file names and blob
+    digest in the upload's sidecar, for the upload index and retention sweeper (upload_index.py).
+    """
+    try:
+        write_upload_metadata(upload_dir, filename, {
+            "created_at": time.time(),
+            "source_sha256": source_sha256,
+            "kind": kind,
+            **fields,
+        })
+    except Exception as e:
+        logger.warning(f"Could not record provenance for {filename}: {e}")
+
+
+def _record_colors(cropped_image: Image.Image, upload_dir: str, filename: str) -> tuple:
+    """
+    Dominant jersey colour, palette and colour histogram of the in-memory cutout, stored in
+    the upload's metadata sidecar so /extract-colors and /palette do not reopen the file.
+    Returns (colors, palette); ([], []) if extraction fails (the upload itself still succeeds).
+    """
+    t = time.perf_counter()
+    try:
+        profile = color_profile(cropped_image)
+        palette = profile["clusters"]
+        colors = [palette[0]["hex"]] if palette else ["#000000"]
+        write_upload_metadata(upload_dir, filename, {
+            "colors": colors,
+            "palette": palette,
+            "color_engine": COLOR_ENGINE,
+            "color_histogram": profile["histogram"],
+        })
+    except Exception as e:
+        logger.warning(f"Colour extraction for {filename} failed: {e}")
+        return [], []
+    logger.info(f"Colours for {filename}: {colors} ({(time.perf_counter() - t) * 1000:.1f}ms)")
+    return colors, palette
+
+
+def _finish_and_save(
+    input_image: Image.Image,
+    output_image: Image.Image,
+    upload_dir: str,
+    do_refine_edges: bool,
+    enhance_for_athletes: bool,
+    output_format: str = "png",
+    lazy_uncropped: bool = False,
+    source_sha256: Optional[str] = None,
+) -> dict:
+    """Compute crop_bbox, post-process edges and write the uncropped and cropped files."""
+    # Bbox of non-transparent content in *original* image coords (before crop)
+    bbox = output_image.getbbox()
+    if bbox:
+        crop_bbox = {"x": bbox[0], "y": bbox[1], "width": bbox[2] - bbox[0], "height": bbox[3] - bbox[1]}
+    else:
+        crop_bbox = {"x": 0, "y": 0, "width": output_image.width, "height": output_image.height}
+
+    # Apply edge enhancements if requested (alpha only, in place, edge-band ROI only)
+    preset = "athlete" if enhance_for_athletes else "refine" if do_refine_edges else None
+    postprocess_timings = {}
+    if preset:
+        try:
+            output_image, postprocess_timings = postprocess_image_alpha(output_image, preset, feather=2, smooth=True)
+            logger.info(f"Alpha post-process ({preset}): {_format_timings(postprocess_timings)}")
+        except Exception as e:
+            logger.warning(f"Alpha post-process ({preset}) failed: {e}, keeping unprocessed edges")
+
+    # Uncropped version (same dimensions as original, transparent bg).
+    # Templates using "included"/"blurredOverlay" player background load this so
+    # alignment with the original image is trivial (identical pixel grids).
+    uncropped_filename = f"{uuid.uuid4()}_uncropped.{output_format}"
+    uncropped_filepath = os.path.join(upload_dir, uncropped_filename)
+
+    # Crop transparent edges to remove empty space (default for "removed" mode)
+    content_bbox = output_image.getbbox()
+    cropped_image = output_image.crop(content_bbox) if content_bbox else output_image
+
+    logger.info(f"Background removed, cropped size: {cropped_image.size}, uncropped size: {output_image.size}, crop_bbox: {crop_bbox}")
+
+    filename = f"{uuid.uuid4()}.{output_format}"
+    filepath = os.path.join(upload_dir, filename)
+    t = time.perf_counter()
+    uncropped_digest = None
+    if lazy_uncropped:
+        digest = _save_and_store(cropped_image, filepath, output_format)
+        os.makedirs(os.path.join(upload_dir, PENDING_UNCROPPED_DIR), exist_ok=True)
+        with open(_pending_path(upload_dir, uncropped_filename), "w") as f:
+            json.dump({
+                "filename": filename,
+                "size": list(output_image.size),
+                "offset": list(content_bbox[:2]) if content_bbox else [0, 0],
+                "format": output_format,
+                "source_sha256": source_sha256,
+            }, f)
+    else:
+        uncropped_job = _ENCODE_POOL.submit(_save_and_store, output_image, uncropped_filepath, output_format)
+        digest = _save_and_store(cropped_image, filepath, output_format)
+        uncropped_digest = uncropped_job.result()
+    encode_ms = (time.perf_counter() - t) * 1000
+
+    logger.info(
+        f"Saved to: {filepath} (cropped) and {uncropped_filepath} "
+        f"({'deferred' if lazy_uncropped else 'uncropped'}), encode {encode_ms:.1f}ms"
+    )
+
+    _record_provenance(
+        upload_dir, filename, "cropped", source_sha256, uncropped_filename=uncropped_filename, content_sha256=digest
+    )
+    if not lazy_uncropped:
+        _record_provenance(
+            upload_dir, uncropped_filename, "uncropped", source_sha256,
+            cropped_filename=filename, content_sha256=uncropped_digest,
+        )
+    colors, palette = _record_colors(cropped_image, upload_dir, filename)
+
+    return {
+        "filename": filename,
+        "uncropped_filename": uncropped_filename,
+        "original_size": input_image.size,
+        "processed_size": cropped_image.size,
+        "crop_bbox": crop_bbox,
+        "postprocess_ms": {k: round(v, 1) for k, v in postprocess_timings.items() if k.endswith("_ms")},
+        "encode_ms": round(encode_ms, 1),
+        "colors": colors,
+        "palette": palette,
+        "output_format": output_format,
+        "uncropped_lazy": lazy_uncropped,
+    }
+
+
+# Progressive /remove-bg preview: a small, fast model on a downscaled copy.
+REMBG_PREVIEW_MODEL = os.getenv("REMBG_PREVIEW_MODEL", "u2netp")
+REMBG_PREVIEW_MAX_SIDE = int(os.getenv("REMBG_PREVIEW_MAX_SIDE", "512"))
+
+
+def process_preview(
+    file_content: bytes,
+    upload_dir: str,
+    model: Optional[str] = None,
+    max_side: Optional[int] = None,
+) -> dict:
+    """
+    Low-resolution cutout for positioning in the card builder while the full result runs.
+
+    JPEGs are decoded at reduced scale (draft mode), the image is downscaled to max_side and
+    segmented with the preview model; no edge post-processing, PNG written at compress_level 1.
+
+    Returns a dict with filename, preview_size, original_size (after EXIF orientation), model
+    and crop_bbox scaled to original image coordinates.
+    Raises InvalidImageError if the bytes are not a readable image.
+    """
+    model = model or REMBG_PREVIEW_MODEL
+    max_side = max_side or REMBG_PREVIEW_MAX_SIDE
+    image = _decode_upload(file_content)
+    original_size = image.size
+    if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # EXIF orientation rotates by 90 degrees
+        original_size = (original_size[1], original_size[0])
+    image.draft("RGB", (max_side, max_side))  # no-op for formats other than JPEG
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_side, max_side), Image.BILINEAR)
+
+    with checkout_session(model) as session:
+        cutout = remove(image, session=session)
+
+    bbox = cutout.getbbox()
+    sx = original_size[0] / cutout.width
+    sy = original_size[1] / cutout.height
+    if bbox:
+        x0, y0 = int(bbox[0] * sx), int(bbox[1] * sy)
+        x1, y1 = min(original_size[0], int(round(bbox[2] * sx))), min(original_size[1], int(round(bbox[3] * sy)))
+        crop_bbox = {"x": x0, "y": y0, "width": x1 - x0, "height": y1 - y0}
+        cutout = cutout.crop(bbox)
+    else:
+        crop_bbox = {"x": 0, "y": 0, "width": original_size[0], "height": original_size[1]}
+
+    filename = f"{uuid.uuid4()}_preview.png"
+    replace_file(os.path.join(upload_dir, filename), lambda tmp: cutout.save(tmp, "PNG", compress_level=1))
+    _record_provenance(upload_dir, filename, "preview", source_hash(file_content))
+    logger.info(f"Preview cutout {filename} ({cutout.size}) with model: {model}")
+    return {
+        "filename": filename,
+        "preview_size": cutout.size,
+        "original_size": original_size,
+        "crop_bbox": crop_bbox,
+        "model": model,
+    }
+
+
+def process_upload(
+    file_content: bytes,
+    upload_dir: str,
+    model: str,
+    do_refine_edges: bool = True,
+    enhance_for_athletes: bool = False,
+    source_name: Optional[str] = None,
+    mask_mode: str = "full",
+    output_format: Optional[str] = None,
+    lazy_uncropped: Optional[bool] = None,
+) -> dict:
+    """
+    Decode an upload, remove its background, post-process edges and write the
+    cropped and uncropped PNGs into upload_dir.
+
+    mask_mode: "full" segments at full resolution; "proxy" segments a copy downscaled to
+    REMBG_PROXY_MAX_SIDE and guided-upsamples the mask; "auto" uses the proxy only above
+    REMBG_PROXY_TRIGGER_SIDE.
+
+    output_format: "png" or "webp" (lossless); defaults to REMBG_OUTPUT_FORMAT.
+    lazy_uncropped: defer the uncropped copy until materialize_uncropped is called;
+    defaults to REMBG_LAZY_UNCROPPED.
+
+    Returns a dict with filename, uncropped_filename, original_size (after EXIF orientation),
+    processed_size, crop_bbox (in original image coordinates), mask_mode ("full" or "proxy"),
+    postprocess_ms (per-stage alpha post-processing timings), encode_ms, colors (dominant
+    jersey colour, also stored in the upload's metadata sidecar), palette, output_format
+    and uncropped_lazy. Creation time and the SHA-256 of file_content go in each file's sidecar.
+    Raises InvalidImageError if the bytes are not a readable image.
+    """
+    output_settings = _output_settings(output_format, lazy_uncropped)
+    input_image = _decode_upload(file_content)
+
+    logger.info(f"Processing image: {source_name} ({input_image.size}) with model: {model}")
+
+    # Orientation is fixed first in both modes, so the mask matches what remove() cuts out and
+    # original_size / crop_bbox are always in the upright image's coordinates
+    input_image = ImageOps.exif_transpose(input_image)
+    proxied = use_proxy_mask(input_image.size, mask_mode)
+    if proxied:
+        proxy = make_proxy(input_image)
+        with checkout_session(model) as session:
+            proxy_mask = session.predict(proxy)[0]
+        mask = guided_upsample_mask(proxy_mask, proxy, input_image)
+        output_image = remove(input_image, session=_PrecomputedMaskSession(mask))
+    else:
+        # Check out a model session (exclusive while this image runs) and remove background
+        with checkout_session(model) as session:
+            output_image = remove(input_image, session=session)
+
+    result = _finish_and_save(
+        input_image, output_image, upload_dir, do_refine_edges, enhance_for_athletes, *output_settings,
+        source_sha256=source_hash(file_content),
+    )
+    result["mask_mode"] = "proxy" if proxied else "full"
+    return result
+
+
+def process_upload_batch(
+    file_contents: List[bytes],
+    upload_dir: str,
+    model: str,
+    do_refine_edges: bool = True,
+    enhance_for_athletes: bool = False,
+    source_names: Optional[List[str]] = None,
+    mask_mode: str = "full",
+    output_format: Optional[str] = None,
+    lazy_uncropped: Optional[bool] = None,
+) -> List[dict]:
+    """
+    Batched process_upload: decode every upload, predict all masks in one forward pass,
+    then post-process and save each image.
+
+    Returns one dict per input, in order: the process_upload result, or {"error": str}
+    for an upload that failed on its own (bad image, save error).
+    """
+    source_names = source_names or [None] * len(file_contents)
+    output_settings = _output_settings(output_format, lazy_uncropped)
+    results: List[dict] = [None] * len(file_contents)
+    images = []
+    for i, content in enumerate(file_contents):
+        try:
+            # Orientation is fixed before predicting so the mask matches what remove() cuts out
+            images.append((i, ImageOps.exif_transpose(_decode_upload(content))))
+        except InvalidImageError as e:
+            results[i] = {"error": str(e)}
+
+    if images:
+        logger.info(f"Processing batch of {len(images)} image(s) with model: {model}")
+        proxies = [make_proxy(img) if use_proxy_mask(img.size, mask_mode) else None for _, img in images]
+        with checkout_session(model) as session:
+            masks = predict_masks_batch(
+                session, model, [proxy or img for (_, img), proxy in zip(images, proxies)]
+            )
+        for (i, input_image), proxy, mask in zip(images, proxies, masks):
+            try:
+                if proxy is not None:
+                    mask = guided_upsample_mask(mask, proxy, input_image)
+                output_image = remove(input_image, session=_PrecomputedMaskSession(mask))
+                results[i] = _finish_and_save(
+                    input_image, output_image, upload_dir, do_refine_edges, enhance_for_athletes, *output_settings,
+                    source_sha256=source_hash(file_contents[i]),
+                )
+                results[i]["mask_mode"] = "full" if proxy is None else "proxy"
+            except Exception as e:
+                logger.error(f"Batch item {source_names[i]} failed: {e}")
+                results[i] = {"error": f"{type(e).__name__}: {e}"}
+    return results
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Benchmark colour extraction on the cutouts in static/uploads.
+
+1. Jersey-pixel filtering: the old per-pixel colorsys loop vs the array version in
+   color_extraction. Checks both keep exactly the same pixels; reports time per image for
+   each sample size.
+2. Clustering engines: "histogram" vs scikit-learn "kmeans" (skipped if scikit-learn is
+   missing). Reports time per image and the RGB distance between their dominant colours.
+
+Usage (from backend/):
+    python bench_color_extraction.py [--limit 50] [--sizes 100,150,200] [--tolerance 10]
+"""
+
+import argparse
+import colorsys
+import glob
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from color_extraction import (
+    _clusters_histogram,
+    _clusters_kmeans,
+    jersey_pixel_mask,
+    rgb_to_hex,
+    sample_solid_pixels,
+)
+
+UPLOAD_DIR = "static/uploads"
+
+
+def loop_filter(solid_pixels, min_saturation=0.2, min_value=0.2):
+    """The per-pixel loop extract_dominant_colors used before vectorizing."""
+    valid_pixels = []
+    for r, g, b, a in solid_pixels:
+        h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+        if v < min_value:
+            continue
+        if s < 0.12 and v > 0.9:
+            continue
+        is_skin_hue = 0.04 <= h <= 0.18
+        if is_skin_hue and s < 0.65:
+            continue
+        if s >= min_saturation:
+            valid_pixels.append([r, g, b])
+    return np.array(valid_pixels, dtype=np.uint8).reshape(-1, 3)
+
+
+def vector_filter(solid_pixels, min_saturation=0.2, min_value=0.2):
+    rgb = solid_pixels[:, :3]
+    return rgb[jersey_pixel_mask(rgb, min_saturation, min_value)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--limit", type=int, default=50, help="Max images to use")
+    parser.add_argument("--sizes", default="100,150,200", help="Comma-separated sample sizes")
+    parser.add_argument("--tolerance", type=float, default=10, help="Max RGB distance counted as the same colour")
+    args = parser.parse_args()
+
+    paths = sorted(
+        p for p in glob.glob(os.path.join(UPLOAD_DIR, "*"))
+        if p.lower().endswith((".png", ".webp"))
+    )[: args.limit]
+    if not paths:
+        print(f"No images found in {UPLOAD_DIR}")
+        return
+    images = []
+    for p in paths:
+        with Image.open(p) as im:
+            images.append(im.convert("RGBA"))
+    print(f"{len(images)} image(s) from {UPLOAD_DIR}\n")
+
+    print(f"{'size':>6} {'pixels':>8} {'loop ms':>9} {'array ms':>9} {'speedup':>8}  identical")
+    for size in (int(s) for s in args.sizes.split(",")):
+        samples = [sample_solid_pixels(im, size) for im in images]
+        t = time.perf_counter()
+        loop_out = [loop_filter(s) for s in samples]
+        loop_ms = (time.perf_counter() - t) * 1000 / len(samples)
+        t = time.perf_counter()
+        vec_out = [vector_filter(s) for s in samples]
+        vec_ms = (time.perf_counter() - t) * 1000 / len(samples)
+        identical = all(np.array_equal(a, b) for a, b in zip(loop_out, vec_out))
+        pixels = sum(len(s) for s in samples) // len(samples)
+        print(
+            f"{size:>6} {pixels:>8} {loop_ms:>9.2f} {vec_ms:>9.2f} "
+            f"{loop_ms / max(vec_ms, 1e-6):>7.1f}x  {'yes' if identical else 'NO'}"
+        )
+
+    compare_engines(images, args.tolerance)
+
+
+def compare_engines(images, tolerance):
+    try:
+        import sklearn  # noqa: F401
+    except ImportError:
+        print("\nscikit-learn not installed; skipping engine comparison")
+        return
+    inputs = []
+    for im in images:
+        solid = sample_solid_pixels(im)
+        if len(solid) == 0:
+            continue
+        rgb = solid[:, :3]
+        valid = vector_filter(solid)
+        if len(valid) < 30:
+            valid = rgb
+        inputs.append((valid, min(8, max(4, len(valid) // 30))))
+    if not inputs:
+        print("\nNo image has opaque pixels; skipping engine comparison")
+        return
+
+    results = {}
+    print(f"\n{'engine':>10} {'ms/image':>9}")
+    for name, fn in (("kmeans", _clusters_kmeans), ("histogram", _clusters_histogram)):
+        t = time.perf_counter()
+        results[name] = [rgb_to_hex(fn(valid, k)[0][0]) for valid, k in inputs]
+        print(f"{name:>10} {(time.perf_counter() - t) * 1000 / len(inputs):>9.2f}")
+
+    def to_rgb(hex_color):
+        return np.array([int(hex_color[i:i + 2], 16) for i in (1, 3, 5)])
+
+    dist = np.array([
+        np.linalg.norm(to_rgb(a) - to_rgb(b)) for a, b in zip(results["kmeans"], results["histogram"])
+    ])
+    within = int((dist <= tolerance).sum())
+    print(
+        f"\nhistogram vs kmeans: {within}/{len(dist)} within {tolerance:g} "
+        f"(mean {dist.mean():.1f}, p95 {np.percentile(dist, 95):.1f}, max {dist.max():.1f})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""
+Content-addressed blob storage shared by uploads and production assets.
+
+Files are stored once under their SHA-256 and placed into job directories (static/uploads,
+output/<order>/card_N/, temp_assets/<card_id>/) by reference: the local backend hard-links
+the blob, so the same hero or frame reused across cards and orders costs one copy on disk
+and no extra writes. Placement always goes through a temporary name and os.replace, so a
+linked file is never truncated or written in place.
+
+A placed file shares its inode with the blob and every other copy, and blobs are read-only.
+Code that rewrites such a file (a re-run of processing, a placeholder) must use
+replace_file(), which writes a temporary sibling and renames it over the link: only that name
+changes, and the blob and the other copies keep their bytes.
+
+Backends (BLOB_STORE):
+  - local (default): <BLOB_STORE_DIR>/sha256/ab/cd/<digest>. BLOB_STORE_DIR must be on the
+    same filesystem as the job directories for hard links; otherwise blobs are copied, the
+    store records that in <BLOB_STORE_DIR>/.copy_mode and gc() is disabled (a copied blob
+    always has link count 1, so link counts no longer say whether it is in use).
+  - s3: any S3-compatible service (e.g. a local MinIO) via boto3, configured with
+    BLOB_S3_BUCKET, BLOB_S3_ENDPOINT, BLOB_S3_PREFIX. Placement downloads the object.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+BLOB_STORE_BACKENDS = ("local", "s3")
+BLOB_STORE_BACKEND = os.getenv("BLOB_STORE", "local").strip().lower()
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", str(Path(__file__).resolve().parent / "blobs"))
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET", "")
+BLOB_S3_ENDPOINT = os.getenv("BLOB_S3_ENDPOINT") or None
+BLOB_S3_PREFIX = os.getenv("BLOB_S3_PREFIX", "blobs/")
+_HASH_CHUNK = 1024 * 1024
+COPY_MODE_MARKER = ".copy_mode"
+# A placement that finds its blob renamed away by a concurrent gc() retries this often.
+_LINK_RETRIES = 3
+
+PathLike = Union[str, Path]
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path: PathLike) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _tmp_sibling(dest: Path) -> Path:
+    return dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+
+
+def _move_over(tmp: Path, dest: Path) -> None:
+    """os.replace, except rename() does nothing when both names already link the same file."""
+    try:
+        if os.path.samefile(tmp, dest):
+            os.remove(tmp)
+            return
+    except FileNotFoundError:
+        pass
+    os.replace(tmp, dest)
+
+
+def replace_file(dest: PathLike, write: Callable[[Path], None]) -> Path:
+    """
+    Call write(tmp) for a temporary sibling of dest, then rename it over dest. Use this, never an
+    in-place write, for any file that may be linked to a blob. write must not infer the format
+    from tmp's suffix (pass it explicitly, e.g. image.save(tmp, "PNG")).
+    """
+    dest = Path(dest)
+    tmp = _tmp_sibling(dest)
+    try:
+        write(tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    return dest
+
+
+def _replace_with_bytes(data: bytes, dest: Path) -> None:
+    tmp = _tmp_sibling(dest)
+    tmp.write_bytes(data)
+    os.replace(tmp, dest)
+
+
+class LocalBlobStore:
+    """
+    Blobs as read-only files under root, placed into job directories by hard link.
+
+    Args:
+        root: Store directory; keep it on the job directories' filesystem.
+    """
+
+    def __init__(self, root: PathLike):
+        self.root = Path(root)
+        self._copy_marker = self.root / COPY_MODE_MARKER
+
+    @property
+    def copy_mode(self) -> bool:
+        """True once a blob had to be copied instead of hard-linked (another filesystem)."""
+        return self._copy_marker.exists()
+
+    def _mark_copy_mode(self, err: OSError) -> None:
+        if not self._copy_marker.exists():
+            logger.warning(f"Blob store {self.root}: hard links failed ({err}); copying instead, GC disabled")
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._copy_marker.write_text(f"{time.time()}\n{err}\n")
+
+    @staticmethod
+    def _touch(blob: Path) -> bool:
+        """Refresh blob's mtime so gc() leaves it alone for min_age_seconds. False if it is missing."""
+        try:
+            os.utime(blob)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def path(self, digest: str) -> Path:
+        return self.root / "sha256" / digest[:2] / digest[2:4] / digest
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def read_bytes(self, digest: str) -> bytes:
+        return self.path(digest).read_bytes()
+
+    def put_bytes(self, data: bytes) -> str:
+        """Store data (no-op if already present). Returns its digest."""
+        digest = sha256_bytes(data)
+        blob = self.path(digest)
+        if not self._touch(blob):
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            _replace_with_bytes(data, blob)
+            os.chmod(blob, 0o444)
+        return digest
+
+    def ingest(self, path: PathLike) -> str:
+        """
+        Take an already written file into the store without copying: a new blob is a hard link
+        to it; if the blob exists, path is replaced by a link to it (the duplicate is freed).
+        """
+        path = Path(path)
+        digest = sha256_file(path)
+        blob = self.path(digest)
+        if self._touch(blob):
+            if not os.path.samefile(blob, path):
+                self._link(blob, path)
+            return digest
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            tmp = _tmp_sibling(blob)
+            os.link(path, tmp)
+            os.replace(tmp, blob)
+        except OSError as e:  # other filesystem: the store keeps its own copy
+            self._mark_copy_mode(e)
+            tmp = _tmp_sibling(blob)
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, blob)
+        os.chmod(blob, 0o444)
+        return digest
+
+    def link_to(self, digest: str, dest: PathLike) -> Path:
+        """Place blob digest at dest (hard link, or copy across filesystems), replacing dest."""
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        self._link(self.path(digest), dest)
+        return dest
+
+    def _link(self, blob: Path, dest: Path) -> None:
+        tmp = _tmp_sibling(dest)
+        for attempt in range(_LINK_RETRIES):
+            try:
+                os.link(blob, tmp)
+                break
+            except FileNotFoundError:  # held by gc() for its final check, or really gone
+                if attempt == _LINK_RETRIES - 1:
+                    raise
+                time.sleep(0.01)
+            except OSError as e:
+                self._mark_copy_mode(e)
+                shutil.copyfile(blob, tmp)
+                os.chmod(tmp, 0o644)
+                break
+        _move_over(tmp, dest)
+
+    def gc(self, min_age_seconds: float = 3600) -> Tuple[int, int]:
+        """
+        Delete blobs no job directory links to any more (link count 1) and older than
+        min_age_seconds. Returns (blobs removed, bytes freed). Does nothing in copy mode.
+
+        Each candidate is first renamed away, so no placement can link it, and only deleted if
+        it is still unlinked and old; otherwise it is put back. put_bytes/ingest refresh the
+        mtime of a blob they reuse, so a blob about to be placed is never old.
+        """
+        if self.copy_mode:
+            logger.info(f"Blob store GC skipped: {self.root} is in copy mode (see {COPY_MODE_MARKER})")
+            return 0, 0
+        removed = freed = 0
+        cutoff = time.time() - min_age_seconds
+        for blob in self.root.glob("sha256/*/*/*"):
+            if blob.name.endswith(".tmp"):
+                continue
+            try:
+                st = blob.stat()
+                if st.st_nlink != 1 or st.st_mtime >= cutoff:
+                    continue
+                held = _tmp_sibling(blob)
+                os.rename(blob, held)
+            except FileNotFoundError:
+                continue
+            st = held.stat()
+            if st.st_nlink == 1 and st.st_mtime < cutoff:
+                held.unlink()
+                removed += 1
+                freed += st.st_size
+                continue
+            try:  # linked or reused meanwhile: put it back (unless it was re-stored already)
+                os.link(held, blob)
+            except FileExistsError:
+                pass
+            held.unlink()
+        if removed:
+            logger.info(f"Blob store GC: {removed} blob(s), {freed / 1e6:.1f} MB freed")
+        return removed, freed
+
+    def stats(self) -> dict:
+        blobs = [p.stat() for p in self.root.glob("sha256/*/*/*")]
+        return {
+            "backend": "local",
+            "root": str(self.root),
+            "mode": "copy" if self.copy_mode else "link",
+            "blobs": len(blobs),
+            "bytes": sum(st.st_size for st in blobs),
+            # Extra names pointing at stored bytes: writes and disk space saved by linking
+            "links": sum(st.st_nlink - 1 for st in blobs),
+        }
+
+
+class S3BlobStore:
+    """
+    Blobs as objects <prefix><digest> in an S3-compatible bucket (boto3, imported lazily).
+    Placement downloads the object; there are no link counts, so gc() is a no-op.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, prefix: str = "blobs/"):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("BLOB_STORE=s3 requires boto3 (pip install boto3)") from None
+        if not bucket:
+            raise RuntimeError("BLOB_STORE=s3 requires BLOB_S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, digest: str) -> str:
+        return f"{self.prefix}{digest}"
+
+    def exists(self, digest: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(digest))
+            return True
+        except ClientError:
+            return False
+
+    def read_bytes(self, digest: str) -> bytes:
+        return self._client.get_object(Bucket=self.bucket, Key=self._key(digest))["Body"].read()
+
+    def put_bytes(self, data: bytes) -> str:
+        digest = sha256_bytes(data)
+        if not self.exists(digest):
+            self._client.put_object(Bucket=self.bucket, Key=self._key(digest), Body=data)
+        return digest
+
+    def ingest(self, path: PathLike) -> str:
+        """Upload a written file if its content is new; the local file stays as it is."""
+        digest = sha256_file(path)
+        if not self.exists(digest):
+            self._client.upload_file(str(path), self.bucket, self._key(digest))
+        return digest
+
+    def link_to(self, digest: str, dest: PathLike) -> Path:
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = _tmp_sibling(dest)
+        self._client.download_file(self.bucket, self._key(digest), str(tmp))
+        os.replace(tmp, dest)
+        return dest
+
+    def gc(self, min_age_seconds: float = 3600) -> Tuple[int, int]:
+        return 0, 0
+
+    def stats(self) -> dict:
+        return {"backend": "s3", "bucket": self.bucket, "endpoint": BLOB_S3_ENDPOINT, "prefix": self.prefix}
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_blob_store():
+    """The process-wide store for BLOB_STORE (created on first use)."""
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            if BLOB_STORE_BACKEND not in BLOB_STORE_BACKENDS:
+                raise ValueError(f"Unknown BLOB_STORE {BLOB_STORE_BACKEND!r}; expected one of {BLOB_STORE_BACKENDS}")
+            if BLOB_STORE_BACKEND == "s3":
+                _STORE = S3BlobStore(BLOB_S3_BUCKET, BLOB_S3_ENDPOINT, BLOB_S3_PREFIX)
+            else:
+                _STORE = LocalBlobStore(BLOB_STORE_DIR)
+        return _STORE
+
+
+def store_bytes_at(data: bytes, dest: PathLike) -> str:
+    """Store data and place it at dest. Returns the digest."""
+    store = get_blob_store()
+    digest = store.put_bytes(data)
+    store.link_to(digest, dest)
+    return digest
+
+
+def store_temp_file_at(tmp: PathLike, dest: PathLike) -> str:
+    """Store a freshly written temporary file (e.g. a download) and move it over dest. Returns the digest."""
+    digest = get_blob_store().ingest(tmp)
+    _move_over(Path(tmp), Path(dest))
+    return digest
+
+
+def store_file_at(src: PathLike, dest: PathLike) -> str:
+    """Store an existing file (e.g. an upload) and place it at dest without re-downloading. Returns the digest."""
+    store = get_blob_store()
+    digest = store.ingest(src)
+    if isinstance(store, LocalBlobStore):
+        store.link_to(digest, dest)
+    else:  # the bytes are already local; no need to download them back
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = _tmp_sibling(dest)
+        shutil.copyfile(src, tmp)
+        _move_over(tmp, dest)
+    return digest
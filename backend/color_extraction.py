@@ -0,0 +1,332 @@
+"""
+Dominant jersey colour extraction for background-removed player photos.
+
+The cutout is downscaled to a COLOR_SAMPLE_SIZE square, the lower part (jersey/torso) is
+kept, and transparent, dark, washed-out and skin-toned pixels are filtered out with array
+operations before clustering. The HSV conversion matches colorsys.rgb_to_hsv exactly.
+
+The default "histogram" engine bins the pixels into a 32x32x32 colour histogram and clusters
+the few hundred occupied bins (weighted by count) instead of every pixel; scikit-learn KMeans
+is only imported when the "kmeans" engine is selected.
+
+color_profile also returns that histogram (occupied bins only, ~5-10KB of JSON) for storing with the upload;
+palette_from_histogram derives palettes with any n_colors/thresholds from it later.
+"""
+
+import binascii
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Side of the square the image is resized to before sampling (150 -> ~10k jersey pixels)
+COLOR_SAMPLE_SIZE = int(os.getenv("COLOR_SAMPLE_SIZE", "150"))
+# Fraction of rows skipped from the top (head/shoulders); colours come from the rows below
+JERSEY_SKIP_TOP_FRACTION = 0.55
+# Clustering engine: "histogram" (NumPy, no scikit-learn) or "kmeans" (scikit-learn KMeans)
+COLOR_ENGINES = ("histogram", "kmeans")
+COLOR_ENGINE = os.getenv("COLOR_ENGINE", "histogram").strip().lower()
+_HIST_BITS = 5  # 32 levels per channel
+_HIST_KMEANS_N_INIT = 4
+_HIST_KMEANS_MAX_ITER = 50
+PALETTE_ROLES = ("primary", "secondary", "accent")
+# Palettes are rarer than uploads; more restarts keep the primary stable across variants
+_PALETTE_KMEANS_N_INIT = 20
+
+
+def rgb_to_hsv_array(rgb: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorized colorsys.rgb_to_hsv for an (N, 3) array of 0-255 values.
+    Returns (h, s, v) float64 arrays in [0, 1].
+    """
+    rgb = rgb.astype(np.float64) / 255
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    rangec = maxc - minc
+    grey = rangec == 0
+    safe_max = np.where(maxc == 0, 1.0, maxc)
+    safe_range = np.where(grey, 1.0, rangec)
+    s = np.where(grey, 0.0, rangec / safe_max)
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(grey, 0.0, (h / 6.0) % 1.0)
+    return h, s, maxc
+
+
+def jersey_pixel_mask(
+    rgb: np.ndarray,
+    min_saturation: float = 0.2,
+    min_value: float = 0.2,
+) -> np.ndarray:
+    """Boolean mask over (N, 3) pixels: colourful enough, not near-white, not skin-toned."""
+    h, s, v = rgb_to_hsv_array(rgb)
+    keep = v >= min_value
+    keep &= ~((s < 0.12) & (v > 0.9))
+    # Exclude skin: orange/peach hue (0.04–0.18) unless very saturated (jersey)
+    keep &= ~((h >= 0.04) & (h <= 0.18) & (s < 0.65))
+    # Exclude low saturation (gray/skin)
+    keep &= s >= min_saturation
+    return keep
+
+
+def sample_solid_pixels(image: Image.Image, sample_size: Optional[int] = None) -> np.ndarray:
+    """
+    Opaque (alpha > 128) RGBA pixels from the jersey area of the downscaled image, or from
+    the whole image if the jersey area has none. Shape (N, 4), uint8.
+    """
+    sample_size = sample_size or COLOR_SAMPLE_SIZE
+    img = image.convert("RGBA").resize((sample_size, sample_size), Image.Resampling.LANCZOS)
+    ar = np.asarray(img)
+    # Sample only the lower 45% of the image (jersey/torso area); skip the upper 55% (head/shoulders)
+    rows_jersey = int(ar.shape[0] * JERSEY_SKIP_TOP_FRACTION)
+    ar_flat = ar[rows_jersey:].reshape(-1, 4)
+    solid_pixels = ar_flat[ar_flat[:, 3] > 128]
+    if len(solid_pixels) == 0:
+        all_pixels = ar.reshape(-1, 4)
+        solid_pixels = all_pixels[all_pixels[:, 3] > 128]
+    return solid_pixels
+
+
+def rgb_to_hex(rgb) -> str:
+    color_bytes = bytearray(int(round(c)) for c in np.clip(rgb, 0, 255))
+    return f"#{binascii.hexlify(color_bytes).decode('ascii')}"
+
+
+def _histogram_bins(rgb: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Bin indices, counts and per-channel sums of the non-empty bins of a 3D colour histogram."""
+    q = (rgb >> (8 - _HIST_BITS)).astype(np.int32)
+    idx = (q[:, 0] << (2 * _HIST_BITS)) | (q[:, 1] << _HIST_BITS) | q[:, 2]
+    n_bins = 1 << (3 * _HIST_BITS)
+    counts = np.bincount(idx, minlength=n_bins)
+    sums = np.stack([np.bincount(idx, weights=rgb[:, c], minlength=n_bins) for c in range(3)], axis=1)
+    nonzero = np.flatnonzero(counts)
+    return nonzero, counts[nonzero].astype(np.float64), sums[nonzero]
+
+
+def _weighted_kmeans(points: np.ndarray, weights: np.ndarray, k: int, rng: np.random.Generator):
+    """One k-means++ seeded Lloyd run over weighted points. Returns (labels, inertia)."""
+    centers = [points[rng.choice(len(points), p=weights / weights.sum())]]
+    d2 = ((points - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        p = weights * d2
+        if p.sum() <= 0:
+            break
+        centers.append(points[rng.choice(len(points), p=p / p.sum())])
+        d2 = np.minimum(d2, ((points - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+    point_norms = np.einsum("ij,ij->i", points, points)[:, None]
+    labels = None
+    for _ in range(_HIST_KMEANS_MAX_ITER):
+        dist = point_norms - 2 * points @ centers.T + np.einsum("ij,ij->i", centers, centers)[None, :]
+        new_labels = dist.argmin(axis=1)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        onehot = np.zeros((len(centers), len(points)))
+        onehot[labels, np.arange(len(points))] = weights
+        w = onehot.sum(axis=1)
+        filled = w > 0
+        centers[filled] = (onehot[filled] @ points) / w[filled, None]
+    inertia = float((weights * np.maximum(dist[np.arange(len(points)), labels], 0)).sum())
+    return labels, inertia
+
+
+def _sorted_clusters(centers: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(-weights, kind="stable")
+    return centers[order], weights[order]
+
+
+def _cluster_bins(
+    counts: np.ndarray, sums: np.ndarray, n_clusters: int, n_init: int = _HIST_KMEANS_N_INIT
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted k-means over histogram bin means; centres are exact pixel means of their bins."""
+    means = sums / counts[:, None]
+    if len(means) <= n_clusters:
+        return _sorted_clusters(means, counts)
+    rng = np.random.default_rng(42)
+    labels, _ = min(
+        (_weighted_kmeans(means, counts, n_clusters, rng) for _ in range(n_init)),
+        key=lambda run: run[1],
+    )
+    used = np.unique(labels)
+    weights = np.array([counts[labels == c].sum() for c in used])
+    centers = np.array([sums[labels == c].sum(axis=0) for c in used]) / weights[:, None]
+    return _sorted_clusters(centers, weights)
+
+
+def _clusters_histogram(rgb: np.ndarray, n_clusters: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster colours via a 32-level-per-channel histogram: weighted k-means over the bin means
+    (a few hundred points instead of every pixel). Returns (centers, pixel counts), heaviest
+    cluster first.
+    """
+    _, counts, sums = _histogram_bins(rgb)
+    return _cluster_bins(counts, sums, n_clusters)
+
+
+def _clusters_kmeans(rgb: np.ndarray, n_clusters: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Cluster colours with scikit-learn KMeans over every pixel (the original engine)."""
+    from sklearn.cluster import KMeans
+
+    kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=42)
+    labels = kmeans.fit_predict(rgb)
+    unique, counts = np.unique(labels, return_counts=True)
+    return _sorted_clusters(kmeans.cluster_centers_[unique], counts.astype(np.float64))
+
+
+_ENGINES = {"histogram": _clusters_histogram, "kmeans": _clusters_kmeans}
+
+
+def _valid_jersey_pixels(solid_pixels: np.ndarray, min_saturation: float, min_value: float) -> np.ndarray:
+    rgb = solid_pixels[:, :3]
+    valid_pixels = rgb[jersey_pixel_mask(rgb, min_saturation, min_value)]
+    return valid_pixels if len(valid_pixels) >= 30 else rgb
+
+
+def _clusters_from_pixels(valid_pixels: np.ndarray, engine: str) -> List[dict]:
+    n_clusters = min(8, max(4, len(valid_pixels) // 30))
+    try:
+        centers, weights = _ENGINES[engine](valid_pixels, n_clusters)
+    except ImportError:
+        logger.warning("scikit-learn not installed; using the histogram colour engine")
+        centers, weights = _clusters_histogram(valid_pixels, n_clusters)
+    total = weights.sum()
+    return [
+        {"hex": rgb_to_hex(center), "weight": round(float(weight / total), 4)}
+        for center, weight in zip(centers, weights)
+    ]
+
+
+def _check_engine(engine: Optional[str]) -> str:
+    engine = engine or COLOR_ENGINE
+    if engine not in COLOR_ENGINES:
+        raise ValueError(f"Unknown colour engine {engine!r}; expected one of {COLOR_ENGINES}")
+    return engine
+
+
+def extract_color_clusters(
+    image: Image.Image,
+    min_saturation: float = 0.2,
+    min_value: float = 0.2,
+    sample_size: Optional[int] = None,
+    engine: Optional[str] = None,
+) -> List[dict]:
+    """
+    Jersey colour clusters of an image, most dominant first: [{"hex", "weight"}] where weight
+    is the cluster's share of the sampled pixels. Empty if the image has no opaque pixels.
+    Sampling, filtering and engines are as in extract_dominant_colors.
+    """
+    engine = _check_engine(engine)
+    solid_pixels = sample_solid_pixels(image, sample_size)
+    if len(solid_pixels) == 0:
+        return []
+    return _clusters_from_pixels(_valid_jersey_pixels(solid_pixels, min_saturation, min_value), engine)
+
+
+def _histogram_record(solid_pixels: np.ndarray) -> dict:
+    """Occupied bins as pixel counts and mean colours (rounded); ~5-10KB of JSON."""
+    _, counts, sums = _histogram_bins(solid_pixels[:, :3])
+    means = np.rint(sums / np.maximum(counts, 1)[:, None]).astype(int) if len(counts) else np.zeros((0, 3), int)
+    return {
+        "bits": _HIST_BITS,
+        "counts": counts.astype(int).tolist(),
+        "means": means.tolist(),
+    }
+
+
+def color_profile(image: Image.Image, sample_size: Optional[int] = None, engine: Optional[str] = None) -> dict:
+    """
+    Everything colour-related that is stored per upload, from one sampling pass:
+    clusters (as extract_color_clusters with default thresholds) and the compact colour
+    histogram of the unfiltered jersey-area pixels that palette_from_histogram works from.
+    """
+    engine = _check_engine(engine)
+    solid_pixels = sample_solid_pixels(image, sample_size)
+    if len(solid_pixels) == 0:
+        return {"clusters": [], "histogram": _histogram_record(np.zeros((0, 4), np.uint8))}
+    return {
+        "clusters": _clusters_from_pixels(_valid_jersey_pixels(solid_pixels, 0.2, 0.2), engine),
+        "histogram": _histogram_record(solid_pixels),
+    }
+
+
+def palette_from_histogram(
+    histogram: dict,
+    n_colors: int = 3,
+    min_saturation: float = 0.2,
+    min_value: float = 0.2,
+    min_distance: float = 40.0,
+) -> List[dict]:
+    """
+    Weighted palette from a stored colour histogram (no pixel access).
+
+    Bins are filtered like pixels in extract_dominant_colors (by their mean colour), clustered,
+    and clusters are taken heaviest first, skipping any within min_distance (RGB) of one
+    already chosen, so secondary/accent are not shades of the primary.
+
+    Returns up to n_colors [{"hex", "weight", "role"}]; role is primary, secondary, accent,
+    then extra. weight is the share of the (filtered) jersey pixels.
+    """
+    counts = np.asarray(histogram.get("counts", []), dtype=np.float64)
+    if counts.size == 0 or n_colors < 1:
+        return []
+    means = np.asarray(histogram["means"], dtype=np.float64).reshape(-1, 3)
+    sums = means * counts[:, None]
+    keep = jersey_pixel_mask(means, min_saturation, min_value)
+    if counts[keep].sum() >= 30:
+        counts, sums = counts[keep], sums[keep]
+    total = counts.sum()
+    n_clusters = max(n_colors, min(8, max(4, int(total) // 30)))
+    centers, weights = _cluster_bins(counts, sums, n_clusters, n_init=_PALETTE_KMEANS_N_INIT)
+
+    chosen = []
+    for center, weight in zip(centers, weights):
+        if all(np.linalg.norm(center - other) >= min_distance for other, _ in chosen):
+            chosen.append((center, weight))
+            if len(chosen) == n_colors:
+                break
+    return [
+        {
+            "hex": rgb_to_hex(center),
+            "weight": round(float(weight / total), 4),
+            "role": PALETTE_ROLES[i] if i < len(PALETTE_ROLES) else "extra",
+        }
+        for i, (center, weight) in enumerate(chosen)
+    ]
+
+
+def extract_dominant_colors(
+    image: Image.Image,
+    n_colors: int = 4,
+    min_saturation: float = 0.2,
+    min_value: float = 0.2,
+    sample_size: Optional[int] = None,
+    engine: Optional[str] = None,
+) -> List[str]:
+    """
+    Extract the single most dominant jersey color from an image by clustering its pixels.
+
+    Samples only the lower 45% of the image (jersey/torso); filters out transparent pixels,
+    skin tones, and very desaturated grays.
+
+    engine: "histogram" (default, COLOR_ENGINE) or "kmeans" (scikit-learn, n_init=10).
+
+    Returns a list with one hex color: the cluster that has the most pixels (most dominant).
+    """
+    try:
+        clusters = extract_color_clusters(image, min_saturation, min_value, sample_size, engine)
+        if not clusters:
+            logger.warning("No solid pixels found in image")
+            return ["#000000"]
+        return [clusters[0]["hex"]]
+
+    except Exception as e:
+        logger.error(f"Error extracting colors: {e}")
+        return ["#000000"]
@@ -2,10 +2,8 @@ import asyncio
 import os
 import shutil
 import sys
-import threading
+import time
 import uuid
-import colorsys
-import binascii
 import io
 import json
 import logging
@@ -13,13 +11,43 @@ from datetime import datetime
 from pathlib import Path
 from typing import Optional, List
 import numpy as np
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Header, Depends
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Header, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from rembg import remove, new_session
+from fastapi.responses import JSONResponse, StreamingResponse
 from PIL import Image
-from sklearn.cluster import KMeans
+
+from background_removal import (
+    AVAILABLE_MODELS,
+    MASK_MODES,
+    OUTPUT_FORMATS,
+    REMBG_OUTPUT_FORMAT,
+    InvalidImageError,
+    materialize_uncropped,
+    process_preview,
+    process_upload,
+    process_upload_batch,
+    preload_models,
+    session_registry_status,
+)
+from blob_store import get_blob_store
+from color_extraction import (
+    COLOR_ENGINE,
+    PALETTE_ROLES,
+    color_profile,
+    extract_dominant_colors,
+    palette_from_histogram,
+)
+from production.card_pool import get_card_pool, shutdown_card_pool
+from production.control import JobCancelled, JobControl, ProductionTimeout
+from production.events import ProductionEventBus
+from production.registry import ProductionRegistry
+from production.scheduler import PRIORITIES, ProductionScheduler, QueueFullError
+from result_cache import ResultCache, make_cache_key
+from static_serving import IMMUTABLE_CACHE_CONTROL, CachingStaticFiles, file_response, precompress_dir
+from upload_index import UPLOAD_NAME_RE, UploadIndex, fetch_referenced_uploads
+from upload_metadata import UploadMetadataIndex
+from worker_pool import PoolFullError, Reservation, WorkerPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -37,38 +65,6 @@ async def unhandled_exception_handler(request, exc):
         content={"detail": str(exc)},
     )
 
-# Initialize RemBG sessions for different models (lazy loaded)
-# All models are FREE and run locally - no API fees!
-REMBG_SESSIONS = {}
-AVAILABLE_MODELS = {
-    'u2net': 'General purpose - Fast and accurate',
-    'u2netp': 'Lightweight - Faster, lower memory',
-    'u2net_human_seg': 'Optimized for people in static poses',
-    'u2net_cloth_seg': 'Optimized for clothing details',
-    'silueta': 'High quality edges - Excellent for dynamic poses',
-    'isnet-general-use': 'Best overall - Recommended for athletes ⭐',
-    'isnet-anime': 'Cartoon/illustrated characters only',
-}
-
-def get_rembg_session(model_name: str = 'u2net_human_seg'):
-    """
-    Get or create a RemBG session for the specified model.
-    Sessions are cached for performance.
-    All models run locally with NO API fees!
-    """
-    if model_name not in REMBG_SESSIONS:
-        try:
-            logger.info(f"Initializing RemBG model: {model_name}")
-            REMBG_SESSIONS[model_name] = new_session(model_name)
-            logger.info(f"Model {model_name} loaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to load model {model_name}: {e}")
-            # Fallback to default model
-            if 'u2net' not in REMBG_SESSIONS:
-                REMBG_SESSIONS['u2net'] = new_session('u2net')
-            return REMBG_SESSIONS['u2net']
-    return REMBG_SESSIONS[model_name]
-
 # Allowed origins for CORS (must be explicit when using credentials)
 CORS_ORIGINS = ["http://localhost:5173", "http://127.0.0.1:5173"]
 
@@ -87,6 +83,38 @@ async def add_cors_headers(request, call_next):
     return response
 
 
+async def reject_oversized_uploads(request, call_next):
+    """
+    Refuse upload requests whose declared Content-Length is over the limit before the
+    multipart body is read or spooled. Chunked uploads without a length are still capped
+    per file by read_upload_limited().
+    """
+    limit = UPLOAD_BODY_LIMITS.get(request.url.path)
+    if limit is not None and request.method == "POST":
+        try:
+            declared = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            declared = 0
+        if declared > limit:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Upload too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB per file"},
+            )
+    return await call_next(request)
+
+
+async def track_upload_access(request, call_next):
+    """Record reads of /static/uploads/* in the upload index (LRU order for disk-budget eviction)."""
+    response = await call_next(request)
+    path = request.url.path
+    if request.method == "GET" and path.startswith("/static/uploads/") and response.status_code in (200, 206, 304):
+        UPLOAD_INDEX.touch(path.rsplit("/", 1)[1])
+    return response
+
+
+# Innermost: reject oversized upload bodies (responses still pass through the CORS layers below)
+app.middleware("http")(reject_oversized_uploads)
+app.middleware("http")(track_upload_access)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
@@ -102,10 +130,124 @@ app.middleware("http")(add_cors_headers)
 UPLOAD_DIR = "static/uploads"
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
+ALLOWED_IMAGE_FORMATS = {"PNG", "JPEG", "WEBP"}  # PIL format names, checked from the header
+# Pillow names multi-picture JPEGs (many phone cameras) "MPO"; they decode as ordinary JPEGs.
+IMAGE_FORMAT_ALIASES = {"MPO": "JPEG"}
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))  # decoded size guard (~50MP)
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_SNIFF_BYTES = 1024 * 1024  # JPEGs with large EXIF blocks put SOF further in
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Per-upload sidecar records (dominant colours, palette) written by background removal
+UPLOAD_METADATA = UploadMetadataIndex(UPLOAD_DIR)
+# Retention for static/uploads: unreferenced files (no order_cards.design_data mentions them)
+# are deleted once not accessed for UPLOAD_TTL_HOURS; above UPLOAD_DISK_BUDGET_MB the least
+# recently used ones go first. Nothing younger than UPLOAD_MIN_AGE_HOURS is deleted.
+# UPLOAD_SWEEP_INTERVAL_MINUTES=0 disables the background sweeper (POST /api/uploads/sweep still works).
+UPLOAD_INDEX = UploadIndex(
+    UPLOAD_DIR,
+    ttl_seconds=float(os.getenv("UPLOAD_TTL_HOURS", "720")) * 3600,
+    max_bytes=int(float(os.getenv("UPLOAD_DISK_BUDGET_MB", "0")) * 1024 * 1024),
+    min_age_seconds=float(os.getenv("UPLOAD_MIN_AGE_HOURS", "24")) * 3600,
+)
+UPLOAD_SWEEP_INTERVAL_SECONDS = float(os.getenv("UPLOAD_SWEEP_INTERVAL_MINUTES", "60")) * 60
+
+
+def is_immutable_static(path: str) -> bool:
+    """UUID-named results in uploads/ are never rewritten under the same name: cache them forever."""
+    folder, _, name = path.rpartition("/")
+    return folder == "uploads" and UPLOAD_NAME_RE.fullmatch(name) is not None
+
+
+# ETag/304, byte ranges, immutable caching for uploads; dot paths (.meta, .pending) are not served
+app.mount("/static", CachingStaticFiles(directory="static", is_immutable=is_immutable_static), name="static")
+
+# Background removal worker pool: inference + edge filters run here, never on the event loop.
+# REMBG_POOL_KIND=thread|process, REMBG_WORKERS = concurrent jobs, REMBG_MAX_QUEUE = jobs allowed to wait.
+REMBG_POOL_KIND = os.getenv("REMBG_POOL_KIND", "thread").strip().lower()
+REMBG_WORKERS = int(os.getenv("REMBG_WORKERS", "2"))
+REMBG_MAX_QUEUE = int(os.getenv("REMBG_MAX_QUEUE", "16"))
+# Models loaded, warmed and pinned at startup (comma-separated; empty = fully lazy).
+REMBG_PRELOAD_MODELS = [m.strip() for m in os.getenv("REMBG_PRELOAD_MODELS", "isnet-general-use").split(",") if m.strip()]
+REMBG_POOL = WorkerPool(
+    "rembg",
+    max_workers=REMBG_WORKERS,
+    kind=REMBG_POOL_KIND,
+    max_queue=REMBG_MAX_QUEUE,
+    # Process workers each hold their own sessions, so each one warms up on start
+    initializer=preload_models if REMBG_POOL_KIND == "process" else None,
+    initargs=(REMBG_PRELOAD_MODELS,),
+)
+# Progressive previews (small model, small image) get their own threads, so the quick first
+# result never waits behind full-quality runs on REMBG_POOL.
+REMBG_PREVIEW_POOL = WorkerPool(
+    "rembg-preview",
+    max_workers=int(os.getenv("REMBG_PREVIEW_WORKERS", "1")),
+    max_queue=int(os.getenv("REMBG_PREVIEW_MAX_QUEUE", "8")),
+)
+
+# /remove-bg/batch: max files per request, and images per ONNX forward pass (micro-batch).
+MAX_BATCH_FILES = int(os.getenv("REMBG_MAX_BATCH_FILES", "40"))
+REMBG_MICRO_BATCH = max(1, int(os.getenv("REMBG_MICRO_BATCH", "4")))
+
+# Declared request body limits (multipart overhead included) for reject_oversized_uploads
+_MULTIPART_OVERHEAD = 64 * 1024
+UPLOAD_BODY_LIMITS = {
+    "/remove-bg": MAX_FILE_SIZE + _MULTIPART_OVERHEAD,
+    "/remove-bg/batch": MAX_BATCH_FILES * (MAX_FILE_SIZE + _MULTIPART_OVERHEAD),
+}
+
+# Content-addressed /remove-bg result cache (same bytes + options -> same PNGs). 0 disables it.
+REMBG_CACHE_MAX_BYTES = int(os.getenv("REMBG_CACHE_MAX_MB", "512")) * 1024 * 1024
+REMBG_RESULT_CACHE = ResultCache(REMBG_CACHE_MAX_BYTES, UPLOAD_DIR)
+
+
+@app.on_event("startup")
+async def preload_rembg_models():
+    """Load and warm REMBG_PRELOAD_MODELS before serving, so the first upload after a deploy is fast."""
+    if REMBG_POOL_KIND == "thread" and REMBG_PRELOAD_MODELS:
+        await asyncio.get_running_loop().run_in_executor(None, preload_models, REMBG_PRELOAD_MODELS)
+
+
+def run_upload_sweep(dry_run: bool = False) -> dict:
+    """Reload order_cards references, then sweep static/uploads (blocking; run in an executor)."""
+    referenced = fetch_referenced_uploads()
+    if referenced is not None:
+        UPLOAD_INDEX.set_references(referenced)
+    summary = UPLOAD_INDEX.sweep(dry_run=dry_run)
+    if not dry_run and "skipped" not in summary:
+        # Blobs whose last upload/job-directory link was just removed
+        summary["blobs_removed"], summary["blob_bytes_freed"] = get_blob_store().gc()
+    return summary
+
+
+async def _upload_sweeper():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL_SECONDS)
+        try:
+            await loop.run_in_executor(None, run_upload_sweep)
+        except Exception:
+            logger.exception("Upload sweep failed")
+
+
+@app.on_event("startup")
+async def start_upload_index():
+    """Build the static/uploads index and start the retention sweeper."""
+    await asyncio.get_running_loop().run_in_executor(None, UPLOAD_INDEX.scan)
+    if UPLOAD_SWEEP_INTERVAL_SECONDS > 0:
+        app.state.upload_sweeper = asyncio.create_task(_upload_sweeper())
+
+
+@app.on_event("shutdown")
+def shutdown_worker_pools():
+    """Stop background-removal workers (and the upload sweeper) when the server exits."""
+    sweeper = getattr(app.state, "upload_sweeper", None)
+    if sweeper is not None:
+        sweeper.cancel()
+    REMBG_POOL.shutdown()
+    REMBG_PREVIEW_POOL.shutdown()
 
 
 def validate_file_extension(filename: str) -> bool:
@@ -118,87 +260,63 @@ def validate_file_size(file_content: bytes) -> bool:
     return len(file_content) <= MAX_FILE_SIZE
 
 
-def crop_transparent_edges(image: Image.Image) -> Image.Image:
-    """
-    Crop transparent edges from image to remove empty space.
-    This fixes the "wide handles" issue where background removal
-    leaves too much transparent padding.
-    """
-    bbox = image.getbbox()
-    if bbox:
-        return image.crop(bbox)
-    return image
-
-
-def refine_edges(image: Image.Image, feather: int = 2, smooth: bool = True) -> Image.Image:
+def sniff_image_header(head: bytes) -> Optional[tuple]:
     """
-    Refine edges for crisp, smooth results - perfect for athlete photos.
-    
-    Args:
-        image: RGBA image with transparent background
-        feather: Edge softening amount (0-5, default 2)
-        smooth: Apply smoothing filter to edges
-    
-    Returns:
-        Image with refined edges
+    Identify format and dimensions from the first bytes of an upload without decoding pixels.
+    Returns (format, (width, height)), or None if the header is incomplete or not an image.
     """
     try:
-        from PIL import ImageFilter, ImageChops
-        
-        if image.mode != 'RGBA':
-            return image
-        
-        # Extract alpha channel
-        alpha = image.split()[3]
-        
-        if smooth:
-            # Smooth edges to remove jaggedness
-            alpha = alpha.filter(ImageFilter.SMOOTH_MORE)
-        
-        if feather > 0:
-            # Feather edges slightly for natural look
-            for _ in range(feather):
-                alpha = alpha.filter(ImageFilter.SMOOTH)
-        
-        # Apply refined alpha back
-        r, g, b, _ = image.split()
-        return Image.merge('RGBA', (r, g, b, alpha))
-    
-    except Exception as e:
-        logger.warning(f"Edge refinement failed: {e}, returning original")
-        return image
+        with Image.open(io.BytesIO(head)) as probe:
+            return IMAGE_FORMAT_ALIASES.get(probe.format, probe.format), probe.size
+    except Exception:
+        return None
 
 
-def enhance_edges_for_athletes(image: Image.Image) -> Image.Image:
+async def read_upload_limited(file: UploadFile) -> bytes:
     """
-    Special edge enhancement for athlete/dynamic photos.
-    Focuses on crisp edges around limbs, hair, and equipment.
+    Read an upload in chunks, stopping as soon as it can be rejected. Starlette has already
+    spooled the multipart body by the time the handler runs, so this bounds memory, not the
+    bytes received (only reject_oversized_uploads refuses a body before it arrives). Rejects:
+    - as soon as more than MAX_FILE_SIZE bytes have been read;
+    - once the header is readable, if the format isn't PNG/JPEG/WebP or the image has more
+      than MAX_IMAGE_PIXELS pixels;
+    - if no image header is found in the first UPLOAD_SNIFF_BYTES.
+    Raises HTTPException(400) on rejection; returns the full bytes otherwise.
     """
-    try:
-        from PIL import ImageFilter, ImageEnhance
-        
-        if image.mode != 'RGBA':
-            return image
-        
-        # Extract alpha channel
-        r, g, b, alpha = image.split()
-        
-        # Step 1: Remove noise from alpha
-        alpha = alpha.filter(ImageFilter.MedianFilter(size=3))
-        
-        # Step 2: Enhance edge contrast (makes edges more defined)
-        enhancer = ImageEnhance.Contrast(alpha)
-        alpha = enhancer.enhance(1.2)
-        
-        # Step 3: Slight blur to smooth jagged edges
-        alpha = alpha.filter(ImageFilter.GaussianBlur(radius=0.5))
-        
-        # Recombine
-        return Image.merge('RGBA', (r, g, b, alpha))
-    
-    except Exception as e:
-        logger.warning(f"Edge enhancement failed: {e}, returning original")
-        return image
+    chunks = []
+    total = 0
+    header = None
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB"
+            )
+        chunks.append(chunk)
+        if header is None:
+            header = sniff_image_header(b"".join(chunks))
+            if header is None and total >= UPLOAD_SNIFF_BYTES:
+                raise HTTPException(status_code=400, detail="Invalid image file")
+            if header is not None:
+                fmt, (width, height) = header
+                if fmt not in ALLOWED_IMAGE_FORMATS:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
+                    )
+                if width * height > MAX_IMAGE_PIXELS:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Image too large: {width}x{height}. Maximum: {MAX_IMAGE_PIXELS // 1_000_000} megapixels"
+                    )
+    if header is None:
+        # Whole upload was smaller than a chunk and still not identifiable
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    return b"".join(chunks)
 
 
 def _luminance(r: float, g: float, b: float) -> float:
@@ -206,78 +324,6 @@ def _luminance(r: float, g: float, b: float) -> float:
     return 0.2126 * (r / 255) + 0.7152 * (g / 255) + 0.0722 * (b / 255)
 
 
-def extract_dominant_colors(
-    image: Image.Image,
-    n_colors: int = 4,
-    min_saturation: float = 0.2,
-    min_value: float = 0.2
-) -> List[str]:
-    """
-    Extract the single most dominant jersey color from an image using K-Means clustering.
-    
-    Samples only the lower 55% of the image (jersey/torso); filters out transparent pixels,
-    skin tones, and very desaturated grays.
-    
-    Returns a list with one hex color: the cluster that has the most pixels (most dominant).
-    """
-    try:
-        img = image.convert("RGBA")
-        w, h = img.size
-        img = img.resize((150, 150), Image.Resampling.LANCZOS)
-        ar = np.array(img)
-        shape = ar.shape
-        # Sample only lower 55% of image (jersey/torso area); exclude upper 45% (face/head)
-        rows_jersey = int(shape[0] * 0.55)
-        ar_jersey = ar[rows_jersey:, :, :]
-        ar_flat = ar_jersey.reshape(-1, shape[2])
-        
-        mask = ar_flat[:, 3] > 128
-        solid_pixels = ar_flat[mask]
-        
-        if len(solid_pixels) == 0:
-            solid_pixels = ar.reshape(-1, shape[2])[ar.reshape(-1, shape[2])[:, 3] > 128]
-        if len(solid_pixels) == 0:
-            logger.warning("No solid pixels found in image")
-            return ["#000000"]
-        
-        valid_pixels = []
-        for r, g, b, a in solid_pixels:
-            h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
-            if v < min_value:
-                continue
-            if s < 0.12 and v > 0.9:
-                continue
-            # Exclude skin: orange/peach hue (0.04–0.18) unless very saturated (jersey)
-            is_skin_hue = 0.04 <= h <= 0.18
-            if is_skin_hue and s < 0.65:
-                continue
-            # Exclude low saturation (gray/skin)
-            if s >= min_saturation:
-                valid_pixels.append([r, g, b])
-        
-        valid_pixels = np.array(valid_pixels) if valid_pixels else solid_pixels[:, :3]
-        if len(valid_pixels) < 30:
-            valid_pixels = solid_pixels[:, :3]
-        
-        n_clusters = min(8, max(4, len(valid_pixels) // 30))
-        kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=42)
-        labels = kmeans.fit_predict(valid_pixels)
-        colors_rgb = kmeans.cluster_centers_
-
-        # Single most dominant jersey color: cluster with the most pixels
-        unique, counts = np.unique(labels, return_counts=True)
-        dominant_idx = unique[np.argmax(counts)]
-        dominant_rgb = colors_rgb[dominant_idx]
-
-        color_bytes = bytearray(int(round(c)) for c in np.clip(dominant_rgb, 0, 255))
-        hex_color = f"#{binascii.hexlify(color_bytes).decode('ascii')}"
-        return [hex_color]
-    
-    except Exception as e:
-        logger.error(f"Error extracting colors: {e}")
-        return ["#000000"]
-
-
 @app.get("/")
 async def root():
     """Health check endpoint."""
@@ -296,10 +342,148 @@ async def list_models():
             for k, v in AVAILABLE_MODELS.items()
         ],
         "default": "u2net_human_seg",
+        "preloaded": REMBG_PRELOAD_MODELS,
+        **session_registry_status(),
         "note": "All models run locally on your machine - 100% FREE, no API costs!"
     }
 
 
+def _remove_bg_response(result: dict, model: str, edge_refinement: str, cached: bool) -> dict:
+    """/remove-bg response body for a process_upload result."""
+    filename = result["filename"]
+    return {
+        "url": f"http://localhost:8000/static/uploads/{filename}",
+        "uncropped_url": uncropped_url(result),
+        "filename": filename,
+        "original_size": result["original_size"],
+        "processed_size": result["processed_size"],
+        "crop_bbox": result["crop_bbox"],
+        "mask_mode": result.get("mask_mode", "full"),
+        "model_used": model,
+        "edge_refinement": edge_refinement,
+        "postprocess_ms": result.get("postprocess_ms", {}),
+        "output_format": result.get("output_format", "png"),
+        "colors": result.get("colors", []),
+        "cached": cached,
+        "cost": "FREE - runs locally!"
+    }
+
+
+# Progressive /remove-bg jobs: job_id -> {"status": "processing"|"completed"|"failed",
+# "preview": dict, "response": dict|None, "error": str|None, "finished_at": float|None,
+# "done": asyncio.Event, "task": asyncio.Task}. Finished jobs are forgotten after the TTL.
+REMBG_JOBS: dict[str, dict] = {}
+REMBG_JOB_TTL_SECONDS = int(os.getenv("REMBG_JOB_TTL_SECONDS", "900"))
+REMBG_JOB_MAX_WAIT_SECONDS = 30
+
+
+def _prune_rembg_jobs() -> None:
+    cutoff = time.time() - REMBG_JOB_TTL_SECONDS
+    for job_id in [j for j, job in REMBG_JOBS.items() if job["finished_at"] and job["finished_at"] < cutoff]:
+        del REMBG_JOBS[job_id]
+
+
+async def _run_rembg_job(job_id: str, reservation: Reservation, file_content: bytes, source_name: str,
+                         cache_key: str, model: str, do_refine_edges: bool, enhance_for_athletes: bool,
+                         mask_mode: str, output_format: str, edge_refinement: str) -> None:
+    """Full-quality background removal for a progressive job, on its reserved REMBG_POOL place."""
+    job = REMBG_JOBS[job_id]
+    try:
+        result = await reservation.run(
+            process_upload,
+            file_content,
+            UPLOAD_DIR,
+            model,
+            do_refine_edges,
+            enhance_for_athletes,
+            source_name,
+            mask_mode,
+            output_format,
+        )
+        REMBG_RESULT_CACHE.put(cache_key, result)
+        UPLOAD_INDEX.add_result(result)
+        job["response"] = _remove_bg_response(result, model, edge_refinement, False)
+        job["status"] = "completed"
+    except Exception as e:
+        logger.exception(f"Progressive background removal failed for job {job_id}")
+        job["status"] = "failed"
+        job["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        reservation.release()  # no-op once used
+        job["finished_at"] = time.time()
+        job["done"].set()
+        logger.info(f"Progressive job {job_id} {job['status']}")
+
+
+def _rembg_job_body(job_id: str, job: dict) -> dict:
+    preview = job["preview"]
+    body = {
+        "job_id": job_id,
+        "status": job["status"],
+        "status_url": f"http://localhost:8000/remove-bg/jobs/{job_id}",
+        "preview_url": f"http://localhost:8000/static/uploads/{preview['filename']}",
+        "preview_size": preview["preview_size"],
+        "preview_model": preview["model"],
+        "original_size": preview["original_size"],
+        "crop_bbox": preview["crop_bbox"],
+    }
+    if job["status"] == "completed":
+        body["result"] = job["response"]
+    elif job["status"] == "failed":
+        body["error"] = job["error"]
+    return body
+
+
+async def _start_progressive_job(file_content: bytes, source_name: str, cache_key: str, model: str,
+                                 do_refine_edges: bool, enhance_for_athletes: bool, mask_mode: str,
+                                 output_format: str, edge_refinement: str) -> JSONResponse:
+    """
+    Reserve the full-quality run's place, run the quick preview on REMBG_PREVIEW_POOL, then queue
+    the full run and answer 202 with the job id. A busy pool answers 503 before any work starts.
+    """
+    try:
+        reservation = REMBG_POOL.reserve()
+    except PoolFullError:
+        raise HTTPException(
+            status_code=503,
+            detail="Background removal is busy. Please retry in a few seconds.",
+            headers={"Retry-After": "5"},
+        )
+    try:
+        preview = await REMBG_PREVIEW_POOL.run(process_preview, file_content, UPLOAD_DIR)
+        UPLOAD_INDEX.add(preview["filename"])
+    except InvalidImageError:
+        reservation.release()
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    except PoolFullError:
+        reservation.release()
+        raise HTTPException(
+            status_code=503,
+            detail="Background removal is busy. Please retry in a few seconds.",
+            headers={"Retry-After": "5"},
+        )
+    except BaseException:
+        reservation.release()
+        raise
+    _prune_rembg_jobs()
+    job_id = uuid.uuid4().hex
+    job = {
+        "status": "processing",
+        "preview": preview,
+        "response": None,
+        "error": None,
+        "finished_at": None,
+        "done": asyncio.Event(),
+    }
+    REMBG_JOBS[job_id] = job
+    job["task"] = asyncio.create_task(_run_rembg_job(
+        job_id, reservation, file_content, source_name, cache_key, model, do_refine_edges, enhance_for_athletes,
+        mask_mode, output_format, edge_refinement,
+    ))
+    logger.info(f"Progressive job {job_id} for {source_name}: preview {preview['filename']}")
+    return JSONResponse(status_code=202, content=_rembg_job_body(job_id, job))
+
+
 @app.post("/remove-bg")
 async def remove_background(
     file: UploadFile = File(...),
@@ -315,6 +499,20 @@ async def remove_background(
     enhance_for_athletes: bool = Query(
         default=False,
         description="Apply special edge enhancement optimized for dynamic poses/athletes"
+    ),
+    mask_mode: str = Query(
+        default="full",
+        description="Segmentation resolution: full (default), proxy (segment a downscaled copy and upsample the "
+        "mask edge-aware to full resolution), or auto (proxy for large photos). Options: " + ", ".join(MASK_MODES)
+    ),
+    output_format: str = Query(
+        default=REMBG_OUTPUT_FORMAT,
+        description="Encoding of the result files: png or webp (lossless). Options: " + ", ".join(OUTPUT_FORMATS)
+    ),
+    progressive: bool = Query(
+        default=False,
+        description="Return a quick low-resolution preview cutout and a job id right away; "
+        "fetch the full-quality result from GET /remove-bg/jobs/{job_id}"
     )
 ):
     """
@@ -325,6 +523,8 @@ async def remove_background(
     Args:
         file: Image file to process
         model: Which AI model to use (default: u2net_human_seg - best for people)
+        progressive: Respond with a preview (REMBG_PREVIEW_MODEL at REMBG_PREVIEW_MAX_SIDE)
+            and a job id (202); the full result is produced in the background
     
     Returns:
         JSON with URL to processed image and filename
@@ -337,76 +537,59 @@ async def remove_background(
                 detail=f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
             )
         
-        # Read file content
-        file_content = await file.read()
+        if mask_mode not in MASK_MODES:
+            raise HTTPException(status_code=400, detail=f"Invalid mask_mode. Options: {', '.join(MASK_MODES)}")
+        if output_format not in OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Invalid output_format. Options: {', '.join(OUTPUT_FORMATS)}")
         
-        # Validate file size
-        if not validate_file_size(file_content):
-            raise HTTPException(
-                status_code=400,
-                detail=f"File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB"
+        # Read in chunks: stops on size, format or pixel count before loading it all into memory
+        file_content = await read_upload_limited(file)
+        
+        # Same photo + same options already processed: reuse its PNGs, skip inference
+        cache_key = make_cache_key(file_content, model, do_refine_edges, enhance_for_athletes, mask_mode, output_format)
+        result = REMBG_RESULT_CACHE.get(cache_key)
+        cached = result is not None
+        if cached:
+            logger.info(f"Result cache hit for {file.filename}: {result['filename']}")
+        
+        edge_refinement = "athlete_enhanced" if enhance_for_athletes else ("refined" if do_refine_edges else "none")
+        if progressive and not cached:
+            return await _start_progressive_job(
+                file_content, file.filename, cache_key, model, do_refine_edges, enhance_for_athletes,
+                mask_mode, output_format, edge_refinement,
             )
         
-        # Open image
+        # Decode, run the model, refine edges and save PNGs on the worker pool
         try:
-            input_image = Image.open(io.BytesIO(file_content))
-        except Exception as e:
-            logger.error(f"Error opening image: {e}")
+            if not cached:
+                result = await REMBG_POOL.run(
+                    process_upload,
+                    file_content,
+                    UPLOAD_DIR,
+                    model,
+                    do_refine_edges,
+                    enhance_for_athletes,
+                    file.filename,
+                    mask_mode,
+                    output_format,
+                )
+                REMBG_RESULT_CACHE.put(cache_key, result)
+                UPLOAD_INDEX.add_result(result)
+            else:
+                UPLOAD_INDEX.touch(result["filename"])
+        except InvalidImageError:
             raise HTTPException(status_code=400, detail="Invalid image file")
+        except PoolFullError:
+            raise HTTPException(
+                status_code=503,
+                detail="Background removal is busy. Please retry in a few seconds.",
+                headers={"Retry-After": "5"},
+            )
         
-        logger.info(f"Processing image: {file.filename} ({input_image.size}) with model: {model}")
-        
-        # Get or create model session
-        session = get_rembg_session(model)
-        
-        # Remove background using selected model
-        output_image = remove(input_image, session=session)
-        
-        # Bbox of non-transparent content in *original* image coords (before crop)
-        bbox = output_image.getbbox()
-        if bbox:
-            crop_bbox = {"x": bbox[0], "y": bbox[1], "width": bbox[2] - bbox[0], "height": bbox[3] - bbox[1]}
-        else:
-            crop_bbox = {"x": 0, "y": 0, "width": output_image.width, "height": output_image.height}
-        
-        # Apply edge enhancements if requested
-        if enhance_for_athletes:
-            logger.info("Applying athlete edge enhancement...")
-            output_image = enhance_edges_for_athletes(output_image)
-        elif do_refine_edges:
-            logger.info("Applying edge refinement...")
-            output_image = refine_edges(output_image, feather=2, smooth=True)
-        
-        # Save uncropped version (same dimensions as original, transparent bg).
-        # Templates using "included"/"blurredOverlay" player background load this so
-        # alignment with the original image is trivial (identical pixel grids).
-        uncropped_filename = f"{uuid.uuid4()}_uncropped.png"
-        uncropped_filepath = os.path.join(UPLOAD_DIR, uncropped_filename)
-        output_image.save(uncropped_filepath, "PNG")
-
-        # Crop transparent edges to remove empty space (default for "removed" mode)
-        cropped_image = crop_transparent_edges(output_image)
-        
-        logger.info(f"Background removed, cropped size: {cropped_image.size}, uncropped size: {output_image.size}, crop_bbox: {crop_bbox}")
-        
-        # Save cropped version
-        filename = f"{uuid.uuid4()}.png"
-        filepath = os.path.join(UPLOAD_DIR, filename)
-        cropped_image.save(filepath, "PNG")
-        
-        logger.info(f"Saved to: {filepath} (cropped) and {uncropped_filepath} (uncropped)")
-        
-        return {
-            "url": f"http://localhost:8000/static/uploads/{filename}",
-            "uncropped_url": f"http://localhost:8000/static/uploads/{uncropped_filename}",
-            "filename": filename,
-            "original_size": input_image.size,
-            "processed_size": cropped_image.size,
-            "crop_bbox": crop_bbox,
-            "model_used": model,
-            "edge_refinement": "athlete_enhanced" if enhance_for_athletes else ("refined" if do_refine_edges else "none"),
-            "cost": "FREE - runs locally!"
-        }
+        response = _remove_bg_response(result, model, edge_refinement, cached)
+        if progressive:
+            response.update({"job_id": None, "status": "completed"})
+        return response
     
     except HTTPException:
         raise
@@ -419,11 +602,206 @@ async def remove_background(
         raise HTTPException(status_code=500, detail=detail)
 
 
+@app.post("/remove-bg/batch")
+async def remove_background_batch(
+    files: List[UploadFile] = File(...),
+    model: str = Query(
+        default="isnet-general-use",
+        description="Model to use for background removal. Options: " + ", ".join(AVAILABLE_MODELS.keys())
+    ),
+    do_refine_edges: bool = Query(
+        default=True,
+        alias="refine_edges",
+        description="Apply edge refinement for smoother, crisper edges (recommended for athletes)"
+    ),
+    enhance_for_athletes: bool = Query(
+        default=False,
+        description="Apply special edge enhancement optimized for dynamic poses/athletes"
+    ),
+    mask_mode: str = Query(
+        default="full",
+        description="Segmentation resolution: full (default), proxy (segment a downscaled copy and upsample the "
+        "mask edge-aware to full resolution), or auto (proxy for large photos). Options: " + ", ".join(MASK_MODES)
+    ),
+    output_format: str = Query(
+        default=REMBG_OUTPUT_FORMAT,
+        description="Encoding of the result files: png or webp (lossless). Options: " + ", ".join(OUTPUT_FORMATS)
+    )
+):
+    """
+    Remove backgrounds from many images in one request (e.g. a team order's player photos).
+    
+    Uploads are grouped by pixel count into micro-batches of REMBG_MICRO_BATCH images; each
+    micro-batch is one ONNX forward pass on the worker pool. Cached results are returned
+    without inference.
+    
+    Returns:
+        JSON with "results": one entry per file, in upload order, shaped like the /remove-bg
+        response, or {"filename", "error"} for a file that could not be processed.
+    """
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"Too many files. Maximum per batch: {MAX_BATCH_FILES}")
+    if mask_mode not in MASK_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mask_mode. Options: {', '.join(MASK_MODES)}")
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid output_format. Options: {', '.join(OUTPUT_FORMATS)}")
+    edge_refinement = "athlete_enhanced" if enhance_for_athletes else ("refined" if do_refine_edges else "none")
+    results: list = [None] * len(files)
+    pending = []  # (index, content, cache_key, pixel_count)
+    for i, file in enumerate(files):
+        if not validate_file_extension(file.filename or ""):
+            results[i] = {"filename": file.filename, "error": f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"}
+            continue
+        try:
+            file_content = await read_upload_limited(file)
+        except HTTPException as e:
+            results[i] = {"filename": file.filename, "error": e.detail}
+            continue
+        cache_key = make_cache_key(file_content, model, do_refine_edges, enhance_for_athletes, mask_mode, output_format)
+        cached = REMBG_RESULT_CACHE.get(cache_key)
+        if cached is not None:
+            UPLOAD_INDEX.touch(cached["filename"])
+            results[i] = {**cached, "cached": True}
+            continue
+        _, (width, height) = sniff_image_header(file_content)
+        pixels = width * height
+        pending.append((i, file_content, cache_key, pixels))
+
+    # Similar-size images share a micro-batch so decode/post-process memory per job is even
+    pending.sort(key=lambda p: p[3])
+    chunks = [pending[k:k + REMBG_MICRO_BATCH] for k in range(0, len(pending), REMBG_MICRO_BATCH)]
+
+    async def run_chunk(chunk):
+        try:
+            out = await REMBG_POOL.run(
+                process_upload_batch,
+                [p[1] for p in chunk],
+                UPLOAD_DIR,
+                model,
+                do_refine_edges,
+                enhance_for_athletes,
+                [files[p[0]].filename for p in chunk],
+                mask_mode,
+                output_format,
+            )
+        except PoolFullError:
+            out = [{"error": "Background removal is busy. Please retry in a few seconds."}] * len(chunk)
+        except Exception as e:
+            logger.exception("Batch background removal failed")
+            out = [{"error": f"Internal server error: {type(e).__name__}: {e}"}] * len(chunk)
+        for (i, _, cache_key, _), result in zip(chunk, out):
+            if "error" not in result:
+                REMBG_RESULT_CACHE.put(cache_key, result)
+                UPLOAD_INDEX.add_result(result)
+                result = {**result, "cached": False}
+            results[i] = result
+
+    await asyncio.gather(*(run_chunk(c) for c in chunks))
+
+    response = []
+    for file, result in zip(files, results):
+        if "error" in result:
+            response.append({"filename": file.filename, "error": result["error"]})
+            continue
+        response.append({
+            "source_filename": file.filename,
+            "url": f"http://localhost:8000/static/uploads/{result['filename']}",
+            "uncropped_url": uncropped_url(result),
+            "filename": result["filename"],
+            "original_size": result["original_size"],
+            "processed_size": result["processed_size"],
+            "crop_bbox": result["crop_bbox"],
+            "mask_mode": result.get("mask_mode", "full"),
+            "model_used": model,
+            "edge_refinement": edge_refinement,
+            "postprocess_ms": result.get("postprocess_ms", {}),
+            "output_format": result.get("output_format", "png"),
+            "colors": result.get("colors", []),
+            "cached": result["cached"],
+        })
+    return {
+        "results": response,
+        "processed": sum(1 for r in response if "error" not in r),
+        "failed": sum(1 for r in response if "error" in r),
+        "cost": "FREE - runs locally!",
+    }
+
+
+def uncropped_url(result: dict) -> str:
+    """Static URL of the uncropped file, or the on-demand route if it has not been written yet."""
+    name = result["uncropped_filename"]
+    if result.get("uncropped_lazy") and not os.path.isfile(os.path.join(UPLOAD_DIR, name)):
+        return f"http://localhost:8000/remove-bg/uncropped/{name}"
+    return f"http://localhost:8000/static/uploads/{name}"
+
+
+@app.get("/remove-bg/uncropped/{filename}")
+async def get_uncropped(filename: str, request: Request):
+    """
+    Serve an uncropped result, writing it from the cropped file first if it was deferred
+    (REMBG_LAZY_UNCROPPED). Later requests can use /static/uploads/{filename} directly.
+    """
+    try:
+        path = await REMBG_POOL.run(materialize_uncropped, UPLOAD_DIR, filename)
+    except PoolFullError:
+        raise HTTPException(
+            status_code=503,
+            detail="Background removal is busy. Please retry in a few seconds.",
+            headers={"Retry-After": "5"},
+        )
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    if UPLOAD_INDEX.entry(filename) is None:
+        UPLOAD_INDEX.add(filename)
+    else:
+        UPLOAD_INDEX.touch(filename)
+    return await run_in_threadpool(
+        file_response, request.headers, request.method, Path(path), cache_control=IMMUTABLE_CACHE_CONTROL
+    )
+
+
+@app.get("/remove-bg/jobs/{job_id}")
+async def get_remove_background_job(
+    job_id: str,
+    wait: float = Query(
+        default=0,
+        ge=0,
+        le=REMBG_JOB_MAX_WAIT_SECONDS,
+        description="Seconds to hold the request open until the full result is ready (long poll)"
+    ),
+):
+    """
+    Status of a progressive /remove-bg job. Once "completed", "result" holds the same body a
+    non-progressive /remove-bg call returns; "failed" carries "error".
+    """
+    job = REMBG_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    if wait and not job["done"].is_set():
+        try:
+            await asyncio.wait_for(job["done"].wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return _rembg_job_body(job_id, job)
+
+
+@app.get("/remove-bg/stats")
+async def remove_background_stats():
+    """Worker pool occupancy (active jobs, queue depth, wait/run times) and result cache counters."""
+    return {**REMBG_POOL.stats(), "preview_pool": REMBG_PREVIEW_POOL.stats(), "cache": REMBG_RESULT_CACHE.stats()}
+
+
 @app.post("/extract-colors")
-async def extract_colors(filename: str = Form(...)):
+async def extract_colors(
+    filename: str = Form(...),
+    palette: bool = Query(default=False, description="Also return the weighted colour palette"),
+):
     """
     Extract dominant colors from a previously uploaded image.
     
+    Colours computed by /remove-bg are read from the upload's metadata sidecar; other files
+    are opened and clustered once, then recorded there too.
+    
     Args:
         filename: Name of file in uploads directory
     
@@ -437,23 +815,16 @@ async def extract_colors(filename: str = Form(...)):
         if not os.path.exists(filepath) or ".." in filename:
             raise HTTPException(status_code=404, detail="File not found")
         
-        # Open image
-        try:
-            img = Image.open(filepath)
-        except Exception as e:
-            logger.error(f"Error opening file {filepath}: {e}")
-            raise HTTPException(status_code=400, detail="Invalid image file")
-        
-        logger.info(f"Extracting colors from: {filename}")
-        
-        # Extract colors (single most dominant jersey color)
-        colors = extract_dominant_colors(img)
+        record = UPLOAD_METADATA.get(filename)
+        if record is None or not record.get("colors"):
+            record = await _compute_upload_colors(filename, filepath)
         
-        logger.info(f"Extracted colors: {colors}")
-        
-        if not colors:
-            return {"colors": ["#000000"]}
-        return {"colors": colors[:1]}
+        colors = record.get("colors") or ["#000000"]
+        logger.info(f"Colors for {filename}: {colors}")
+        response = {"colors": colors[:1]}
+        if palette:
+            response["palette"] = record.get("palette", [])
+        return response
     
     except HTTPException:
         raise
@@ -462,6 +833,67 @@ async def extract_colors(filename: str = Form(...)):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
+async def _compute_upload_colors(filename: str, filepath: str) -> dict:
+    """
+    Fallback for files without a metadata record (or without a colour histogram): open,
+    cluster, and record the result.
+    """
+    try:
+        img = Image.open(filepath)
+    except Exception as e:
+        logger.error(f"Error opening file {filepath}: {e}")
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    
+    logger.info(f"Extracting colors from: {filename}")
+    try:
+        profile = await asyncio.get_running_loop().run_in_executor(None, color_profile, img)
+    except Exception as e:
+        logger.error(f"Error extracting colors: {e}")
+        return {"colors": ["#000000"], "palette": []}
+    clusters = profile["clusters"]
+    return UPLOAD_METADATA.put(filename, {
+        "colors": [clusters[0]["hex"]] if clusters else ["#000000"],
+        "palette": clusters,
+        "color_engine": COLOR_ENGINE,
+        "color_histogram": profile["histogram"],
+    })
+
+
+@app.get("/palette/{filename}")
+async def get_palette(
+    filename: str,
+    n_colors: int = Query(default=3, ge=1, le=8, description="Number of palette colours"),
+    min_saturation: float = Query(default=0.2, ge=0, le=1, description="Ignore colours less saturated than this"),
+    min_value: float = Query(default=0.2, ge=0, le=1, description="Ignore colours darker than this"),
+    min_distance: float = Query(default=40, ge=0, le=442, description="Minimum RGB distance between palette colours"),
+):
+    """
+    Weighted palette (primary, secondary, accent, ...) of an uploaded image for template theming.
+    
+    Computed from the colour histogram stored with the upload, so variants with different
+    n_colors or thresholds never touch the pixels.
+    """
+    filepath = os.path.join(UPLOAD_DIR, filename)
+    if not os.path.exists(filepath) or ".." in filename:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    record = UPLOAD_METADATA.get(filename)
+    if record is None or "color_histogram" not in record:
+        record = await _compute_upload_colors(filename, filepath)
+    histogram = record.get("color_histogram")
+    if histogram is None:
+        raise HTTPException(status_code=500, detail="Could not extract colours")
+    
+    palette = await asyncio.get_running_loop().run_in_executor(
+        None, palette_from_histogram, histogram, n_colors, min_saturation, min_value, min_distance
+    )
+    return {
+        "filename": filename,
+        "palette": palette,
+        **{p["role"]: p["hex"] for p in palette if p["role"] in PALETTE_ROLES},
+    }
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """Global exception handler for uncaught errors."""
@@ -569,10 +1001,6 @@ async def get_production_spec():
     return PRODUCTION_CONFIG
 
 
-# Cache of generated production output dirs: order_id -> Path (backend/output/{order_id})
-PRODUCTION_OUTPUT_DIRS: dict[str, Path] = {}
-# Background job state: order_id -> {"status": "running"|"completed"|"failed", "error": str|None}
-PRODUCTION_JOBS: dict[str, dict] = {}
 ADMIN_API_KEY = (os.getenv("STAKD_ADMIN_KEY") or "stakd-local-admin-key").strip()
 
 
@@ -589,36 +1017,95 @@ def require_admin_access(
         raise HTTPException(status_code=403, detail="Admin access required")
 
 
-def _list_production_artifacts(out_dir: Path) -> list[dict]:
-    """Return list of { name, url } for PDF and SVG files in out_dir."""
-    files = []
-    if not out_dir.is_dir():
-        return files
-    for f in sorted(out_dir.iterdir()):
-        if f.is_file() and f.suffix.lower() in (".pdf", ".svg"):
-            files.append({
-                "name": f.name,
-                "filename": f.name,
-                "url": f"/api/orders/{out_dir.name}/production/download/{f.name}",
-            })
-    return files
-
-
-def _run_production_sync(order_id: str) -> None:
-    """Run the pipeline in a thread; update PRODUCTION_JOBS and PRODUCTION_OUTPUT_DIRS when done."""
+def _list_production_artifacts(order_id: str) -> list[dict]:
+    """Return list of { name, url, size, sha256 } for the order's registered PDF and SVG files."""
+    return [
+        {
+            "name": a["name"],
+            "filename": a["name"],
+            "url": f"/api/orders/{order_id}/production/download/{a['name']}",
+            "size": a["size"],
+            "sha256": a["sha256"],
+        }
+        for a in PRODUCTION_REGISTRY.list_artifacts(order_id)
+    ]
+
+
+def _run_production_sync(order_id: str, params: Optional[dict] = None) -> None:
+    """Run the pipeline on a scheduler worker; record the job, stage timings and artifacts in PRODUCTION_REGISTRY."""
+    if not PRODUCTION_REGISTRY.claim_job(order_id):
+        logger.info("Production for order %s is running in another worker or was cancelled; skipped", order_id)
+        PRODUCTION_EVENTS.publish(order_id, "state")
+        return
+    control = JobControl(
+        stage_timeout=PRODUCTION_STAGE_TIMEOUT_SECONDS,
+        job_timeout=PRODUCTION_JOB_TIMEOUT_SECONDS,
+        cancel_check=lambda: PRODUCTION_REGISTRY.cancel_requested(order_id),  # DELETE from another worker
+    )
+    PRODUCTION_CONTROLS[order_id] = control
+    PRODUCTION_EVENTS.publish(order_id, "state")
     print(f"[Production] Background job started for order {order_id}", flush=True)
     logger.info("Production generation started for order %s (running in background)", order_id)
+    if (params or {}).get("clean"):
+        out_dir = _production_output_dir(order_id)
+        if out_dir.is_dir():
+            try:
+                shutil.rmtree(out_dir)
+                logger.info("Cleared production output for order %s (full restart)", order_id)
+            except Exception as e:
+                logger.warning("Could not clear output dir for order %s: %s", order_id, e)
+        PRODUCTION_REGISTRY.clear_output(order_id)
+    def on_progress(event: dict) -> None:
+        PRODUCTION_REGISTRY.record_stage(
+            order_id, event["stage"], event["status"],
+            card=event["card"] if event["card"] is not None else -1,
+            started_at=event["started_at"], finished_at=event.get("finished_at"),
+            bytes_written=event.get("bytes_written"), detail={"cards": event["cards"]},
+        )
+        PRODUCTION_EVENTS.publish(order_id, "stage", event)
+
+    stage, started = "pipeline", time.time()
     try:
         from production.process_single_order import process_single_order
-        out_dir = process_single_order(order_id)
-        PRODUCTION_OUTPUT_DIRS[order_id] = out_dir
-        PRODUCTION_JOBS[order_id] = {"status": "completed", "error": None}
+        out_dir = process_single_order(order_id, progress=on_progress, control=control)
+        PRODUCTION_REGISTRY.record_stage(order_id, stage, "completed", started_at=started, finished_at=time.time())
+        stage, started = "artifacts", time.time()
+        precompress_dir(out_dir)  # gzip siblings of the cutline SVGs, served to admin downloads
+        artifacts = PRODUCTION_REGISTRY.record_artifacts(order_id, out_dir)
+        PRODUCTION_REGISTRY.record_stage(
+            order_id, stage, "completed", started_at=started, finished_at=time.time(),
+            detail={"files": len(artifacts), "total_bytes": sum(a["size"] for a in artifacts)},
+        )
+        PRODUCTION_REGISTRY.job_finished(order_id, "completed", output_dir=out_dir)
+        PRODUCTION_EVENTS.publish(order_id, "state")
         print(f"[Production] Completed order {order_id} -> {out_dir}", flush=True)
         logger.info("Production generation completed for order %s -> %s", order_id, out_dir)
+    except (JobCancelled, ProductionTimeout) as e:
+        cancelled = isinstance(e, JobCancelled)
+        print(f"[Production] {'CANCELLED' if cancelled else 'TIMED OUT'} order {order_id}: {e}", flush=True)
+        logger.warning("Production generate stopped for order %s: %s", order_id, e)
+        if isinstance(e, ProductionTimeout):  # the stage may have been running in a terminated worker
+            PRODUCTION_REGISTRY.record_stage(
+                order_id, e.stage, "timeout", card=e.card if e.card is not None else -1,
+                finished_at=time.time(), detail={"error": str(e)},
+            )
+        PRODUCTION_REGISTRY.close_running_stages(order_id, "cancelled" if cancelled else "timeout")
+        PRODUCTION_REGISTRY.record_stage(
+            order_id, stage, "cancelled" if cancelled else "timeout", started_at=started, finished_at=time.time(),
+        )
+        PRODUCTION_REGISTRY.job_finished(order_id, "cancelled" if cancelled else "timed_out", str(e))
+        PRODUCTION_EVENTS.publish(order_id, "state")
     except Exception as e:
         print(f"[Production] FAILED order {order_id}: {e}", flush=True)
         logger.exception("Production generate failed for order %s", order_id)
-        PRODUCTION_JOBS[order_id] = {"status": "failed", "error": str(e)}
+        PRODUCTION_REGISTRY.close_running_stages(order_id, "failed")
+        PRODUCTION_REGISTRY.record_stage(
+            order_id, stage, "failed", started_at=started, finished_at=time.time(), detail={"error": str(e)}
+        )
+        PRODUCTION_REGISTRY.job_finished(order_id, "failed", str(e))
+        PRODUCTION_EVENTS.publish(order_id, "state")
+    finally:
+        PRODUCTION_CONTROLS.pop(order_id, None)
 
 
 def _production_output_dir(order_id: str) -> Path:
@@ -626,18 +1113,71 @@ def _production_output_dir(order_id: str) -> Path:
     return Path(__file__).resolve().parent / "output" / order_id
 
 
+# Jobs, stage timings and artifacts (size + SHA-256) in SQLite next to the outputs, so status and
+# downloads survive restarts and are shared by all uvicorn workers. Rebuilt from output/ at startup.
+PRODUCTION_REGISTRY = ProductionRegistry(
+    Path(__file__).resolve().parent / "output",
+    db_path=os.getenv("PRODUCTION_REGISTRY_DB") or None,
+)
+# Wall-clock budgets per pipeline stage and per job (0 = no limit); running jobs' controls, for DELETE.
+PRODUCTION_STAGE_TIMEOUT_SECONDS = float(os.getenv("PRODUCTION_STAGE_TIMEOUT_SECONDS", "300"))
+PRODUCTION_JOB_TIMEOUT_SECONDS = float(os.getenv("PRODUCTION_JOB_TIMEOUT_SECONDS", "3600"))
+PRODUCTION_CONTROLS: dict[str, JobControl] = {}
+PRODUCTION_FINAL_STATES = ("completed", "failed", "cancelled", "timed_out")
+# States of a job that is still going; /production/events only stays open while in one of these.
+PRODUCTION_ACTIVE_STATES = ("queued", "deferred", "running")
+# Pushes stage progress and state changes from pipeline threads to /production/events streams.
+PRODUCTION_EVENTS = ProductionEventBus()
+PRODUCTION_SSE_KEEPALIVE_SECONDS = float(os.getenv("PRODUCTION_SSE_KEEPALIVE_SECONDS", "15"))
+
+# Fixed production workers with a priority queue (rush first). PRODUCTION_WORKERS pipelines run
+# at once; PRODUCTION_MAX_QUEUE may wait (0 = unbounded), beyond that /generate answers 503.
+# PRODUCTION_MAX_DEFERRED (default: PRODUCTION_MAX_QUEUE) bounds jobs displaced by rush orders.
+PRODUCTION_SCHEDULER = ProductionScheduler(
+    _run_production_sync,
+    workers=int(os.getenv("PRODUCTION_WORKERS", "2")),
+    max_queue=int(os.getenv("PRODUCTION_MAX_QUEUE", "20")),
+    max_deferred=int(os.getenv("PRODUCTION_MAX_DEFERRED")) if os.getenv("PRODUCTION_MAX_DEFERRED") else None,
+)
+
+
+@app.on_event("startup")
+def start_production_scheduler():
+    try:
+        PRODUCTION_REGISTRY.rebuild_from_disk()
+    except Exception as e:
+        logger.warning("Production registry rebuild failed: %s", e)
+    PRODUCTION_SCHEDULER.start()
+
+
+@app.on_event("shutdown")
+def stop_production_scheduler():
+    PRODUCTION_SCHEDULER.shutdown()
+    shutdown_card_pool()
+
+
+@app.get("/api/production/queue")
+async def get_production_queue(_: None = Depends(require_admin_access)):
+    """Running and queued production jobs, in the order they will run, and the shared card pool."""
+    return {**PRODUCTION_SCHEDULER.stats(), "card_pool": get_card_pool().stats()}
+
+
 @app.post("/api/orders/{order_id}/production/generate")
 async def generate_production_files(
     order_id: str,
     clean: bool = Query(False, description="If true, delete existing output folder before generating (full restart)."),
+    priority: str = Query("normal", description="rush | normal | low. Rush orders run before everything queued."),
     _: None = Depends(require_admin_access),
 ):
     """
-    Start production file generation in the background. Returns 202 immediately.
+    Queue production file generation. Returns 202 with the queue position immediately.
     Poll GET /production/status for completion.
-    If clean=1: removes existing output folder first so the run is from scratch.
+    If clean=1: removes existing output folder first (when the job starts) so the run is from scratch.
+    Returns 503 with Retry-After when the production queue is full.
     """
-    if PRODUCTION_JOBS.get(order_id, {}).get("status") == "running":
+    previous = PRODUCTION_SCHEDULER.status(order_id)
+    job = PRODUCTION_REGISTRY.get_job(order_id)
+    if (previous is not None and previous["state"] == "running") or (job is not None and job["status"] == "running"):
         return JSONResponse(
             status_code=200,
             content={
@@ -647,55 +1187,119 @@ async def generate_production_files(
                 "message": "Generation already in progress.",
             },
         )
-    if clean:
-        out_dir = _production_output_dir(order_id)
-        if out_dir.is_dir():
-            try:
-                shutil.rmtree(out_dir)
-                logger.info("Cleared production output for order %s (full restart)", order_id)
-            except Exception as e:
-                logger.warning("Could not clear output dir for order %s: %s", order_id, e)
-        PRODUCTION_OUTPUT_DIRS.pop(order_id, None)
-    PRODUCTION_JOBS[order_id] = {"status": "running", "error": None}
-    thread = threading.Thread(target=_run_production_sync, args=(order_id,), daemon=True)
-    thread.start()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority {priority!r}; expected one of {tuple(PRIORITIES)}")
+    if previous is None:
+        PRODUCTION_REGISTRY.job_queued(order_id, priority)
+    try:
+        queued = PRODUCTION_SCHEDULER.submit(order_id, priority, clean=clean)
+    except QueueFullError:
+        PRODUCTION_REGISTRY.job_finished(order_id, "rejected", "Production queue is full")
+        raise HTTPException(
+            status_code=503,
+            detail="Production queue is full. Please retry shortly.",
+            headers={"Retry-After": "30"},
+        )
+    PRODUCTION_EVENTS.publish(order_id, "state")
+    if previous is not None:
+        message = "Generation already queued." + (" (output will be cleared)" if clean else "")
+    else:
+        message = "Production generation queued. Refresh status or wait a moment for results." + (" (output will be cleared)" if clean else "")
     return JSONResponse(
         status_code=202,
         content={
             "order_id": order_id,
             "job_id": order_id,
-            "status": "queued",
-            "message": "Production generation started. Refresh status or wait a moment for results." + (" (output cleared)" if clean else ""),
+            "status": queued["state"],
+            "priority": queued["priority"],
+            "queue_position": queued.get("queue_position"),
+            "message": message,
         },
     )
 
 
+def _running_status(order_id: str, priority: Optional[str]) -> dict:
+    """Status body for a running job: stage events so far, cards done and a rough ETA."""
+    progress = PRODUCTION_REGISTRY.progress(order_id)
+    if progress["cards_total"]:
+        message = f"Generating: card {min(progress['cards_done'] + 1, progress['cards_total'])} of {progress['cards_total']}"
+        if progress["current_stage"]:
+            message += f" ({progress['current_stage']})"
+        if progress["eta_s"] is not None:
+            message += f", about {int(progress['eta_s'])}s left"
+        message += "…"
+    else:
+        message = "Generation in progress…"
+    return {
+        "order_id": order_id,
+        "status": "running",
+        "priority": priority,
+        "files": [],
+        "progress": progress,
+        "stages": PRODUCTION_REGISTRY.list_stages(order_id),
+        "message": message,
+    }
+
+
 @app.get("/api/orders/{order_id}/production/status")
 async def get_production_status(order_id: str, _: None = Depends(require_admin_access)):
-    """Return status and download links for generated production files."""
-    job = PRODUCTION_JOBS.get(order_id)
-    if job and job.get("status") == "failed":
+    """Return status (with queue position while waiting) and download links for generated production files."""
+    return _production_status(order_id)
+
+
+def _production_status(order_id: str) -> dict:
+    """Status body shared by /production/status and the /production/events stream."""
+    scheduled = PRODUCTION_SCHEDULER.status(order_id)
+    if scheduled is not None and scheduled["state"] in ("queued", "deferred"):
+        position = scheduled.get("queue_position")
         return {
             "order_id": order_id,
-            "status": "failed",
+            "status": scheduled["state"],
+            "priority": scheduled["priority"],
+            "queue_position": position,
+            "queue_length": scheduled.get("queue_length"),
             "files": [],
-            "message": job.get("error") or "Generation failed.",
+            "message": (
+                f"Queued: position {position} of {scheduled['queue_length']}." if position
+                else "Deferred by rush orders; will be queued as soon as there is room."
+            ),
         }
-    out_dir = PRODUCTION_OUTPUT_DIRS.get(order_id)
-    if out_dir is not None and out_dir.is_dir():
-        files = _list_production_artifacts(out_dir)
+    if scheduled is not None:
+        return _running_status(order_id, scheduled["priority"])
+    job = PRODUCTION_REGISTRY.get_job(order_id)
+    if job and job["status"] in ("failed", "cancelled", "timed_out"):
+        stages = PRODUCTION_REGISTRY.list_stages(order_id)
+        timed_out = next((s for s in stages if s["status"] == "timeout" and s["stage"] not in ("pipeline", "card")), None)
         return {
             "order_id": order_id,
-            "status": "completed",
-            "files": files,
-            "message": f"{len(files)} file(s) ready for download.",
+            "status": job["status"],
+            "files": [],
+            "stages": stages,
+            "timed_out_stage": (
+                {"stage": timed_out["stage"], "card": timed_out["card"] if timed_out["card"] >= 0 else None}
+                if timed_out else None
+            ),
+            "message": job.get("error") or "Generation failed.",
         }
-    if job and job.get("status") == "running":
+    if job and job["status"] == "running":  # held by another uvicorn worker
+        return _running_status(order_id, job.get("priority"))
+    if job and job["status"] == "queued":
         return {
             "order_id": order_id,
-            "status": "running",
+            "status": "queued",
+            "priority": job.get("priority"),
             "files": [],
-            "message": "Generation in progress…",
+            "message": "Queued.",
+        }
+    if PRODUCTION_REGISTRY.output_dir(order_id) is not None:
+        files = _list_production_artifacts(order_id)
+        return {
+            "order_id": order_id,
+            "status": "completed",
+            "files": files,
+            "stages": PRODUCTION_REGISTRY.list_stages(order_id),
+            "finished_at": job.get("finished_at"),
+            "message": f"{len(files)} file(s) ready for download.",
         }
     return {
         "order_id": order_id,
@@ -706,11 +1310,93 @@ async def get_production_status(order_id: str, _: None = Depends(require_admin_a
     }
 
 
-@app.get("/api/orders/{order_id}/production/download/{filename:path}")
-async def download_production_file(order_id: str, filename: str, _: None = Depends(require_admin_access)):
-    """Serve a generated PDF or SVG file for download."""
-    out_dir = PRODUCTION_OUTPUT_DIRS.get(order_id)
-    if out_dir is None or not out_dir.is_dir():
+@app.delete("/api/orders/{order_id}/production/job")
+async def cancel_production_job(order_id: str, _: None = Depends(require_admin_access)):
+    """
+    Cancel the order's production job. A queued job is dropped at once (200); a running job stops
+    at its next stage boundary (202, poll status or watch /production/events for "cancelled").
+    """
+    if PRODUCTION_SCHEDULER.cancel(order_id):
+        PRODUCTION_REGISTRY.job_finished(order_id, "cancelled", "Cancelled before it started")
+        PRODUCTION_EVENTS.publish(order_id, "state")
+        return {"order_id": order_id, "status": "cancelled", "message": "Queued job cancelled."}
+    control = PRODUCTION_CONTROLS.get(order_id)
+    if control is not None:
+        control.cancel()
+    status = PRODUCTION_REGISTRY.request_cancel(order_id)  # reaches jobs held by other uvicorn workers
+    if control is None and status not in ("queued", "running"):
+        raise HTTPException(status_code=404, detail="No queued or running production job for this order")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "order_id": order_id,
+            "status": "cancelling",
+            "message": "Cancellation requested; the job stops after its current stage.",
+        },
+    )
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/api/orders/{order_id}/production/events")
+async def stream_production_events(order_id: str, request: Request, _: None = Depends(require_admin_access)):
+    """
+    Server-Sent Events instead of polling /production/status. Sends `status` (the same body as
+    /production/status) now and on every state change, `stage` for each stage event as it
+    happens, and a keepalive comment when idle. The stream ends after any status that is not a
+    running or waiting job: a final one (completed, failed, cancelled, timed_out) or "pending"
+    when there is no job. Close the EventSource then, or it will reconnect and receive that
+    status again.
+    """
+
+    async def stream():
+        # Subscribed here, not in the handler, so it is always released by the finally below;
+        # before the first snapshot, so nothing is missed.
+        sub = PRODUCTION_EVENTS.subscribe(order_id)
+        try:
+            status = await run_in_threadpool(_production_status, order_id)
+            yield _sse("status", status)
+            last = (status["status"], status.get("queue_position"))
+            while last[0] in PRODUCTION_ACTIVE_STATES:
+                item = await sub.get(PRODUCTION_SSE_KEEPALIVE_SECONDS)
+                if await request.is_disconnected():
+                    break
+                if item is not None and item[0] == "stage" and not sub.overflowed:
+                    yield _sse("stage", item[1])
+                    continue
+                # State change, missed events or idle: resync from the scheduler and registry
+                # (also picks up jobs that another uvicorn worker is running).
+                sub.overflowed = False
+                status = await run_in_threadpool(_production_status, order_id)
+                current = (status["status"], status.get("queue_position"))
+                if current == last:
+                    if item is None:
+                        yield ": keepalive\n\n"
+                    continue
+                yield _sse("status", status)
+                last = current
+        finally:
+            PRODUCTION_EVENTS.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.api_route("/api/orders/{order_id}/production/download/{filename:path}", methods=["GET", "HEAD"])
+async def download_production_file(
+    order_id: str, filename: str, request: Request, _: None = Depends(require_admin_access)
+):
+    """
+    Serve a generated PDF or SVG file for download: ETag revalidation (304 until the order is
+    regenerated), byte ranges, and gzip for SVGs when the client accepts it.
+    """
+    out_dir = await run_in_threadpool(PRODUCTION_REGISTRY.output_dir, order_id)
+    if out_dir is None:
         raise HTTPException(status_code=404, detail="No production files for this order")
     out_dir_resolved = out_dir.resolve()
     path = (out_dir / filename).resolve()
@@ -722,18 +1408,40 @@ async def download_production_file(order_id: str, filename: str, _: None = Depen
         raise HTTPException(status_code=404, detail="File not found")
     if not path.is_file() or path.suffix.lower() not in (".pdf", ".svg"):
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(path, filename=rel.name, media_type="application/octet-stream")
+    return await run_in_threadpool(
+        file_response, request.headers, request.method, path,
+        media_type="application/octet-stream", filename=rel.name,
+    )
 
 
 @app.get("/api/orders/{order_id}/production/files")
 async def list_production_files(order_id: str, _: None = Depends(require_admin_access)):
     """List production files with download URLs (same as status when completed)."""
-    out_dir = PRODUCTION_OUTPUT_DIRS.get(order_id)
-    if out_dir is not None and out_dir.is_dir():
-        return {"order_id": order_id, "files": _list_production_artifacts(out_dir)}
+    if PRODUCTION_REGISTRY.output_dir(order_id) is not None:
+        return {"order_id": order_id, "files": _list_production_artifacts(order_id)}
     return {"order_id": order_id, "files": []}
 
 
+@app.get("/api/uploads/index")
+async def get_upload_index(filename: Optional[str] = None, _: None = Depends(require_admin_access)):
+    """Upload index totals and last sweep, or one file's entry (size, times, source hash, referenced)."""
+    if filename is not None:
+        entry = UPLOAD_INDEX.entry(filename)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        return entry
+    return {**UPLOAD_INDEX.stats(), "blob_store": get_blob_store().stats()}
+
+
+@app.post("/api/uploads/sweep")
+async def sweep_uploads(dry_run: bool = Query(True), _: None = Depends(require_admin_access)):
+    """
+    Run the retention sweep now (dry run by default: report what would be deleted).
+    Skipped when order_cards references cannot be loaded.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, run_upload_sweep, dry_run)
+
+
 # Minimal Supabase schema we support: orders (id, status, created_at); order_cards (id, order_id, design_data).
 # order_items is optional; if missing, order_cards are linked by order_id only.
 
@@ -0,0 +1,281 @@
+"""
+One long-lived set of worker processes for the per-card stages, shared by every production job.
+
+Starting a spawn pool per job re-imports the backend (and, under `python main.py`, main.py with
+rembg/onnxruntime) in every worker for every order, and PRODUCTION_WORKERS concurrent jobs each
+sized to the CPU count oversubscribe the machine. Instead at most PRODUCTION_CARD_WORKERS
+processes (default: CPU count) are started on demand and kept for the life of the process.
+
+A job leases an idle worker for each card (at most max_in_flight at a time), so concurrent jobs
+take turns. Each worker runs one card at a time and talks only to the job that leased it, over
+its own pipe: the card's stage events as they happen, then its result. A job that is cancelled,
+runs over its budget or fails terminates only the workers running its own cards (the only way
+to stop a stage stuck in C code); other jobs' cards are not touched, and replacements are
+spawned when a worker is next needed. Re-running a card is safe: its stages invalidate their
+manifest entry before they start, so a half-finished stage is never mistaken for fresh.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import wait as wait_connections
+from typing import Callable, Optional
+
+from .control import JobControl
+
+logger = logging.getLogger(__name__)
+
+# How long a job waits on its workers before checking for cancellation and overruns.
+POLL_SECONDS = 0.25
+# How long a terminated worker gets to exit before it is killed.
+TERMINATE_WAIT_SECONDS = 2.0
+
+# Set in each worker process: the pipe to the parent.
+_worker_conn = None
+
+
+def default_pool_size() -> int:
+    """PRODUCTION_CARD_WORKERS, or the CPU count."""
+    env = os.getenv("PRODUCTION_CARD_WORKERS", "").strip()
+    return max(1, int(env)) if env else (os.cpu_count() or 1)
+
+
+def _send_event(event: dict) -> None:
+    _worker_conn.send(("event", event))
+
+
+def _worker_main(conn) -> None:
+    """Worker loop: run (func, args) tasks until the pipe closes or None arrives."""
+    global _worker_conn
+    _worker_conn = conn
+    logging.basicConfig(level=logging.INFO)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        func, args = task
+        try:
+            message = ("result", True, func(*args, progress=_send_event))
+        except BaseException as e:  # re-raised in the parent
+            message = ("result", False, e)
+        try:
+            conn.send(message)
+        except (EOFError, OSError):
+            return
+        except Exception as e:  # result or exception that does not pickle
+            conn.send(("result", False, RuntimeError(f"Card result could not be returned: {e!r}")))
+
+
+class _Worker:
+    """One spawned worker process and the parent's end of its pipe."""
+
+    def __init__(self, ctx, name: str):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child,), daemon=True, name=name)
+        self.process.start()
+        child.close()
+
+    def terminate(self) -> None:
+        self.process.terminate()
+        self.process.join(TERMINATE_WAIT_SECONDS)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(TERMINATE_WAIT_SECONDS)
+        if self.process.is_alive():
+            self.terminate()
+        else:
+            self.conn.close()
+
+
+class _Job:
+    """Parent-side state of one run(): its progress callback and each card's current leaf stage."""
+
+    def __init__(self, progress: Optional[Callable[[dict], None]]):
+        self.progress = progress
+        self.running: dict = {}
+
+    def deliver(self, event: dict) -> None:
+        if event["card"] is not None and event["stage"] != "card":
+            if event["status"] == "running":
+                self.running[event["card"]] = event
+            else:
+                self.running.pop(event["card"], None)
+        if self.progress is not None:
+            try:
+                self.progress(event)
+            except Exception as e:
+                logger.warning("Progress callback failed for stage %s: %s", event.get("stage"), e)
+
+    def running_stages(self) -> list[dict]:
+        return sorted(self.running.values(), key=lambda e: e["started_at"])
+
+
+class CardPool:
+    """
+    Args:
+        size: Most worker processes shared by all jobs.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._cond = threading.Condition()
+        self._workers: set[_Worker] = set()
+        self._idle: list[_Worker] = []
+        self._spawning = 0
+        self._started = 0
+        self._jobs = 0
+        self._terminated = 0
+
+    def _lease(self, timeout: float) -> Optional[_Worker]:
+        """An idle worker, a new one if below size, or None if none frees up within timeout."""
+        with self._cond:
+            full = lambda: len(self._workers) + self._spawning >= self.size
+            if not self._idle and full() and timeout > 0:
+                self._cond.wait(timeout)
+            if self._idle:
+                return self._idle.pop()
+            if full():
+                return None
+            self._spawning += 1  # holds the slot while the process starts, outside the lock
+            self._started += 1
+            name = f"card-worker-{self._started}"
+        worker = None
+        try:
+            worker = _Worker(self._ctx, name)
+        finally:
+            with self._cond:
+                self._spawning -= 1
+                if worker is not None:
+                    self._workers.add(worker)
+                else:
+                    self._cond.notify()
+        return worker
+
+    def _release(self, worker: _Worker) -> None:
+        with self._cond:
+            if worker in self._workers:
+                self._idle.append(worker)
+                self._cond.notify()
+
+    def _terminate(self, worker: _Worker) -> None:
+        worker.terminate()
+        with self._cond:
+            if worker in self._workers:
+                self._workers.discard(worker)
+                self._terminated += 1
+            self._cond.notify()
+
+    def run(self, func: Callable, tasks: list[tuple], max_in_flight: int,
+            progress: Optional[Callable[[dict], None]] = None, control: Optional[JobControl] = None) -> list:
+        """
+        Call func(*args, progress=...) for every args in tasks in a worker process, at most
+        max_in_flight at a time. Returns results in task order. The first failure (including a
+        cancellation or overrun found by control) is raised after this job's running cards are
+        terminated.
+        """
+        job = _Job(progress)
+        results: list = [None] * len(tasks)
+        todo = list(range(len(tasks)))
+        busy: dict = {}  # worker pipe -> (worker, task index)
+        with self._cond:
+            self._jobs += 1
+        try:
+            while todo or busy:
+                while todo and len(busy) < max_in_flight:
+                    worker = self._lease(0 if busy else POLL_SECONDS)
+                    if worker is None:
+                        break
+                    i = todo.pop(0)
+                    try:
+                        worker.conn.send((func, tasks[i]))
+                    except OSError:  # died while idle
+                        self._terminate(worker)
+                        todo.insert(0, i)
+                        continue
+                    busy[worker.conn] = (worker, i)
+                for conn in wait_connections(list(busy), POLL_SECONDS) if busy else ():
+                    worker, i = busy[conn]
+                    while True:
+                        try:
+                            message = conn.recv()
+                        except (EOFError, OSError):
+                            del busy[conn]
+                            self._terminate(worker)
+                            raise RuntimeError(
+                                f"Card worker exited unexpectedly on card {i + 1} (exit code {worker.process.exitcode})"
+                            )
+                        if message[0] == "event":
+                            job.deliver(message[1])
+                            if conn.poll():
+                                continue
+                            break
+                        del busy[conn]
+                        self._release(worker)
+                        _, ok, value = message
+                        if not ok:
+                            raise value
+                        results[i] = value
+                        break
+                if control is not None:
+                    control.check("card", None, running=job.running_stages())
+        except BaseException as e:
+            if busy:
+                logger.warning(f"Card pool: terminating {len(busy)} worker(s) of this job ({e})")
+            for worker, _ in busy.values():
+                self._terminate(worker)
+            raise
+        finally:
+            with self._cond:
+                self._jobs -= 1
+        return results
+
+    def shutdown(self) -> None:
+        with self._cond:
+            workers, self._workers, self._idle = list(self._workers), set(), []
+            self._cond.notify_all()
+        for worker in workers:
+            worker.stop()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self.size,
+                "workers": len(self._workers),
+                "idle": len(self._idle),
+                "jobs": self._jobs,
+                "terminated": self._terminated,
+            }
+
+
+_card_pool: Optional[CardPool] = None
+_card_pool_lock = threading.Lock()
+
+
+def get_card_pool(size: Optional[int] = None) -> CardPool:
+    """The process-wide pool; size (default default_pool_size()) only applies when it is first created."""
+    global _card_pool
+    with _card_pool_lock:
+        if _card_pool is None:
+            _card_pool = CardPool(size or default_pool_size())
+        return _card_pool
+
+
+def shutdown_card_pool() -> None:
+    global _card_pool
+    with _card_pool_lock:
+        pool, _card_pool = _card_pool, None
+    if pool is not None:
+        pool.shutdown()
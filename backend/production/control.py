@@ -0,0 +1,115 @@
+"""
+Cancellation and wall-clock budgets for a production run.
+
+A JobControl is passed to process_single_order and checked before every stage:
+
+- cancel() (or the cancel_check callback, e.g. a registry flag set by another process) makes
+  the next check raise JobCancelled, so a job stops cleanly between stages.
+- stage_timeout bounds each stage and job_timeout the whole run. A stage that overruns raises
+  ProductionTimeout naming the stage and card. Stages running in a card worker process are
+  interrupted by SIGALRM; the parent also terminates the job's workers if one does not return
+  to Python in time (a hang inside C code). Stages on other threads are checked when they return.
+"""
+
+import threading
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+# Extra time a worker gets after its stage budget before the parent terminates the job's workers.
+WATCHDOG_GRACE_SECONDS = 5.0
+# How often cancel_check (e.g. a database read) is polled at most.
+CANCEL_POLL_SECONDS = 1.0
+
+
+class JobCancelled(RuntimeError):
+    """Raised at the next stage boundary after the job was cancelled."""
+
+    def __init__(self, message: str = "Cancelled by an admin"):
+        super().__init__(message)
+
+
+class ProductionTimeout(RuntimeError):
+    """A stage (scope "stage") or the whole job (scope "job") exceeded its wall-clock budget."""
+
+    def __init__(self, stage: str, card: Optional[int], seconds: float, scope: str = "stage"):
+        self.stage = stage
+        self.card = card
+        self.seconds = seconds
+        self.scope = scope
+        where = f"stage {stage}" + (f" (card {card + 1})" if card is not None else "")
+        budget = "job" if scope == "job" else "stage"
+        super().__init__(f"Timed out in {where}: {budget} budget of {seconds:g}s exceeded")
+
+    def __reduce__(self):  # raised in card worker processes and re-raised in the parent
+        return (ProductionTimeout, (self.stage, self.card, self.seconds, self.scope))
+
+
+class JobControl:
+    """
+    Args:
+        stage_timeout: Seconds any single stage may take; None or 0 for no limit.
+        job_timeout: Seconds the whole run may take, from construction; None or 0 for no limit.
+        cancel_check: Optional callable returning True once the job should stop.
+    """
+
+    def __init__(
+        self,
+        stage_timeout: Optional[float] = None,
+        job_timeout: Optional[float] = None,
+        cancel_check: Optional[Callable[[], bool]] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.stage_timeout = stage_timeout or None
+        self.job_timeout = job_timeout or None
+        self.deadline = deadline or (time.time() + job_timeout if job_timeout else None)
+        self.cancel_check = cancel_check
+        self._cancelled = threading.Event()
+        self._last_poll = 0.0
+
+    @classmethod
+    def from_limits(cls, limits: Tuple[Optional[float], Optional[float], Optional[float]]) -> "JobControl":
+        """Rebuild the budgets in a card worker process (cancellation stays with the parent)."""
+        stage_timeout, job_timeout, deadline = limits
+        return cls(stage_timeout=stage_timeout, job_timeout=job_timeout, deadline=deadline)
+
+    def limits(self) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+        return self.stage_timeout, self.job_timeout, self.deadline
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        if self._cancelled.is_set():
+            return True
+        now = time.time()
+        if self.cancel_check is not None and now - self._last_poll >= CANCEL_POLL_SECONDS:
+            self._last_poll = now
+            if self.cancel_check():
+                self._cancelled.set()
+        return self._cancelled.is_set()
+
+    def stage_budget(self) -> Optional[Tuple[float, str]]:
+        """(seconds, scope) the next stage may run: the stage budget or what is left of the job's."""
+        budgets = []
+        if self.stage_timeout:
+            budgets.append((self.stage_timeout, "stage"))
+        if self.deadline is not None:
+            budgets.append((max(0.001, self.deadline - time.time()), "job"))
+        return min(budgets) if budgets else None
+
+    def check(self, stage: str, card: Optional[int] = None, running: Iterable[dict] = ()) -> None:
+        """
+        Raise JobCancelled or ProductionTimeout if the job must stop. running: stage events
+        ({"stage", "card", "started_at"}) of stages in progress elsewhere, watched for overruns.
+        """
+        if self.is_cancelled():
+            raise JobCancelled()
+        now = time.time()
+        running = list(running)
+        if self.deadline is not None and now > self.deadline:
+            current = running[0] if running else {"stage": stage, "card": card}
+            raise ProductionTimeout(current["stage"], current["card"], self.job_timeout, scope="job")
+        if self.stage_timeout:
+            for event in running:
+                if now - event["started_at"] > self.stage_timeout + WATCHDOG_GRACE_SECONDS:
+                    raise ProductionTimeout(event["stage"], event["card"], self.stage_timeout)
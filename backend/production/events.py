@@ -0,0 +1,80 @@
+"""
+In-process fan-out of production job events to Server-Sent Events streams.
+
+Pipeline threads publish() stage progress and state transitions; each open
+/production/events stream holds a Subscription whose bounded asyncio queue is filled on the
+stream's own event loop (call_soon_threadsafe), so publishing never blocks a worker. A stream
+that falls behind is marked overflowed and resyncs from the registry instead of replaying.
+
+Events only reach streams in the same process; jobs run by another uvicorn worker are picked up
+from the registry when the stream's keepalive fires.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, order_id: str, loop: asyncio.AbstractEventLoop, max_pending: int):
+        self.order_id = order_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.overflowed = False
+
+    def _put(self, item: tuple) -> None:
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout: float) -> Optional[tuple]:
+        """Next (event, data), or None after timeout seconds without one."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ProductionEventBus:
+    """
+    Args:
+        max_pending: Events buffered per stream before it is marked overflowed.
+    """
+
+    def __init__(self, max_pending: int = 256):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subs: Dict[str, Set[Subscription]] = {}
+
+    def subscribe(self, order_id: str) -> Subscription:
+        """Call from the event loop that will read the subscription."""
+        sub = Subscription(order_id, asyncio.get_running_loop(), self.max_pending)
+        with self._lock:
+            self._subs.setdefault(order_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            subs = self._subs.get(sub.order_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[sub.order_id]
+
+    def publish(self, order_id: str, event: str, data: Optional[dict] = None) -> None:
+        """Queue (event, data) on every stream for order_id. Safe from any thread."""
+        with self._lock:
+            subs = list(self._subs.get(order_id, ()))
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub._put, (event, data))
+            except RuntimeError:  # loop closed; the stream is gone
+                self.unsubscribe(sub)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"streams": sum(len(s) for s in self._subs.values()), "orders": len(self._subs)}
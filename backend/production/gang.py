@@ -0,0 +1,259 @@
+"""
+Cross-order sheet ganging: lay out the cards of several orders on shared sheets.
+
+process_single_order builds sheets per order, so a 1-card order still takes a whole 6-up
+background page, a 4-up foreground page and a top-layer cut page. A gang run renders each
+order's cards (incremental, so already-rendered cards are reused from output/<order_id>/card_N/)
+and then fills the sheet slots across orders, in the order given:
+
+  - gang_bg_6up.pdf: backgrounds, 6 cards per page (create_background_sheet).
+  - gang_fg_4up.pdf: player + frame, 2 cards per page (create_foreground_sheet).
+  - gang_top_N.svg / gang_spacer_N.svg: cutlines matching the 4-up pages (spacers cut twice per card).
+  - gang_manifest.json: for every page and slot of every file, the order_id and card index placed
+    there, plus sheet counts against per-order production.
+
+A card with missing layers is left out of every sheet and listed under "skipped" in the manifest.
+Outputs go to temp_assets/gang_output/<run_id>/.
+
+Run from backend: python -m production.gang [order_id ...] [--status accepted] [--workers N] [--full]
+With no order ids, every order with the given status (default 'accepted') is ganged, oldest first.
+"""
+
+import argparse
+import json
+import logging
+import math
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+_backend_dir = Path(__file__).resolve().parent.parent
+if str(_backend_dir) not in sys.path:
+    sys.path.insert(0, str(_backend_dir))
+
+from asset_fetcher import get_supabase_client
+
+from .card_pool import get_card_pool, shutdown_card_pool
+from .control import JobControl
+from .pdf_builder import (
+    build_spacers_cutlines_svg,
+    build_top_layers_cutlines_svg,
+    create_background_sheet,
+    create_foreground_sheet,
+)
+from .process_single_order import (
+    BG6UP_SLOTS,
+    FG4UP_SLOTS,
+    ProgressCallback,
+    _stage,
+    render_order_cards,
+)
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = _backend_dir
+GANG_OUTPUT_DIR = BACKEND_DIR / "temp_assets" / "gang_output"
+GANG_MANIFEST_NAME = "gang_manifest.json"
+GANG_MANIFEST_VERSION = 1
+# Cards per 4-up page: left column player (merged cut), right column frame.
+CARDS_PER_FG_PAGE = FG4UP_SLOTS // 2
+# Each card's spacer set is cut twice, so one card per spacer page.
+SPACER_COPIES = 2
+
+
+def queued_order_ids(client, status: str = "accepted") -> list[str]:
+    """Ids of orders with the given status, oldest first."""
+    res = client.table("orders").select("id").eq("status", status).order("created_at").execute()
+    return [r["id"] for r in (res.data or [])]
+
+
+def _card_layers(card_dir: Path) -> Optional[dict]:
+    """Paths of the layers and cut files a card contributes, or None if any is missing."""
+    frame = card_dir / "print_layer_3_frame_text.png"
+    if not frame.is_file():  # as in process_single_order: prefer frame + text on the 4-up
+        frame = card_dir / "print_layer_3_frame.png"
+    layers = {
+        "background": card_dir / "print_layer_1_bg.png",
+        "player": card_dir / "print_layer_2_hero.png",
+        "frame": frame,
+        "hero_frame_cut": card_dir / "hero_frame_cut.svg",
+        "frame_cut": card_dir / "frame_cut.svg",
+        "hero_frame_spacer": card_dir / "hero_frame_spacer.svg",
+        "frame_spacer": card_dir / "frame_spacer.svg",
+    }
+    missing = [name for name, path in layers.items() if not path.is_file()]
+    if missing:
+        logger.warning("Card %s left out of the gang run: missing %s", card_dir, ", ".join(missing))
+        return None
+    return layers
+
+
+def _slots(cards: list[dict], per_page: int, parts: tuple, copies: int = 1) -> list[dict]:
+    """Slot entries (page, slot, order_id, card, part) for cards laid out row-major, per_page slots a page."""
+    entries = []
+    n = 0
+    for card in cards:
+        for _ in range(copies):
+            for part in parts:
+                entries.append({
+                    "page": n // per_page,
+                    "slot": n % per_page,
+                    "order_id": card["order_id"],
+                    "card": card["card"],
+                    "part": part,
+                })
+                n += 1
+    return entries
+
+
+def _sheet(file: str, kind: str, slots: list[dict], per_page: int) -> dict:
+    return {
+        "file": file,
+        "kind": kind,
+        "pages": max((s["page"] for s in slots), default=-1) + 1,
+        "slots_per_page": per_page,
+        "slots": slots,
+    }
+
+
+def _paged(slots: list[dict], page: int) -> list[dict]:
+    """Slots of one page, renumbered as page 0 of its own file (the cutline SVGs are one page each)."""
+    return [dict(s, page=0) for s in slots if s["page"] == page]
+
+
+def gang_orders(
+    order_ids: list[str],
+    run_dir: Optional[Path] = None,
+    progress: Optional[ProgressCallback] = None,
+    workers: Optional[int] = None,
+    incremental: bool = True,
+    control: Optional[JobControl] = None,
+) -> dict:
+    """
+    Render the cards of order_ids and build shared sheets in run_dir (default GANG_OUTPUT_DIR/<run_id>).
+    Returns the slot manifest (also written to run_dir/gang_manifest.json).
+    Other arguments as for process_single_order; progress also gets the gang sheet stages.
+    """
+    order_ids = list(dict.fromkeys(order_ids))
+    if not order_ids:
+        raise ValueError("No orders to gang")
+    run_id = time.strftime("gang_%Y%m%d_%H%M%S")
+    run_dir = Path(run_dir) if run_dir is not None else GANG_OUTPUT_DIR / run_id
+    run_dir.mkdir(parents=True, exist_ok=True)
+
+    cards = []
+    skipped = []
+    orders = []
+    for order_id in order_ids:
+        card_dirs = render_order_cards(order_id, progress, workers, incremental, control)
+        placed = 0
+        for i, card_dir in enumerate(card_dirs):
+            layers = _card_layers(card_dir)
+            if layers is None:
+                skipped.append({"order_id": order_id, "card": i})
+                continue
+            cards.append({"order_id": order_id, "card": i, **layers})
+            placed += 1
+        orders.append({"order_id": order_id, "cards": len(card_dirs), "placed": placed})
+    if not cards:
+        raise FileNotFoundError("No rendered cards to gang")
+    n_cards = len(cards)
+    print(f"[Production] Gang run {run_id}: {n_cards} card(s) from {len(orders)} order(s)", flush=True)
+
+    sheets = []
+    bg_slots = _slots(cards, BG6UP_SLOTS, ("background",))
+    with _stage(progress, "background_pdf", n_cards, run_dir, control=control):
+        create_background_sheet([c["background"] for c in cards], run_dir / "gang_bg_6up.pdf")
+    sheets.append(_sheet("gang_bg_6up.pdf", "background", bg_slots, BG6UP_SLOTS))
+
+    fg_slots = _slots(cards, FG4UP_SLOTS, ("player", "frame"))
+    with _stage(progress, "foreground_pdf", n_cards, run_dir, control=control):
+        create_foreground_sheet([c[part] for c in cards for part in ("player", "frame")], run_dir / "gang_fg_4up.pdf")
+    sheets.append(_sheet("gang_fg_4up.pdf", "foreground", fg_slots, FG4UP_SLOTS))
+
+    # Cutlines: one SVG per 4-up page, slots as on the foreground sheet.
+    top_slots = _slots(cards, FG4UP_SLOTS, ("hero_frame_cut", "frame_cut"))
+    num_top_pages = math.ceil(n_cards / CARDS_PER_FG_PAGE)
+    with _stage(progress, "top_svg", n_cards, run_dir, control=control):
+        for p in range(num_top_pages):
+            page_cards = cards[p * CARDS_PER_FG_PAGE : (p + 1) * CARDS_PER_FG_PAGE]
+            name = f"gang_top_{p + 1}.svg"
+            build_top_layers_cutlines_svg(
+                [c["hero_frame_cut"] for c in page_cards], [c["frame_cut"] for c in page_cards], run_dir / name
+            )
+            sheets.append(_sheet(name, "top", _paged(top_slots, p), FG4UP_SLOTS))
+
+    spacer_cards = [c for c in cards for _ in range(SPACER_COPIES)]
+    spacer_slots = _slots(cards, FG4UP_SLOTS, ("hero_frame_spacer", "frame_spacer"), copies=SPACER_COPIES)
+    num_spacer_pages = math.ceil(len(spacer_cards) / CARDS_PER_FG_PAGE)
+    with _stage(progress, "spacer_svg", n_cards, run_dir, control=control):
+        for p in range(num_spacer_pages):
+            page_cards = spacer_cards[p * CARDS_PER_FG_PAGE : (p + 1) * CARDS_PER_FG_PAGE]
+            name = f"gang_spacer_{p + 1}.svg"
+            build_spacers_cutlines_svg(
+                [c["hero_frame_spacer"] for c in page_cards], [c["frame_spacer"] for c in page_cards], run_dir / name
+            )
+            sheets.append(_sheet(name, "spacer", _paged(spacer_slots, p), FG4UP_SLOTS))
+
+    # What the same cards cost when each order is laid out on its own sheets.
+    per_order = [o["placed"] for o in orders if o["placed"]]
+    summary = {
+        "cards": n_cards,
+        "background_pages": math.ceil(n_cards / BG6UP_SLOTS),
+        "foreground_pages": num_top_pages,
+        "background_pages_per_order": sum(math.ceil(n / BG6UP_SLOTS) for n in per_order),
+        "foreground_pages_per_order": sum(math.ceil(n / CARDS_PER_FG_PAGE) for n in per_order),
+        "empty_background_slots": math.ceil(n_cards / BG6UP_SLOTS) * BG6UP_SLOTS - n_cards,
+        "empty_foreground_slots": num_top_pages * FG4UP_SLOTS - 2 * n_cards,
+    }
+    manifest = {
+        "version": GANG_MANIFEST_VERSION,
+        "run_id": run_id,
+        "created_at": time.time(),
+        "output_dir": str(run_dir),
+        "orders": orders,
+        "skipped": skipped,
+        "summary": summary,
+        "sheets": sheets,
+    }
+    (run_dir / GANG_MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+    logger.info(
+        "Gang run %s: %d card(s) on %d background / %d foreground page(s) (per order: %d / %d)",
+        run_id, n_cards, summary["background_pages"], summary["foreground_pages"],
+        summary["background_pages_per_order"], summary["foreground_pages_per_order"],
+    )
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gang the cards of several orders onto shared print sheets and cutlines.")
+    parser.add_argument("order_ids", nargs="*", help="Order UUIDs, in slot order (default: orders with --status)")
+    parser.add_argument("--status", default="accepted", help="Order status to gang when no ids are given (default: accepted)")
+    parser.add_argument("-o", "--output", type=Path, default=None, help="Output directory (default temp_assets/gang_output/<run_id>)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Card pool processes (default PRODUCTION_CARD_WORKERS or CPU count)")
+    parser.add_argument("--full", action="store_true", help="Rerun every per-card stage, ignoring the card manifests")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose logging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    order_ids = args.order_ids or queued_order_ids(get_supabase_client(), args.status)
+    if not order_ids:
+        print(f"No orders with status={args.status!r}. Nothing to do.")
+        return
+    get_card_pool(args.workers)  # size the pool for this run
+    try:
+        manifest = gang_orders(order_ids, run_dir=args.output, workers=args.workers, incremental=not args.full)
+    finally:
+        shutdown_card_pool()
+    summary = manifest["summary"]
+    print("--- Gang report ---")
+    print("Orders: %d" % len(manifest["orders"]))
+    print("Cards placed: %d (skipped: %d)" % (summary["cards"], len(manifest["skipped"])))
+    print("Background pages: %d (per order: %d)" % (summary["background_pages"], summary["background_pages_per_order"]))
+    print("Foreground pages: %d (per order: %d)" % (summary["foreground_pages"], summary["foreground_pages_per_order"]))
+    print("Output directory: %s" % manifest["output_dir"])
+
+
+if __name__ == "__main__":
+    main()
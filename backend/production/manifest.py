@@ -0,0 +1,100 @@
+"""
+Per-card input manifests for incremental regeneration.
+
+Each card_N/ directory keeps .manifest.json: for every stage (fetch, render, cut) the
+fingerprint of its inputs and the size of each output it wrote. A stage whose inputs hash
+the same and whose outputs are all still on disk is skipped on the next run.
+
+Fingerprints cover everything a stage reads: the design JSON (snapshot data URLs included),
+the bytes of the files it consumes, and the source of the stage module and config.py, so
+changing a constant such as DPI or SPACER_INSET_MM (or the code) invalidates the stage.
+Outputs are fingerprinted by content downstream, so a re-fetch that yields identical files
+still lets render and cut be skipped.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".manifest.json"
+# Bump to invalidate every manifest (e.g. when a stage starts reading a new kind of input).
+MANIFEST_VERSION = 1
+_HASH_CHUNK = 1024 * 1024
+
+
+def fingerprint(*parts) -> str:
+    """SHA-256 over parts: Paths hash as name + file bytes (or missing), anything else as canonical JSON."""
+    h = hashlib.sha256(f"v{MANIFEST_VERSION}".encode())
+    for part in parts:
+        if isinstance(part, Path):
+            h.update(b"file:" + part.name.encode())
+            try:
+                with open(part, "rb") as f:
+                    for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+                        h.update(chunk)
+            except FileNotFoundError:
+                h.update(b"<missing>")
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def stage_files(directory: Path, patterns: Iterable[str]) -> List[Path]:
+    """Files in directory matching any of the glob patterns, sorted, dot-files excluded."""
+    found = set()
+    for pattern in patterns:
+        found.update(p for p in directory.glob(pattern) if p.is_file() and not p.name.startswith("."))
+    return sorted(found)
+
+
+class CardManifest:
+    """Loads and updates card_dir/.manifest.json; a missing or unreadable manifest is treated as empty."""
+
+    def __init__(self, card_dir: Path):
+        self.card_dir = Path(card_dir)
+        self.path = self.card_dir / MANIFEST_NAME
+        try:
+            data = json.loads(self.path.read_text())
+            self.stages = data.get("stages", {}) if data.get("version") == MANIFEST_VERSION else {}
+        except (OSError, ValueError):
+            self.stages = {}
+
+    def is_fresh(self, stage: str, inputs: str) -> bool:
+        """True if stage last ran on these inputs and all its outputs are still present, unchanged in size."""
+        entry = self.stages.get(stage)
+        if not entry or entry.get("inputs") != inputs:
+            return False
+        for name, size in entry.get("outputs", {}).items():
+            try:
+                if (self.card_dir / name).stat().st_size != size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def invalidate(self, stage: str) -> None:
+        """Forget stage before re-running it, so an interrupted run is never mistaken for fresh."""
+        if self.stages.pop(stage, None) is not None:
+            self._save()
+
+    def record(self, stage: str, inputs: str, outputs: Iterable[Path], elapsed_ms: Optional[float] = None) -> None:
+        self.stages[stage] = {
+            "inputs": inputs,
+            "outputs": {p.name: p.stat().st_size for p in outputs},
+            "elapsed_ms": elapsed_ms,
+        }
+        self._save()
+
+    def _save(self) -> None:
+        tmp = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps({"version": MANIFEST_VERSION, "stages": self.stages}, indent=2, sort_keys=True))
+        os.replace(tmp, self.path)
@@ -13,13 +13,41 @@ Actions:
 
 Output: output/{order_id}/
 
-Run from backend: python -m production.process_single_order <order_id>
+Progress: pass progress=callable to receive one event dict when each stage starts and ends
+(a "card" stage per card wrapping its fetch/render/cut, then the sheet stages): {"stage", "status", "card", "cards",
+"started_at", "finished_at", "elapsed_ms", "bytes_written"}.
+
+Parallel cards: cards are independent until sheet assembly, so with workers > 1 (default: the
+pool size) each card's fetch/render/cut runs on the process-wide card pool (card_pool.py, at
+most PRODUCTION_CARD_WORKERS processes shared by all jobs; spawned, not forked: the API process
+has threads and onnxruntime state). Results are gathered in card order; stage events from the
+workers are relayed to progress as they happen.
+
+Incremental: each card_N/ keeps a manifest of the inputs each stage ran on (manifest.py); a
+stage whose inputs (design JSON, fetched/rendered file bytes, stage code and config.py) are
+unchanged and whose outputs are intact is skipped and reported with status "skipped". A fetch
+where a download failed (and a placeholder stands in) is not recorded, so the next run retries it.
+
+Cancellation and budgets: pass control=JobControl(...) (control.py). It is checked before each
+stage; a cancelled job raises JobCancelled, a stage or job over budget raises ProductionTimeout
+naming the stage (reported with status "cancelled" / "timeout"). When a stage budget is set and
+this is not the main thread, the per-card stages of an order with several cards always run in
+worker processes, where a hung stage can actually be interrupted; stopping a job terminates only
+the workers running its own cards. A 1-card order runs in-process and its stages are checked
+when they return.
+
+Run from backend: python -m production.process_single_order <order_id> [--workers N] [--full]
 """
 
 import argparse
 import logging
+import signal
 import sys
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable, Iterator, Optional, Tuple
 
 _backend_dir = Path(__file__).resolve().parent.parent
 if str(_backend_dir) not in sys.path:
@@ -27,7 +55,10 @@ if str(_backend_dir) not in sys.path:
 
 from asset_fetcher import fetch_assets_from_design, get_supabase_client
 
+from .card_pool import get_card_pool, shutdown_card_pool
+from .control import JobCancelled, JobControl, ProductionTimeout
 from .cut_paths import run_for_dir as cut_paths_run_for_dir
+from .manifest import CardManifest, fingerprint, stage_files
 from .pdf_builder import (
     build_top_layers_cutlines_svg,
     build_spacers_cutlines_svg,
@@ -42,6 +73,119 @@ BACKEND_DIR = _backend_dir
 OUTPUT_BASE = BACKEND_DIR / "output"
 BG6UP_SLOTS = 6
 FG4UP_SLOTS = 4
+CARD_STAGES = ("card", "fetch", "render", "cut")
+SHEET_STAGES = ("background_pdf", "foreground_pdf", "top_svg", "spacer_svg")
+
+ProgressCallback = Callable[[dict], None]
+
+# Files each per-card stage writes (recorded in the card manifest) and code it depends on.
+FETCH_OUTPUTS = (
+    "background_snapshot.png", "player_snapshot.png", "frame_snapshot.png", "text_snapshot.png",
+    "hero.png", "frame.png", "background.jpg",
+)
+RENDER_OUTPUTS = ("print_*.png",)
+CUT_INPUTS = ("print_layer_2_hero.png", "print_layer_3_frame.png")
+CUT_OUTPUTS = ("*.svg",)
+_PRODUCTION_DIR = Path(__file__).resolve().parent
+_CONFIG_SOURCE = _PRODUCTION_DIR / "config.py"
+_FETCH_SOURCE = _backend_dir / "asset_fetcher.py"
+_RENDER_SOURCE = _PRODUCTION_DIR / "render.py"
+_CUT_SOURCE = _PRODUCTION_DIR / "cut_paths.py"
+
+
+def _bytes_written_since(directory: Path, since_ns: int, recursive: bool = False) -> int:
+    """Total size of files in directory modified at or after since_ns."""
+    files = directory.rglob("*") if recursive else directory.iterdir()
+    total = 0
+    for f in files:
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        if f.is_file() and st.st_mtime_ns >= since_ns:
+            total += st.st_size
+    return total
+
+
+@contextmanager
+def _stage(
+    progress: Optional[ProgressCallback],
+    stage: str,
+    cards: int,
+    directory: Path,
+    card: Optional[int] = None,
+    control: Optional[JobControl] = None,
+    timed: bool = True,
+) -> Iterator[dict]:
+    """
+    Time one stage and report it to progress (started, then completed/failed with bytes written).
+    Yields a dict; set its "status" to "skipped" when the stage had nothing to do.
+    With control: checks for cancellation first and enforces the stage budget (timed stages only).
+    """
+    if control is not None:
+        control.check(stage, card)
+    budget = control.stage_budget() if control is not None and timed else None
+    started, started_ns = time.time(), time.time_ns()
+    base = {"stage": stage, "card": card, "cards": cards, "started_at": started}
+
+    def emit(**event) -> None:
+        if progress is None:
+            return
+        try:
+            progress({**base, **event})
+        except Exception as e:  # progress reporting never fails the job
+            logger.warning("Progress callback failed for stage %s: %s", stage, e)
+
+    emit(status="running")
+    status = "failed"
+    outcome: dict = {}
+    alarm = budget is not None and _start_alarm(control, budget, stage, card)
+    try:
+        yield outcome
+        if budget is not None and time.time() - started > budget[0]:  # no alarm on this thread
+            raise ProductionTimeout(stage, card, _budget_seconds(control, budget), budget[1])
+        status = outcome.get("status", "completed")
+    except ProductionTimeout:
+        status = "timeout"
+        raise
+    except JobCancelled:
+        status = "cancelled"
+        raise
+    finally:
+        if alarm:
+            _stop_alarm()
+        finished = time.time()
+        emit(
+            status=status,
+            finished_at=finished,
+            elapsed_ms=round((finished - started) * 1000, 1),
+            bytes_written=_bytes_written_since(directory, started_ns, recursive=card is not None),
+        )
+        logger.info("Stage %s%s %s in %.2fs", stage, f" (card {card + 1}/{cards})" if card is not None else "",
+                    status, finished - started)
+
+
+def _budget_seconds(control: JobControl, budget: Tuple[float, str]) -> float:
+    """The configured budget to report: the stage timeout, or the job timeout."""
+    return control.stage_timeout if budget[1] == "stage" else control.job_timeout
+
+
+def _start_alarm(control: JobControl, budget: Tuple[float, str], stage: str, card: Optional[int]) -> bool:
+    """Interrupt the stage with ProductionTimeout after budget seconds (main thread only, via SIGALRM)."""
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, "setitimer"):
+        return False
+
+    def on_alarm(signum, frame):
+        raise ProductionTimeout(stage, card, _budget_seconds(control, budget), budget[1])
+
+    signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, budget[0])
+    return True
+
+
+def _stop_alarm() -> None:
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
 
 
 def _short_order_id(order_id: str, length: int = 8) -> str:
@@ -75,9 +219,107 @@ def _order_exists(client, order_id: str) -> bool:
         return False
 
 
-def process_single_order(order_id: str) -> Path:
+def _run_card_stage(
+    manifest: CardManifest,
+    card_dir: Path,
+    progress: Optional[ProgressCallback],
+    stage: str,
+    i: int,
+    n_cards: int,
+    inputs: Callable[[], str],
+    run: Callable[[], object],
+    outputs: tuple,
+    force: bool = False,
+    control: Optional[JobControl] = None,
+) -> None:
     """
-    Fetch, render, cut, and build PDFs/SVG for the order. Returns output directory.
+    Run one per-card stage unless the manifest shows it already ran on the same inputs (or force).
+    If run returns a non-empty list (inputs it could not get), the stage is not recorded, so the
+    next run repeats it.
+    """
+    with _stage(progress, stage, n_cards, card_dir, card=i, control=control) as outcome:
+        key = inputs()
+        if not force and manifest.is_fresh(stage, key):
+            outcome["status"] = "skipped"
+            return
+        manifest.invalidate(stage)
+        started = time.time()
+        missing = run()
+        if isinstance(missing, list) and missing:
+            logger.warning("Card %d: stage %s incomplete (%s); it will run again next time", i, stage, ", ".join(missing))
+            return
+        manifest.record(stage, key, stage_files(card_dir, outputs), elapsed_ms=round((time.time() - started) * 1000, 1))
+
+
+def _fetch_card_assets(design: dict, card_dir: Path) -> list[str]:
+    """Fetch stage: returns the files whose download failed (a placeholder or fallback stands in)."""
+    failures: list[str] = []
+    fetch_assets_from_design(design, card_dir, failures=failures)
+    return failures
+
+
+def _process_card(order_id: str, i: int, n_cards: int, design: dict, card_dir: Path,
+                  progress: Optional[ProgressCallback] = None, incremental: bool = True,
+                  control: Optional[JobControl] = None) -> Path:
+    """
+    Fetch assets, render layers and trace cut paths for one card into card_dir.
+    With incremental, stages whose inputs match the card manifest are skipped; either way the
+    manifest is updated for the next run.
+    """
+    # Log what snapshot data is available in the design
+    bg_snap = bool(design.get("background_snapshot_data_url"))
+    pl_snap = bool(design.get("player_snapshot_data_url"))
+    fr_snap = bool(design.get("frame_snapshot_data_url"))
+    logger.info(
+        "Order %s: card %d design_data keys: %s | snapshots: bg=%s player=%s frame=%s",
+        order_id, i, list(design.keys()), bg_snap, pl_snap, fr_snap,
+    )
+    card_dir.mkdir(parents=True, exist_ok=True)
+    manifest = CardManifest(card_dir)
+    with _stage(progress, "card", n_cards, card_dir, card=i, control=control, timed=False):
+        logger.info("Order %s: card %d - fetching assets", order_id, i)
+        _run_card_stage(
+            manifest, card_dir, progress, "fetch", i, n_cards,
+            inputs=lambda: fingerprint(design, _FETCH_SOURCE),
+            run=lambda: _fetch_card_assets(design, card_dir),
+            outputs=FETCH_OUTPUTS,
+            force=not incremental,
+            control=control,
+        )
+        logger.info("Order %s: card %d - rendering layers (background tint+text, hero, frame, foreground)", order_id, i)
+        _run_card_stage(
+            manifest, card_dir, progress, "render", i, n_cards,
+            inputs=lambda: fingerprint(design, *(card_dir / n for n in FETCH_OUTPUTS), _RENDER_SOURCE, _CONFIG_SOURCE),
+            run=lambda: render_run_three_layer_for_dir(card_dir, design=design),
+            outputs=RENDER_OUTPUTS,
+            force=not incremental,
+            control=control,
+        )
+        logger.info("Order %s: card %d - cut paths", order_id, i)
+        _run_card_stage(
+            manifest, card_dir, progress, "cut", i, n_cards,
+            inputs=lambda: fingerprint(*(card_dir / n for n in CUT_INPUTS), _CUT_SOURCE, _CONFIG_SOURCE),
+            run=lambda: cut_paths_run_for_dir(card_dir),
+            outputs=CUT_OUTPUTS,
+            force=not incremental,
+            control=control,
+        )
+    return card_dir
+
+
+def _process_card_in_worker(order_id: str, i: int, n_cards: int, design: dict, card_dir: Path,
+                            incremental: bool, limits: Optional[tuple], progress: ProgressCallback) -> Path:
+    control = JobControl.from_limits(limits) if limits else None
+    return _process_card(order_id, i, n_cards, design, card_dir, progress=progress,
+                         incremental=incremental, control=control)
+
+
+def render_order_cards(order_id: str, progress: Optional[ProgressCallback] = None,
+                       workers: Optional[int] = None, incremental: bool = True,
+                       control: Optional[JobControl] = None) -> list[Path]:
+    """
+    Fetch, render and cut every card of the order (no sheets). Returns the card_N directories in card order.
+    Arguments as for process_single_order.
     """
     client = get_supabase_client()
     cards = get_order_cards(client, order_id)
@@ -98,26 +340,46 @@ def process_single_order(order_id: str) -> Path:
     out_dir = OUTPUT_BASE / order_id
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    card_dirs = []
-    for i, oc in enumerate(cards):
-        design = oc.get("design_data") or oc.get("design_snapshot") or {}
-        # Log what snapshot data is available in the design
-        bg_snap = bool(design.get("background_snapshot_data_url"))
-        pl_snap = bool(design.get("player_snapshot_data_url"))
-        fr_snap = bool(design.get("frame_snapshot_data_url"))
-        logger.info(
-            "Order %s: card %d design_data keys: %s | snapshots: bg=%s player=%s frame=%s",
-            order_id, i, list(design.keys()), bg_snap, pl_snap, fr_snap,
-        )
-        card_dir = out_dir / f"card_{i}"
-        card_dir.mkdir(parents=True, exist_ok=True)
-        logger.info("Order %s: card %d - fetching assets", order_id, i)
-        fetch_assets_from_design(design, card_dir)
-        logger.info("Order %s: card %d - rendering layers (background tint+text, hero, frame, foreground)", order_id, i)
-        render_run_three_layer_for_dir(card_dir, design=design)
-        logger.info("Order %s: card %d - cut paths", order_id, i)
-        cut_paths_run_for_dir(card_dir)
-        card_dirs.append(card_dir)
+    n_cards = len(cards)
+    designs = [oc.get("design_data") or oc.get("design_snapshot") or {} for oc in cards]
+    card_dirs = [out_dir / f"card_{i}" for i in range(n_cards)]
+    pool = get_card_pool()
+    workers = min(workers or pool.size, n_cards)
+    # A hung stage can only be interrupted in a worker process (SIGALRM needs the main thread).
+    # A single card is not worth the round trip: it runs here and, like the sheet stages, its
+    # stages are checked against the budget when they return.
+    isolate = (
+        n_cards > 1 and control is not None and control.stage_timeout is not None
+        and threading.current_thread() is not threading.main_thread()
+    )
+    if workers > 1 or isolate:
+        logger.info("Order %s: processing cards on the card pool (%d at a time)", order_id, workers)
+        limits = control.limits() if control is not None else None
+        tasks = [
+            (order_id, i, n_cards, design, card_dir, incremental, limits)
+            for i, (design, card_dir) in enumerate(zip(designs, card_dirs))
+        ]
+        pool.run(_process_card_in_worker, tasks, workers, progress=progress, control=control)
+    else:
+        for i, (design, card_dir) in enumerate(zip(designs, card_dirs)):
+            _process_card(order_id, i, n_cards, design, card_dir, progress, incremental, control)
+    return card_dirs
+
+
+def process_single_order(order_id: str, progress: Optional[ProgressCallback] = None,
+                         workers: Optional[int] = None, incremental: bool = True,
+                         control: Optional[JobControl] = None) -> Path:
+    """
+    Fetch, render, cut, and build PDFs/SVG for the order. Returns output directory.
+    progress, if given, receives a stage event dict (see module docstring) as each stage starts and ends.
+    workers: cards of this order processed at once on the shared card pool (card_pool.py; default: the
+    pool size); 1 runs them in-process.
+    incremental: skip per-card stages whose inputs match the card manifest; False reruns everything.
+    control: cancellation and stage/job budgets (see module docstring).
+    """
+    card_dirs = render_order_cards(order_id, progress, workers, incremental, control)
+    out_dir = OUTPUT_BASE / order_id
+    n_cards = len(card_dirs)
 
     bg_images = [d / "print_layer_1_bg.png" for d in card_dirs if (d / "print_layer_1_bg.png").is_file()]
     player_images = [d / "print_layer_2_hero.png" for d in card_dirs if (d / "print_layer_2_hero.png").is_file()]
@@ -139,7 +401,8 @@ def process_single_order(order_id: str) -> Path:
 
     # 1. Background PDF: 6-up (3x2), crop marks for guillotine
     bg_path = out_dir / f"ord_{short_id}_bg_6up.pdf"
-    create_background_sheet(bg_images, bg_path)
+    with _stage(progress, "background_pdf", n_cards, out_dir, control=control):
+        create_background_sheet(bg_images, bg_path)
 
     # 2. Foreground PDF (4-up CMYK): left = player only, right = frame + text (2 cards per page, 4 slots)
     fg_images = []
@@ -156,20 +419,22 @@ def process_single_order(order_id: str) -> Path:
     if not fg_images:
         raise FileNotFoundError("No player or frame layers produced for 4-up PDF")
     fg_path = out_dir / f"ord_{short_id}_fg_4up.pdf"
-    create_foreground_sheet(fg_images, fg_path)
+    with _stage(progress, "foreground_pdf", n_cards, out_dir, control=control):
+        create_foreground_sheet(fg_images, fg_path)
 
     # 3. Cutlines SVG: top layers and spacers.
     # Spacers are output at 2x quantity (same paths duplicated) for layered assembly.
     cards_per_page = 2
     num_top_pages = (len(card_dirs) + cards_per_page - 1) // cards_per_page
-    for p in range(num_top_pages):
-        start = p * cards_per_page
-        end = min(start + cards_per_page, len(card_dirs))
-        hf_c = hero_frame_cuts[start:end]
-        f_c = frame_cuts[start:end]
-        suffix = f"_{p + 1}" if num_top_pages > 1 else ""
-        top_path = out_dir / f"ord_{short_id}_top{suffix}.svg"
-        build_top_layers_cutlines_svg(hf_c, f_c, top_path)
+    with _stage(progress, "top_svg", n_cards, out_dir, control=control):
+        for p in range(num_top_pages):
+            start = p * cards_per_page
+            end = min(start + cards_per_page, len(card_dirs))
+            hf_c = hero_frame_cuts[start:end]
+            f_c = frame_cuts[start:end]
+            suffix = f"_{p + 1}" if num_top_pages > 1 else ""
+            top_path = out_dir / f"ord_{short_id}_top{suffix}.svg"
+            build_top_layers_cutlines_svg(hf_c, f_c, top_path)
 
     # Duplicate spacer entries so each card's spacer set is cut twice.
     hf_s_all = []
@@ -179,14 +444,15 @@ def process_single_order(order_id: str) -> Path:
         f_s_all.extend([f_s, f_s])
 
     num_spacer_pages = (len(hf_s_all) + cards_per_page - 1) // cards_per_page
-    for p in range(num_spacer_pages):
-        start = p * cards_per_page
-        end = min(start + cards_per_page, len(hf_s_all))
-        hf_s = hf_s_all[start:end]
-        f_s = f_s_all[start:end]
-        suffix = f"_{p + 1}" if num_spacer_pages > 1 else ""
-        spacer_path = out_dir / f"ord_{short_id}_spacer{suffix}.svg"
-        build_spacers_cutlines_svg(hf_s, f_s, spacer_path)
+    with _stage(progress, "spacer_svg", n_cards, out_dir, control=control):
+        for p in range(num_spacer_pages):
+            start = p * cards_per_page
+            end = min(start + cards_per_page, len(hf_s_all))
+            hf_s = hf_s_all[start:end]
+            f_s = f_s_all[start:end]
+            suffix = f"_{p + 1}" if num_spacer_pages > 1 else ""
+            spacer_path = out_dir / f"ord_{short_id}_spacer{suffix}.svg"
+            build_spacers_cutlines_svg(hf_s, f_s, spacer_path)
 
     return out_dir
 
@@ -195,9 +461,16 @@ def main():
     parser = argparse.ArgumentParser(description="Process a single order: fetch, render, cut, build PDFs and cutlines.")
     parser.add_argument("order_id", help="Order UUID")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose logging")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Card pool processes (default PRODUCTION_CARD_WORKERS or CPU count)")
+    parser.add_argument("--full", action="store_true", help="Rerun every stage, ignoring the card manifests")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
-    out = process_single_order(args.order_id)
+    get_card_pool(args.workers)  # size the pool for this run
+    try:
+        out = process_single_order(args.order_id, workers=args.workers, incremental=not args.full)
+    finally:
+        shutdown_card_pool()
     print(f"Done. Output: {out}")
 
 
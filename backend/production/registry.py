@@ -0,0 +1,381 @@
+"""
+Persistent registry of production jobs, stage timings and artifacts (SQLite).
+
+Replaces the in-process PRODUCTION_JOBS / PRODUCTION_OUTPUT_DIRS dicts, so status and downloads
+survive restarts and are shared by several uvicorn worker processes:
+
+- The database lives next to the outputs (output/.production_registry.sqlite3) in WAL mode
+  with a busy timeout; every call opens its own short connection, so it is safe from any thread
+  or process.
+- claim_job() checks and sets the job row in one write transaction, so only one process runs
+  a given order at a time.
+- rebuild_from_disk() runs at startup: order directories under output/ that have PDFs/SVGs but
+  no finished job row are registered as completed, and jobs left "running" by a process that
+  no longer exists are marked failed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_SUFFIXES = (".pdf", ".svg")
+REGISTRY_FILENAME = ".production_registry.sqlite3"
+_HASH_CHUNK = 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    order_id    TEXT PRIMARY KEY,
+    status      TEXT NOT NULL,
+    priority    TEXT,
+    error       TEXT,
+    output_dir  TEXT,
+    owner       TEXT,
+    queued_at   REAL,
+    started_at  REAL,
+    finished_at REAL,
+    updated_at  REAL NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS stages (
+    order_id      TEXT NOT NULL,
+    stage         TEXT NOT NULL,
+    card          INTEGER NOT NULL DEFAULT -1,
+    status        TEXT NOT NULL,
+    started_at    REAL,
+    finished_at   REAL,
+    bytes_written INTEGER,
+    detail        TEXT,
+    PRIMARY KEY (order_id, stage, card)
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    order_id TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    sha256   TEXT NOT NULL,
+    mtime    REAL NOT NULL,
+    PRIMARY KEY (order_id, name)
+);
+"""
+
+
+def _process_start(pid: int) -> Optional[str]:
+    """Start time of pid in clock ticks since boot (Linux /proc), or None where unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm (field 2) may contain spaces; starttime is field 22, the 20th after ")"
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+# Identifies this process incarnation: a restarted container reuses hostname and often the pid
+# (PID 1), but not the start time. Without /proc, a random token (checked as pid-only below).
+_OWNER_TOKEN = _process_start(os.getpid()) or f"u{uuid.uuid4().hex[:12]}"
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{_OWNER_TOKEN}"
+
+
+def _owner_alive(owner: Optional[str]) -> bool:
+    """
+    False when owner is a process on this host that no longer exists, or whose pid now belongs
+    to a different process (a restart). Owners on other hosts are assumed alive.
+    """
+    host, pid, token = ((owner or "").split(":") + ["", ""])[:3]
+    if host != socket.gethostname():
+        return True
+    if not pid.isdigit() or not token:  # no token: written before a restart of this server
+        return False
+    pid = int(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if token.startswith("u"):
+        return pid != os.getpid() or token == _OWNER_TOKEN
+    return _process_start(pid) == token
+
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ProductionRegistry:
+    """
+    Args:
+        output_base: Directory holding output/<order_id>/ folders (and the database).
+        db_path: Database file; defaults to output_base/.production_registry.sqlite3.
+    """
+
+    def __init__(self, output_base: Path, db_path: Optional[Path] = None):
+        self.output_base = Path(output_base)
+        self.db_path = Path(db_path) if db_path else self.output_base / REGISTRY_FILENAME
+        self.output_base.mkdir(parents=True, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            if "cancel_requested" not in columns:  # databases created before cancellation
+                conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    # ---- jobs -------------------------------------------------------------------------
+
+    def job_queued(self, order_id: str, priority: str) -> None:
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                """INSERT INTO jobs (order_id, status, priority, owner, queued_at, updated_at)
+                   VALUES (?, 'queued', ?, ?, ?, ?)
+                   ON CONFLICT(order_id) DO UPDATE SET
+                     status = 'queued', priority = excluded.priority, owner = excluded.owner, error = NULL,
+                     cancel_requested = 0,
+                     queued_at = excluded.queued_at, started_at = NULL, finished_at = NULL,
+                     updated_at = excluded.updated_at
+                   WHERE jobs.status != 'running'""",
+                (order_id, priority, _owner(), now, now),
+            )
+
+    def claim_job(self, order_id: str) -> bool:
+        """
+        Mark the job running for this process. False if another live process is running it, or
+        if it was cancelled while queued (it is then marked cancelled).
+        """
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT status, owner, cancel_requested FROM jobs WHERE order_id = ?", (order_id,)
+            ).fetchone()
+            if row is not None and row["status"] == "running" and row["owner"] != _owner() and _owner_alive(row["owner"]):
+                conn.execute("ROLLBACK")
+                return False
+            if row is not None and row["status"] == "queued" and row["cancel_requested"]:
+                conn.execute(
+                    """UPDATE jobs SET status = 'cancelled', error = 'Cancelled before it started',
+                         finished_at = ?, updated_at = ? WHERE order_id = ?""",
+                    (now, now, order_id),
+                )
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                """INSERT INTO jobs (order_id, status, owner, started_at, updated_at)
+                   VALUES (?, 'running', ?, ?, ?)
+                   ON CONFLICT(order_id) DO UPDATE SET
+                     status = 'running', owner = excluded.owner, error = NULL, cancel_requested = 0,
+                     started_at = excluded.started_at, finished_at = NULL, updated_at = excluded.updated_at""",
+                (order_id, _owner(), now, now),
+            )
+            conn.execute("DELETE FROM stages WHERE order_id = ?", (order_id,))
+            conn.execute("COMMIT")
+        return True
+
+    def job_finished(self, order_id: str, status: str, error: Optional[str] = None,
+                     output_dir: Optional[Path] = None) -> None:
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                """UPDATE jobs SET status = ?, error = ?, output_dir = COALESCE(?, output_dir),
+                     finished_at = ?, updated_at = ? WHERE order_id = ?""",
+                (status, error, str(output_dir) if output_dir else None, now, now, order_id),
+            )
+
+    def request_cancel(self, order_id: str) -> Optional[str]:
+        """Flag a queued or running job for cancellation (seen by whichever process holds it). Returns its status."""
+        with self._conn() as conn:
+            conn.execute(
+                """UPDATE jobs SET cancel_requested = 1, updated_at = ?
+                   WHERE order_id = ? AND status IN ('queued', 'running')""",
+                (time.time(), order_id),
+            )
+            row = conn.execute("SELECT status FROM jobs WHERE order_id = ?", (order_id,)).fetchone()
+        return row["status"] if row else None
+
+    def cancel_requested(self, order_id: str) -> bool:
+        with self._conn() as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE order_id = ?", (order_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def clear_output(self, order_id: str) -> None:
+        """Forget the order's output dir and artifacts (the folder was deleted)."""
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET output_dir = NULL, updated_at = ? WHERE order_id = ?", (time.time(), order_id))
+            conn.execute("DELETE FROM artifacts WHERE order_id = ?", (order_id,))
+
+    def get_job(self, order_id: str) -> Optional[dict]:
+        with self._conn() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE order_id = ?", (order_id,)).fetchone()
+        return dict(row) if row else None
+
+    def output_dir(self, order_id: str) -> Optional[Path]:
+        """The order's output folder if a finished job produced it and it still exists."""
+        job = self.get_job(order_id)
+        if not job or not job.get("output_dir"):
+            return None
+        out_dir = Path(job["output_dir"])
+        return out_dir if out_dir.is_dir() else None
+
+    # ---- stages -----------------------------------------------------------------------
+
+    def record_stage(self, order_id: str, stage: str, status: str, card: int = -1,
+                     started_at: Optional[float] = None, finished_at: Optional[float] = None,
+                     bytes_written: Optional[int] = None, detail: Optional[dict] = None) -> None:
+        with self._conn() as conn:
+            conn.execute(
+                """INSERT INTO stages (order_id, stage, card, status, started_at, finished_at, bytes_written, detail)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(order_id, stage, card) DO UPDATE SET
+                     status = excluded.status,
+                     started_at = COALESCE(excluded.started_at, stages.started_at),
+                     finished_at = excluded.finished_at,
+                     bytes_written = excluded.bytes_written,
+                     detail = excluded.detail""",
+                (order_id, stage, card, status, started_at, finished_at, bytes_written,
+                 json.dumps(detail) if detail else None),
+            )
+
+    def close_running_stages(self, order_id: str, status: str) -> None:
+        """Give stages still marked running (e.g. in a terminated worker process) a final status."""
+        with self._conn() as conn:
+            conn.execute(
+                "UPDATE stages SET status = ?, finished_at = ? WHERE order_id = ? AND status = 'running'",
+                (status, time.time(), order_id),
+            )
+
+    def list_stages(self, order_id: str) -> List[dict]:
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT * FROM stages WHERE order_id = ? ORDER BY started_at, card", (order_id,)
+            ).fetchall()
+        stages = []
+        for row in rows:
+            stage = dict(row)
+            stage.pop("order_id")
+            stage["detail"] = json.loads(stage["detail"]) if stage["detail"] else None
+            if stage["started_at"] and stage["finished_at"]:
+                stage["elapsed_ms"] = round((stage["finished_at"] - stage["started_at"]) * 1000, 1)
+            stages.append(stage)
+        return stages
+
+    def progress(self, order_id: str) -> dict:
+        """
+        Summary of the stage events: cards done of total, the stage running now, elapsed time and
+        a rough ETA (average "card" stage time x cards left; sheet building is not included).
+        """
+        stages = self.list_stages(order_id)
+        job = self.get_job(order_id) or {}
+        cards_total = max(((s["detail"] or {}).get("cards", 0) for s in stages), default=0)
+        done = [s for s in stages if s["stage"] == "card" and s["status"] == "completed"]
+        running = [s for s in stages if s["status"] == "running" and s["stage"] != "card"]
+        avg_card_s = sum(s["elapsed_ms"] for s in done) / 1000 / len(done) if done else None
+        current = running[-1] if running else None
+        return {
+            "cards_total": cards_total,
+            "cards_done": len(done),
+            "current_stage": current["stage"] if current else None,
+            "current_card": current["card"] if current and current["card"] >= 0 else None,
+            "elapsed_s": round(time.time() - job["started_at"], 1) if job.get("started_at") and job.get("status") == "running" else None,
+            "avg_card_s": round(avg_card_s, 2) if avg_card_s is not None else None,
+            "eta_s": round(avg_card_s * (cards_total - len(done)), 1) if avg_card_s is not None else None,
+            "bytes_written": sum(s["bytes_written"] or 0 for s in stages if s["stage"] != "card"),
+        }
+
+    # ---- artifacts --------------------------------------------------------------------
+
+    def record_artifacts(self, order_id: str, out_dir: Path) -> List[dict]:
+        """Register the PDFs/SVGs in out_dir with size and SHA-256 (re-hashing only changed files)."""
+        out_dir = Path(out_dir)
+        with self._conn() as conn:
+            known = {
+                r["name"]: dict(r)
+                for r in conn.execute("SELECT * FROM artifacts WHERE order_id = ?", (order_id,)).fetchall()
+            }
+        rows = []
+        for f in sorted(out_dir.iterdir()) if out_dir.is_dir() else []:
+            if not f.is_file() or f.suffix.lower() not in ARTIFACT_SUFFIXES or f.name.startswith("."):
+                continue
+            st = f.stat()
+            old = known.get(f.name)
+            if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+                sha = old["sha256"]
+            else:
+                sha = _sha256_file(f)
+            rows.append((order_id, f.name, st.st_size, sha, st.st_mtime))
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM artifacts WHERE order_id = ?", (order_id,))
+            conn.executemany("INSERT INTO artifacts (order_id, name, size, sha256, mtime) VALUES (?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        return self.list_artifacts(order_id)
+
+    def list_artifacts(self, order_id: str) -> List[dict]:
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT name, size, sha256, mtime FROM artifacts WHERE order_id = ? ORDER BY name", (order_id,)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    # ---- startup ----------------------------------------------------------------------
+
+    def rebuild_from_disk(self) -> dict:
+        """Register finished output folders missing from the database; fail jobs orphaned by a dead process."""
+        now = time.time()
+        interrupted = 0
+        with self._conn() as conn:
+            stale = conn.execute("SELECT order_id, owner FROM jobs WHERE status IN ('running', 'queued')").fetchall()
+        for row in stale:
+            if row["owner"] is None or not _owner_alive(row["owner"]):
+                self.job_finished(row["order_id"], "failed", "Interrupted by a server restart")
+                interrupted += 1
+
+        registered = 0
+        for out_dir in sorted(p for p in self.output_base.iterdir() if p.is_dir() and not p.name.startswith(".")):
+            if not any(f.suffix.lower() in ARTIFACT_SUFFIXES for f in out_dir.iterdir() if f.is_file()):
+                continue
+            job = self.get_job(out_dir.name)
+            if job and job["status"] == "running":
+                continue
+            if job is None or not job.get("output_dir"):
+                finished_at = max(f.stat().st_mtime for f in out_dir.iterdir() if f.is_file())
+                with self._conn() as conn:
+                    conn.execute(
+                        """INSERT INTO jobs (order_id, status, output_dir, finished_at, updated_at)
+                           VALUES (?, 'completed', ?, ?, ?)
+                           ON CONFLICT(order_id) DO UPDATE SET
+                             output_dir = excluded.output_dir,
+                             status = CASE WHEN jobs.status = 'failed' AND jobs.error IS NOT NULL
+                                           THEN jobs.status ELSE 'completed' END,
+                             updated_at = excluded.updated_at""",
+                        (out_dir.name, str(out_dir), finished_at, now),
+                    )
+                registered += 1
+            self.record_artifacts(out_dir.name, out_dir)
+        logger.info(f"Production registry: {registered} output folder(s) registered, {interrupted} interrupted job(s)")
+        return {"registered": registered, "interrupted": interrupted}
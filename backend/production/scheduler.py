@@ -0,0 +1,225 @@
+"""
+Bounded production job scheduler: a fixed number of worker threads and a priority FIFO queue.
+
+Each production run is a full PIL/OpenCV/ReportLab pipeline; running one thread per click lets
+a handful of admins saturate the process. Jobs here wait in a queue ordered by priority
+(rush before normal before low) and then by submission time, and at most `workers` run at once.
+
+When the queue is full a new job is rejected (QueueFullError), unless it outranks the newest
+lowest-priority queued job: that job is then deferred (kept, reported as "deferred") and
+re-admitted automatically as soon as the queue has room. Deferred jobs are bounded too: once
+max_deferred are held, an outranking job is rejected instead of displacing another.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {"rush": 0, "normal": 1, "low": 2}
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the production queue is at capacity and the job is rejected."""
+
+
+class ProductionScheduler:
+    """
+    Args:
+        run_job: Called as run_job(order_id, params) on a worker thread; exceptions are logged.
+        workers: Jobs that run concurrently.
+        max_queue: Jobs allowed to wait; 0 means unbounded.
+        max_deferred: Displaced jobs held for re-admission (default: max_queue).
+    """
+
+    def __init__(self, run_job: Callable[[str, dict], None], workers: int = 2, max_queue: int = 20,
+                 max_deferred: Optional[int] = None):
+        self.run_job = run_job
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.max_deferred = self.max_queue if max_deferred is None else max(0, int(max_deferred))
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._heap: List[tuple] = []  # (rank, seq, order_id)
+        self._queued: Dict[str, dict] = {}  # order_id -> job (also in the heap)
+        self._deferred: List[dict] = []  # displaced jobs, re-admitted oldest-best first
+        self._running: Dict[str, dict] = {}
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self) -> None:
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"production-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info(f"Production scheduler: {self.workers} worker(s), max queue {self.max_queue or 'unbounded'}")
+
+    def shutdown(self) -> None:
+        """Stop taking jobs; running jobs finish, queued ones are dropped."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._threads = []
+
+    def submit(self, order_id: str, priority: str = "normal", **params) -> dict:
+        """
+        Queue a job (or return the existing queued/running one; a queued job is moved up if
+        the new priority is higher, and truthy params such as clean=True are merged into it).
+        Returns status info as in status().
+        Raises ValueError for an unknown priority, QueueFullError when rejected.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}; expected one of {tuple(PRIORITIES)}")
+        rank = PRIORITIES[priority]
+        with self._cond:
+            if order_id in self._running:
+                return self._status_locked(order_id)
+            existing = self._queued.get(order_id) or next((j for j in self._deferred if j["order_id"] == order_id), None)
+            if existing is not None:
+                existing["params"].update({k: v for k, v in params.items() if v})
+                if rank < existing["rank"]:
+                    if order_id in self._queued or self._has_room_locked(rank):
+                        self._remove_locked(order_id)
+                        existing.update(rank=rank, priority=priority)
+                        self._admit_locked(existing)
+                    else:  # no room even at the new priority: stays deferred, readmitted sooner
+                        existing.update(rank=rank, priority=priority)
+                return self._status_locked(order_id)
+
+            job = {
+                "order_id": order_id,
+                "priority": priority,
+                "rank": rank,
+                "seq": next(self._seq),
+                "params": params,
+                "queued_at": time.time(),
+            }
+            self._admit_locked(job)
+            return self._status_locked(order_id)
+
+    def cancel(self, order_id: str) -> bool:
+        """Drop a queued or deferred job. False if it is not waiting here (running jobs are not touched)."""
+        with self._cond:
+            waiting = order_id in self._queued or any(j["order_id"] == order_id for j in self._deferred)
+            if waiting:
+                self._remove_locked(order_id)
+                self._readmit_deferred_locked()
+        if waiting:
+            logger.info(f"Production job {order_id} cancelled while queued")
+        return waiting
+
+    def _has_room_locked(self, rank: int) -> bool:
+        """True if a job of this rank would be admitted now (possibly deferring another)."""
+        if not self.max_queue or len(self._queued) < self.max_queue:
+            return True
+        return max(j["rank"] for j in self._queued.values()) > rank
+
+    def _admit_locked(self, job: dict) -> None:
+        if self.max_queue and len(self._queued) >= self.max_queue:
+            victim = max(self._queued.values(), key=lambda j: (j["rank"], j["seq"]))
+            if victim["rank"] <= job["rank"]:
+                self._rejected += 1
+                raise QueueFullError(f"Production queue is full ({self.max_queue} waiting)")
+            if len(self._deferred) >= self.max_deferred:
+                self._rejected += 1
+                raise QueueFullError(
+                    f"Production queue is full ({self.max_queue} waiting, {len(self._deferred)} deferred)"
+                )
+            self._remove_locked(victim["order_id"])
+            self._deferred.append(victim)
+            logger.info(f"Production job {victim['order_id']} deferred by {job['priority']} job {job['order_id']}")
+        self._queued[job["order_id"]] = job
+        heapq.heappush(self._heap, (job["rank"], job["seq"], job["order_id"]))
+        self._cond.notify()
+
+    def _remove_locked(self, order_id: str) -> None:
+        if self._queued.pop(order_id, None) is not None:
+            self._heap = [e for e in self._heap if e[2] != order_id]
+            heapq.heapify(self._heap)
+        self._deferred = [j for j in self._deferred if j["order_id"] != order_id]
+
+    def _readmit_deferred_locked(self) -> None:
+        self._deferred.sort(key=lambda j: (j["rank"], j["seq"]))
+        while self._deferred and (not self.max_queue or len(self._queued) < self.max_queue):
+            self._admit_locked(self._deferred.pop(0))
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                _, _, order_id = heapq.heappop(self._heap)
+                job = self._queued.pop(order_id)
+                job["started_at"] = time.time()
+                self._running[order_id] = job
+                self._readmit_deferred_locked()
+            wait = job["started_at"] - job["queued_at"]
+            logger.info(f"Production job {order_id} ({job['priority']}) started after {wait:.1f}s in queue")
+            ok = False
+            try:
+                self.run_job(order_id, job["params"])
+                ok = True
+            except Exception:
+                logger.exception(f"Production job {order_id} raised")
+            finally:
+                with self._cond:
+                    self._running.pop(order_id, None)
+                    if ok:
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+
+    def _queue_order_locked(self) -> List[str]:
+        return [order_id for _, _, order_id in sorted(self._heap)]
+
+    def _status_locked(self, order_id: str) -> Optional[dict]:
+        if order_id in self._running:
+            job = self._running[order_id]
+            return {"state": "running", "priority": job["priority"], "started_at": job["started_at"]}
+        if order_id in self._queued:
+            job = self._queued[order_id]
+            return {
+                "state": "queued",
+                "priority": job["priority"],
+                "queue_position": self._queue_order_locked().index(order_id) + 1,
+                "queue_length": len(self._queued),
+                "queued_at": job["queued_at"],
+            }
+        for job in self._deferred:
+            if job["order_id"] == order_id:
+                return {"state": "deferred", "priority": job["priority"], "queued_at": job["queued_at"]}
+        return None
+
+    def status(self, order_id: str) -> Optional[dict]:
+        """{"state": "queued"|"running"|"deferred", "priority", "queue_position", ...} or None."""
+        with self._cond:
+            return self._status_locked(order_id)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "max_deferred": self.max_deferred,
+                "running": sorted(self._running),
+                "queue": [
+                    {"order_id": o, "priority": self._queued[o]["priority"]} for o in self._queue_order_locked()
+                ],
+                "deferred": [j["order_id"] for j in self._deferred],
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+            }
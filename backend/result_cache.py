@@ -0,0 +1,124 @@
+"""
+Content-addressed cache for /remove-bg results.
+
+Customers re-upload the same photo many times while iterating in the card builder. Results are
+keyed by a hash of the input bytes plus the options that change the output (model, edge
+refinement, athlete enhancement, mask mode, output format), so a repeat upload returns the files
+already in static/uploads instead of running the model again.
+
+Eviction is LRU under a byte budget (the size of the cached PNGs). Evicting an entry only
+forgets it; the files stay on disk because saved designs may still reference their URLs.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(file_content: bytes, *options) -> str:
+    """sha256 of the upload bytes followed by the processing options that affect the output."""
+    h = hashlib.sha256(file_content)
+    for opt in options:
+        h.update(b"\0")
+        h.update(str(opt).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Thread-safe LRU map of cache key -> result dict, bounded by the bytes of the files it points at.
+
+    Args:
+        max_bytes: Budget for the summed size of cached files; 0 disables the cache.
+        base_dir: Directory the cached filenames live in (checked on lookup).
+    """
+
+    def __init__(self, max_bytes: int, base_dir: str):
+        self.max_bytes = max(0, int(max_bytes))
+        self.base_dir = base_dir
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple[dict, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _files_exist(self, result: dict) -> bool:
+        # A deferred uncropped copy (uncropped_lazy) is written on first request, so only
+        # the cropped file has to be on disk.
+        keys = ("filename",) if result.get("uncropped_lazy") else ("filename", "uncropped_filename")
+        return all(
+            os.path.isfile(os.path.join(self.base_dir, result[k]))
+            for k in keys
+            if result.get(k)
+        )
+
+    def _entry_size(self, result: dict) -> int:
+        size = 0
+        for k in ("filename", "uncropped_filename"):
+            name = result.get(k)
+            if name:
+                try:
+                    size += os.path.getsize(os.path.join(self.base_dir, name))
+                except OSError:
+                    pass
+        return size
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return a copy of the cached result, or None. Entries whose files were deleted are dropped."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._files_exist(entry[0]):
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[0])
+
+    def put(self, key: str, result: dict) -> None:
+        """Store result under key and evict least-recently-used entries beyond max_bytes."""
+        if not self.enabled:
+            return
+        size = self._entry_size(result)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (dict(result), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key = next(iter(self._entries))
+                self._drop(old_key)
+                self.evictions += 1
+                logger.debug("Result cache evicted %s", old_key[:12])
+
+    def _drop(self, key: str) -> None:
+        _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,289 @@
+"""
+Cache-friendly file responses for uploads and production artifacts.
+
+- Strong ETags from the content hash (cached per file version, so re-linking identical bytes
+  through the blob store keeps the validator) and Last-Modified, with If-None-Match /
+  If-Modified-Since answered by 304.
+- Single byte ranges (206, If-Range, 416), so multi-MB PDFs can resume and seek.
+- UUID-named uploads never change once written and are served as immutable.
+- SVG cutlines are served from a pre-compressed .gz sibling when the client accepts gzip;
+  the sibling is written next to the file and rewritten whenever the SVG is newer.
+
+The pinned Starlette FileResponse supports none of this except If-None-Match; everything here
+is plain ASGI, so it does not depend on the Starlette version.
+"""
+
+import gzip
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+from blob_store import sha256_file
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Same name, new content after a regeneration: always revalidate (cheap 304 when unchanged)
+REVALIDATE_CACHE_CONTROL = "no-cache"
+GZIP_SUFFIXES = (".svg",)
+GZIP_MIN_BYTES = 1024
+_CHUNK_SIZE = 256 * 1024
+# Content digests by file version (device, inode, size, mtime), so each version is hashed once.
+_DIGEST_CACHE_SIZE = 4096
+_digest_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_digest_lock = threading.Lock()
+
+
+def content_digest(path: Path, st: os.stat_result) -> str:
+    """SHA-256 of path's bytes; blocking the first time a version of the file is seen."""
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        digest = _digest_cache.get(key)
+        if digest is not None:
+            _digest_cache.move_to_end(key)
+            return digest
+    digest = sha256_file(path)
+    with _digest_lock:
+        _digest_cache[key] = digest
+        while len(_digest_cache) > _DIGEST_CACHE_SIZE:
+            _digest_cache.popitem(last=False)
+    return digest
+
+
+def strong_etag(path: Path, st: os.stat_result) -> str:
+    """Depends on the bytes only: an identical file re-linked under a new inode keeps its ETag."""
+    return f'"{content_digest(path, st)[:32]}"'
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    for token in (accept_encoding or "").split(","):
+        coding, _, params = token.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            q = params.strip()
+            try:
+                return not (q.startswith("q=") and float(q[2:] or 0) == 0)
+            except ValueError:  # malformed q-value: treat as not accepted
+                return False
+    return False
+
+
+def gzip_variant(path: Path, st: os.stat_result) -> Optional[Tuple[Path, os.stat_result]]:
+    """(path.gz, its stat), written first if missing or older than path. None for small files."""
+    gz = path.with_name(path.name + ".gz")
+    try:
+        gz_st = gz.stat()
+        if gz_st.st_mtime_ns >= st.st_mtime_ns:
+            return gz, gz_st
+    except FileNotFoundError:
+        pass
+    if st.st_size < GZIP_MIN_BYTES:
+        return None
+    tmp = gz.with_name(f".{gz.name}.{uuid.uuid4().hex}.tmp")
+    with open(path, "rb") as src, gzip.GzipFile(tmp, "wb", compresslevel=9, mtime=0) as dst:
+        shutil.copyfileobj(src, dst, _CHUNK_SIZE)
+    os.replace(tmp, gz)
+    return gz, gz.stat()
+
+
+def precompress_dir(directory: Path) -> int:
+    """Write .gz variants for the GZIP_SUFFIXES files in directory (top level). Returns count written or fresh."""
+    count = 0
+    for path in Path(directory).iterdir():
+        if path.is_file() and path.suffix.lower() in GZIP_SUFFIXES:
+            try:
+                if gzip_variant(path, path.stat()) is not None:
+                    count += 1
+            except OSError as e:
+                logger.warning(f"Could not precompress {path.name}: {e}")
+    return count
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == bare for tag in header.split(","))
+
+
+def is_not_modified(request_headers: Headers, etag: str, st: os.stat_result) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end) inclusive for a single "bytes=" range, or None to send the whole file
+    (no header, malformed, or several ranges). Raises ValueError if it cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[len("bytes="):].strip().partition("-")
+    if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if not first:  # suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("range starts past the end")
+    return start, min(int(last) if last else size - 1, size - 1)
+
+
+def _if_range_allows(request_headers: Headers, etag: str, st: os.stat_result) -> bool:
+    if_range = request_headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag  # strong comparison
+    try:
+        return int(st.st_mtime) == int(parsedate_to_datetime(if_range).timestamp())
+    except (TypeError, ValueError):
+        return False
+
+
+class FileSliceResponse(Response):
+    """Streams length bytes of path from start (the whole file for a 200)."""
+
+    def __init__(self, path: Path, start: int, length: int, status_code: int, headers: dict,
+                 media_type: Optional[str], send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.length = length
+        self.send_body = send_body
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        remaining = self.length
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+            while remaining > 0:
+                chunk = await f.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:  # file shrank underneath us; close the body
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def file_response(
+    request_headers: Headers,
+    method: str,
+    path: Path,
+    st: Optional[os.stat_result] = None,
+    cache_control: str = REVALIDATE_CACHE_CONTROL,
+    media_type: Optional[str] = None,
+    filename: Optional[str] = None,
+) -> Response:
+    """
+    GET/HEAD response for path with ETag/Last-Modified, 304, byte ranges and (for
+    GZIP_SUFFIXES) the gzip variant. Blocking (stat, may write the .gz): call off the event loop.
+    """
+    path = Path(path)
+    st = st or path.stat()
+    media_type = media_type or mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    headers = {"cache-control": cache_control, "accept-ranges": "bytes"}
+    if filename:
+        headers["content-disposition"] = f'attachment; filename="{filename}"'
+
+    body_path, body_st = path, st
+    if path.suffix.lower() in GZIP_SUFFIXES:
+        headers["vary"] = "Accept-Encoding"
+        if accepts_gzip(request_headers.get("accept-encoding")):
+            variant = gzip_variant(path, st)
+            if variant is not None:
+                body_path, body_st = variant
+                headers["content-encoding"] = "gzip"
+                headers["accept-ranges"] = "none"  # ranges of the encoded body are not offered
+
+    etag = strong_etag(path, st)
+    if "content-encoding" in headers:
+        etag = etag[:-1] + '-gzip"'
+    headers["etag"] = etag
+    headers["last-modified"] = formatdate(st.st_mtime, usegmt=True)
+
+    if is_not_modified(request_headers, etag, st):
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "content-disposition"})
+
+    size = body_st.st_size
+    start, length, status = 0, size, 200
+    if "content-encoding" not in headers and _if_range_allows(request_headers, etag, st):
+        try:
+            byte_range = parse_range(request_headers.get("range"), size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            length, status = end - start + 1, 206
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+    headers["content-length"] = str(length)
+    return FileSliceResponse(body_path, start, length, status, headers, media_type, send_body=method != "HEAD")
+
+
+class _ThreadedFileResponse(Response):
+    """Builds the real response with build() on a worker thread when sent, then sends it."""
+
+    def __init__(self, build: Callable[[], Response]):
+        super().__init__()
+        self.build = build
+
+    async def __call__(self, scope, receive, send) -> None:
+        response = await anyio.to_thread.run_sync(self.build)
+        await response(scope, receive, send)
+
+
+class CachingStaticFiles(StaticFiles):
+    """
+    StaticFiles serving through file_response. is_immutable(relative path) selects files sent
+    with IMMUTABLE_CACHE_CONTROL; others revalidate. Dot-named paths (upload sidecars,
+    pending records, temp files) are never served. StaticFiles calls file_response on the
+    event loop, so the blocking part (hashing, gzip) is deferred to a worker thread.
+    """
+
+    def __init__(self, *args, is_immutable: Callable[[str], bool] = lambda path: False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_immutable = is_immutable
+
+    async def get_response(self, path: str, scope) -> Response:
+        if any(part.startswith(".") for part in path.replace("\\", "/").split("/") if part):
+            raise HTTPException(status_code=404)
+        scope["caching_static_path"] = path
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        if status_code != 200:  # html mode 404 page
+            return super().file_response(full_path, stat_result, scope, status_code)
+        path = scope.get("caching_static_path", "")
+        cache_control = IMMUTABLE_CACHE_CONTROL if self.is_immutable(path) else REVALIDATE_CACHE_CONTROL
+        request_headers, method = Headers(scope=scope), scope["method"]
+        return _ThreadedFileResponse(
+            lambda: file_response(request_headers, method, Path(full_path), stat_result, cache_control)
+        )
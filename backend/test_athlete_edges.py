@@ -14,7 +14,7 @@ TEST_IMAGE = "../frontend/public/jordan.jpg"
 
 def test_configuration(input_image, config_name, model_name, refine=False, athlete_enhance=False):
     """Test a specific configuration"""
-    from main import refine_edges, enhance_edges_for_athletes
+    from background_removal import refine_edges, enhance_edges_for_athletes
     
     print(f"\n{'='*60}")
     print(f"Testing: {config_name}")
@@ -0,0 +1,47 @@
+"""
+Files placed by the blob store are hard links to one shared blob: rewriting one of them must
+replace only that name, never the bytes the blob and the other copies share.
+
+Run from backend: python -m pytest test_blob_store.py
+"""
+
+import os
+
+from blob_store import LocalBlobStore, replace_file
+
+
+def test_rewriting_a_linked_upload_leaves_the_blob_and_other_copies_alone(tmp_path):
+    store = LocalBlobStore(tmp_path / "blobs")
+    upload = tmp_path / "uploads" / "result.png"
+    upload.parent.mkdir()
+    upload.write_bytes(b"first result")
+    digest = store.ingest(upload)
+    job_copy = store.link_to(digest, tmp_path / "output" / "card_0" / "hero.png")
+    blob = store.path(digest)
+    assert os.path.samefile(upload, blob) and os.path.samefile(job_copy, blob)
+
+    replace_file(upload, lambda tmp: tmp.write_bytes(b"re-run result"))
+
+    assert upload.read_bytes() == b"re-run result"
+    assert not os.path.samefile(upload, blob)
+    assert blob.read_bytes() == b"first result"
+    assert job_copy.read_bytes() == b"first result"
+    assert not list(upload.parent.glob("*.tmp"))
+
+
+def test_failed_rewrite_keeps_the_old_file(tmp_path):
+    store = LocalBlobStore(tmp_path / "blobs")
+    upload = tmp_path / "result.png"
+    upload.write_bytes(b"first result")
+    store.ingest(upload)
+
+    def fail(tmp):
+        tmp.write_bytes(b"partial")
+        raise OSError("disk full")
+
+    try:
+        replace_file(upload, fail)
+    except OSError:
+        pass
+    assert upload.read_bytes() == b"first result"
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,79 @@
+"""
+Incremental production runs must not keep placeholders from a failed download:
+a fetch stage that fell back to a stand-in is not recorded, so the next run fetches again.
+
+Run from backend: python -m pytest test_incremental_fetch.py
+"""
+
+import io
+
+import pytest
+import requests
+from PIL import Image
+
+import asset_fetcher
+import blob_store
+from production import process_single_order as pso
+
+BG_URL = "https://cdn.example.com/bg.png"
+
+
+class _FakeResponse:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=8192):
+        yield self.body
+
+
+def _png_bytes() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (4, 4), (10, 20, 30)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def card_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(blob_store, "_STORE", blob_store.LocalBlobStore(tmp_path / "blobs"))
+    # Only the fetch stage is under test.
+    monkeypatch.setattr(pso, "render_run_three_layer_for_dir", lambda card_dir, design=None: None)
+    monkeypatch.setattr(pso, "cut_paths_run_for_dir", lambda card_dir: None)
+    return tmp_path / "card_0"
+
+
+def _fetch_status(card_dir, design) -> str:
+    events = []
+    pso._process_card("order", 0, 1, design, card_dir, progress=events.append)
+    return next(e["status"] for e in events if e["stage"] == "fetch" and e["status"] != "running")
+
+
+def test_failed_download_is_retried_on_next_incremental_run(card_dir, monkeypatch):
+    design = {"background_url": BG_URL}
+    calls = []
+
+    def outage(url, **kwargs):
+        calls.append(url)
+        raise requests.ConnectionError("CDN down")
+
+    monkeypatch.setattr(asset_fetcher.requests, "get", outage)
+    assert _fetch_status(card_dir, design) == "completed"
+    assert (card_dir / "background.jpg").is_file()  # stand-in derived from the placeholder hero
+    assert "fetch" not in pso.CardManifest(card_dir).stages
+
+    body = _png_bytes()
+
+    def recovered(url, **kwargs):
+        calls.append(url)
+        return _FakeResponse(body)
+
+    monkeypatch.setattr(asset_fetcher.requests, "get", recovered)
+    assert _fetch_status(card_dir, design) == "completed"
+    assert calls == [BG_URL, BG_URL]
+    assert (card_dir / "background.jpg").read_bytes() == body
+    assert "fetch" in pso.CardManifest(card_dir).stages
+
+    assert _fetch_status(card_dir, design) == "skipped"
+    assert calls == [BG_URL, BG_URL]
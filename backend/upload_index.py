@@ -0,0 +1,318 @@
+"""
+Index, retention and garbage collection for static/uploads.
+
+/remove-bg writes two or three UUID-named files per call and nothing ever removed them. The
+index keeps one entry per file (size, creation time, last access, source-image hash and
+whether any order_cards.design_data references it), rebuilt from a directory scan plus the
+.meta sidecars, so it survives restarts without its own database. Accesses are written to the
+file's atime (os.utime), so they survive restarts too and every uvicorn worker's sweeper sees
+the others' accesses. Only upload-named files (UPLOAD_NAME_RE) are indexed or ever deleted.
+
+The sweeper deletes unreferenced files whose last access is older than the TTL, then, if
+the directory is still over its disk budget, the least recently used unreferenced files.
+Files younger than the minimum age are never touched (the customer may still be designing),
+and nothing is deleted unless the referenced set was loaded successfully.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Iterable, Optional, Set
+
+from upload_metadata import METADATA_DIRNAME, metadata_path, read_upload_metadata
+
+logger = logging.getLogger(__name__)
+
+# <uuid>.png, <uuid>_uncropped.webp, <uuid>_preview.png, ...
+UPLOAD_NAME_RE = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?:_uncropped|_preview)?\.(?:png|webp)"
+)
+PENDING_DIRNAME = ".pending"  # background_removal.PENDING_UNCROPPED_DIR
+_SUPABASE_PAGE = 1000
+# Minimum interval between atime writes for the same file.
+TOUCH_PERSIST_SECONDS = 60.0
+
+
+def referenced_upload_names(design_datas: Iterable) -> Set[str]:
+    """Upload filenames mentioned anywhere (URLs, nested layers) in the given design_data values."""
+    names: Set[str] = set()
+    for design in design_datas:
+        if design is None:
+            continue
+        text = design if isinstance(design, str) else json.dumps(design)
+        names.update(UPLOAD_NAME_RE.findall(text))
+    return names
+
+
+def fetch_referenced_uploads() -> Optional[Set[str]]:
+    """Filenames referenced by any order_cards.design_data, or None if Supabase is unavailable."""
+    try:
+        from asset_fetcher import get_supabase_client
+
+        client = get_supabase_client()
+        designs = []
+        start = 0
+        while True:
+            page = (
+                client.table("order_cards")
+                .select("design_data")
+                .order("id")  # stable order, so no row is skipped between pages
+                .range(start, start + _SUPABASE_PAGE - 1)
+                .execute()
+            ).data or []
+            designs.extend(row.get("design_data") for row in page)
+            if len(page) < _SUPABASE_PAGE:
+                break
+            start += _SUPABASE_PAGE
+    except (Exception, SystemExit) as e:  # get_supabase_client exits when unconfigured
+        logger.warning(f"Could not load upload references from order_cards: {e}")
+        return None
+    return referenced_upload_names(designs)
+
+
+class UploadIndex:
+    """
+    In-memory index of static/uploads with TTL and disk-budget eviction.
+
+    Args:
+        upload_dir: Directory holding the uploads.
+        ttl_seconds: Unreferenced files not accessed for this long are deleted; 0 disables.
+        max_bytes: Disk budget for the directory; 0 disables LRU eviction.
+        min_age_seconds: Files younger than this are never deleted.
+    """
+
+    def __init__(self, upload_dir: str, ttl_seconds: float = 0, max_bytes: int = 0, min_age_seconds: float = 0):
+        self.upload_dir = upload_dir
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.max_bytes = max(0, int(max_bytes))
+        self.min_age_seconds = max(0.0, float(min_age_seconds))
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict] = {}
+        self._referenced: Optional[Set[str]] = None
+        self._references_loaded_at: Optional[float] = None
+        self._last_sweep: Optional[dict] = None
+
+    def _entry_for(self, filename: str) -> Optional[dict]:
+        path = os.path.join(self.upload_dir, filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        meta = read_upload_metadata(self.upload_dir, filename) or {}
+        created_at = meta.get("created_at") or st.st_mtime
+        return {
+            "size": st.st_size,
+            "created_at": created_at,
+            "last_access": max(created_at, st.st_mtime, st.st_atime),
+            "source_sha256": meta.get("source_sha256"),
+            "kind": meta.get("kind"),
+            # cropped <-> uncropped copy of the same cutout; kept or deleted together
+            "sibling": meta.get("uncropped_filename") or meta.get("cropped_filename"),
+        }
+
+    def scan(self) -> int:
+        """Rebuild the index from the directory (access times from atime). Returns entry count."""
+        entries = {}
+        with os.scandir(self.upload_dir) as it:
+            for de in it:
+                if not UPLOAD_NAME_RE.fullmatch(de.name) or not de.is_file():
+                    continue
+                entry = self._entry_for(de.name)
+                if entry is not None:
+                    entries[de.name] = entry
+        with self._lock:
+            for name, entry in entries.items():
+                old = self._entries.get(name)
+                if old is not None:
+                    entry["last_access"] = max(entry["last_access"], old["last_access"])
+            self._entries = entries
+        logger.info(f"Upload index: {len(entries)} file(s), {self.total_bytes() / 1e6:.1f} MB")
+        return len(entries)
+
+    def add(self, filename: str) -> None:
+        if not UPLOAD_NAME_RE.fullmatch(filename):
+            return
+        entry = self._entry_for(filename)
+        if entry is not None:
+            with self._lock:
+                self._entries[filename] = entry
+
+    def add_result(self, result: dict) -> None:
+        """Index the files a background-removal result wrote (deferred uncropped copies are skipped)."""
+        for key in ("filename", "uncropped_filename"):
+            if result.get(key):
+                self.add(result[key])
+
+    def touch(self, filename: str) -> None:
+        """Record an access (served, cache hit, colour lookup) for LRU eviction, in memory and as the file's atime."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return
+            persist = now - entry["last_access"] >= TOUCH_PERSIST_SECONDS
+            entry["last_access"] = now
+        if persist:
+            path = os.path.join(self.upload_dir, filename)
+            try:
+                os.utime(path, (now, os.stat(path).st_mtime))
+            except OSError as e:
+                logger.debug(f"Could not record access time for {filename}: {e}")
+
+    def _disk_access(self, filename: str) -> float:
+        """Access time recorded on disk (possibly by another worker); 0 if the file is gone."""
+        try:
+            return os.stat(os.path.join(self.upload_dir, filename)).st_atime
+        except OSError:
+            return 0.0
+
+    def set_references(self, names: Set[str]) -> None:
+        with self._lock:
+            self._referenced = set(names)
+            self._references_loaded_at = time.time()
+
+    def is_referenced(self, filename: str) -> Optional[bool]:
+        with self._lock:
+            return None if self._referenced is None else filename in self._referenced
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(e["size"] for e in self._entries.values())
+
+    def _delete(self, filename: str) -> int:
+        size = 0
+        try:
+            path = os.path.join(self.upload_dir, filename)
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        for sidecar in (
+            metadata_path(self.upload_dir, filename),
+            os.path.join(self.upload_dir, PENDING_DIRNAME, filename + ".json"),
+        ):
+            try:
+                os.remove(sidecar)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._entries.pop(filename, None)
+        return size
+
+    def _drop_orphan_records(self) -> int:
+        """Remove .meta records and deferred-uncropped records whose files are gone."""
+        removed = 0
+        meta_dir = os.path.join(self.upload_dir, METADATA_DIRNAME)
+        pending_dir = os.path.join(self.upload_dir, PENDING_DIRNAME)
+        for d, orphaned in (
+            (meta_dir, lambda name, info: not os.path.exists(os.path.join(self.upload_dir, name))),
+            (pending_dir, lambda name, info: not os.path.exists(os.path.join(self.upload_dir, info.get("filename", "")))),
+        ):
+            if not os.path.isdir(d):
+                continue
+            for rec in os.listdir(d):
+                if not rec.endswith(".json"):
+                    continue
+                name = rec[:-len(".json")]
+                path = os.path.join(d, rec)
+                try:
+                    with open(path) as f:
+                        info = json.load(f)
+                except (OSError, ValueError):
+                    info = {}
+                if orphaned(name, info):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    def sweep(self, dry_run: bool = False, now: Optional[float] = None) -> dict:
+        """
+        Delete expired, then least recently used, unreferenced files. Returns a summary;
+        with dry_run nothing is deleted. Skipped entirely until references are loaded.
+        """
+        now = now or time.time()
+        with self._lock:
+            referenced = self._referenced
+            entries = {name: dict(e) for name, e in self._entries.items()}
+        if referenced is None:
+            summary = {"skipped": "order_cards references not loaded", "deleted": [], "freed_bytes": 0}
+            self._last_sweep = {**summary, "at": now, "dry_run": dry_run}
+            return summary
+
+        keep = set(referenced)
+        keep.update(name for name, e in entries.items() if e.get("sibling") in referenced)
+        candidates = {
+            name: e for name, e in entries.items()
+            if name not in keep and now - e["created_at"] >= self.min_age_seconds
+        }
+        for name, e in candidates.items():  # accesses recorded by other workers
+            e["last_access"] = max(e["last_access"], self._disk_access(name))
+        expired = []
+        if self.ttl_seconds:
+            expired = [name for name, e in candidates.items() if now - e["last_access"] >= self.ttl_seconds]
+        total = sum(e["size"] for e in entries.values()) - sum(entries[n]["size"] for n in expired)
+        evicted = []
+        if self.max_bytes and total > self.max_bytes:
+            remaining = sorted(
+                (n for n in candidates if n not in set(expired)), key=lambda n: candidates[n]["last_access"]
+            )
+            for name in remaining:
+                if total <= self.max_bytes:
+                    break
+                evicted.append(name)
+                total -= candidates[name]["size"]
+
+        freed = sum(entries[n]["size"] for n in expired + evicted)
+        orphans = 0
+        if not dry_run:
+            for name in expired + evicted:
+                self._delete(name)
+            orphans = self._drop_orphan_records()
+        summary = {
+            "expired": expired,
+            "evicted": evicted,
+            "deleted": expired + evicted,
+            "freed_bytes": freed,
+            "orphan_records_removed": orphans,
+            "referenced": sum(1 for n in entries if n in keep),
+            "total_bytes_after": total,
+        }
+        self._last_sweep = {
+            "at": now,
+            "dry_run": dry_run,
+            "deleted": len(summary["deleted"]),
+            "freed_bytes": freed,
+        }
+        logger.info(
+            f"Upload sweep{' (dry run)' if dry_run else ''}: {len(expired)} expired, "
+            f"{len(evicted)} evicted, {freed / 1e6:.1f} MB freed"
+        )
+        return summary
+
+    def stats(self) -> dict:
+        with self._lock:
+            referenced = self._referenced
+            return {
+                "files": len(self._entries),
+                "bytes": sum(e["size"] for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "min_age_seconds": self.min_age_seconds,
+                "referenced": None if referenced is None else sum(1 for n in self._entries if n in referenced),
+                "references_loaded_at": self._references_loaded_at,
+                "last_sweep": self._last_sweep,
+            }
+
+    def entry(self, filename: str) -> Optional[dict]:
+        with self._lock:
+            e = self._entries.get(filename)
+            if e is None:
+                return None
+            referenced = None if self._referenced is None else filename in self._referenced
+            return {"filename": filename, **e, "referenced": referenced}
@@ -0,0 +1,99 @@
+"""
+Sidecar metadata for files in static/uploads, keyed by filename.
+
+Background removal already has the cutout in memory, so it records derived data (dominant
+colours, palette) next to the file it writes. Endpoints such as /extract-colors then look
+the record up instead of re-opening and re-decoding the image.
+
+Records are small JSON files in <upload_dir>/.meta/<filename>.json, written atomically, so
+workers in a process pool and the API process share them through the filesystem.
+"""
+
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+METADATA_DIRNAME = ".meta"
+
+
+def _valid_filename(filename: str) -> bool:
+    return bool(filename) and os.path.basename(filename) == filename and not filename.startswith(".")
+
+
+def metadata_path(upload_dir: str, filename: str) -> str:
+    return os.path.join(upload_dir, METADATA_DIRNAME, filename + ".json")
+
+
+def write_upload_metadata(upload_dir: str, filename: str, record: dict) -> None:
+    """Merge record into filename's sidecar (atomic replace). Safe to call from any worker."""
+    if not _valid_filename(filename):
+        raise ValueError(f"Invalid upload filename {filename!r}")
+    path = metadata_path(upload_dir, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    merged = read_upload_metadata(upload_dir, filename) or {}
+    merged.update(record)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(merged, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def read_upload_metadata(upload_dir: str, filename: str) -> Optional[dict]:
+    if not _valid_filename(filename):
+        return None
+    try:
+        with open(metadata_path(upload_dir, filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unreadable metadata for {filename}: {e}")
+        return None
+
+
+class UploadMetadataIndex:
+    """
+    Read-through LRU cache over the sidecar files for the API process.
+
+    Args:
+        upload_dir: Directory the uploads (and the .meta sidecars) live in.
+        max_entries: Records kept in memory.
+    """
+
+    def __init__(self, upload_dir: str, max_entries: int = 4096):
+        self.upload_dir = upload_dir
+        self.max_entries = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._records: "OrderedDict[str, dict]" = OrderedDict()
+
+    def get(self, filename: str) -> Optional[dict]:
+        """Record for filename, or None. Misses are not cached: a worker may write it later."""
+        with self._lock:
+            record = self._records.get(filename)
+            if record is not None:
+                self._records.move_to_end(filename)
+                return record
+        record = read_upload_metadata(self.upload_dir, filename)
+        if record is not None:
+            self._remember(filename, record)
+        return record
+
+    def put(self, filename: str, record: dict) -> dict:
+        """Merge record into filename's sidecar and the cache; returns the merged record."""
+        write_upload_metadata(self.upload_dir, filename, record)
+        merged = read_upload_metadata(self.upload_dir, filename) or dict(record)
+        self._remember(filename, merged)
+        return merged
+
+    def _remember(self, filename: str, record: dict) -> None:
+        with self._lock:
+            self._records[filename] = record
+            self._records.move_to_end(filename)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
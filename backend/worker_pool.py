@@ -0,0 +1,185 @@
+"""
+Bounded worker pool for blocking, CPU-heavy request work (RemBG inference, PIL filters).
+
+FastAPI handlers are `async def`; calling rembg directly inside them blocks the event loop
+and stalls every other request. WorkerPool runs the call in a thread or process pool with a
+fixed number of workers and a bounded queue, and keeps counters (queue depth, wait time,
+run time) that the API exposes for monitoring.
+
+Threads are the default: onnxruntime and most PIL filters release the GIL, and sessions
+stay shared in-process. A process pool isolates workers fully but each process loads its
+own models; the callable must then be a picklable module-level function.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+POOL_KINDS = ("thread", "process")
+
+
+class PoolFullError(RuntimeError):
+    """Raised when the pool's queue is at capacity and the job is rejected."""
+
+
+def _timed_call(fn, args, kwargs):
+    """Run fn in the worker and report the wall-clock time it actually started."""
+    started_at = time.time()
+    return started_at, fn(*args, **kwargs)
+
+
+class Reservation:
+    """A place in a WorkerPool taken by reserve(); use it once with run(), or release() it."""
+
+    def __init__(self, pool: "WorkerPool"):
+        self._pool = pool
+        self._used = False
+
+    async def run(self, fn, *args, **kwargs):
+        if self._used:
+            raise RuntimeError("Reservation already used")
+        self._used = True
+        return await self._pool._run_reserved(fn, args, kwargs)
+
+    def release(self) -> None:
+        if not self._used:
+            self._used = True
+            self._pool._release()
+
+
+class WorkerPool:
+    """
+    Fixed-size executor with a bounded queue and wait/run-time statistics.
+
+    Args:
+        name: Label used in logs and stats.
+        max_workers: Number of jobs that run concurrently.
+        kind: "thread" or "process".
+        max_queue: Jobs allowed to wait for a free worker; 0 means unbounded.
+        initializer: Optional callable run once in each worker when it starts
+            (e.g. loading models in every process of a process pool).
+        initargs: Arguments for initializer.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_workers: int,
+        kind: str = "thread",
+        max_queue: int = 0,
+        initializer=None,
+        initargs: tuple = (),
+    ):
+        if kind not in POOL_KINDS:
+            raise ValueError(f"Unknown pool kind {kind!r}; expected one of {POOL_KINDS}")
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+        self._total_run = 0.0
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor: Executor = self._make_executor()
+        logger.info("Worker pool %s: %d %s worker(s), max queue %s", name, self.max_workers, kind, self.max_queue or "unbounded")
+
+    def _make_executor(self) -> Executor:
+        if self.kind == "process":
+            return ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=self._initializer, initargs=self._initargs
+            )
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix=self.name,
+            initializer=self._initializer,
+            initargs=self._initargs,
+        )
+
+    @property
+    def queued(self) -> int:
+        """Jobs submitted but still waiting for a free worker."""
+        return max(0, self._in_flight - self.max_workers)
+
+    def reserve(self) -> "Reservation":
+        """
+        Take a place in the pool now for a job submitted later (e.g. after answering the client).
+        Counts like a waiting job; raises PoolFullError if max_queue jobs are already waiting.
+        """
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self._rejected += 1
+                raise PoolFullError(f"{self.name} queue is full ({self.max_queue} waiting)")
+            self._in_flight += 1
+        return Reservation(self)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on a worker and await its result.
+        Raises PoolFullError if max_queue jobs are already waiting.
+        """
+        return await self.reserve().run(fn, *args, **kwargs)
+
+    async def _run_reserved(self, fn, args, kwargs):
+        submitted_at = time.time()
+        try:
+            future = self._executor.submit(_timed_call, fn, args, kwargs)
+        except BaseException:  # executor shut down
+            self._release()
+            raise
+        # Account when the job itself ends: a cancelled caller does not stop a job already running.
+        future.add_done_callback(lambda f: self._job_done(f, submitted_at))
+        started_at, result = await asyncio.wrap_future(future)
+        return result
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def _job_done(self, future, submitted_at: float) -> None:
+        finished_at = time.time()
+        with self._lock:
+            self._in_flight -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._failed += 1
+                return
+            started_at, _ = future.result()
+            wait = max(0.0, started_at - submitted_at)
+            self._completed += 1
+            self._total_wait += wait
+            self._last_wait = wait
+            self._max_wait = max(self._max_wait, wait)
+            self._total_run += max(0.0, finished_at - started_at)
+
+    def stats(self) -> dict:
+        """Snapshot of pool occupancy and timing counters (milliseconds)."""
+        with self._lock:
+            done = self._completed or 1
+            return {
+                "name": self.name,
+                "kind": self.kind,
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "active": min(self._in_flight, self.max_workers),
+                "queued": self.queued,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_wait_ms": round(self._total_wait / done * 1000, 1),
+                "max_wait_ms": round(self._max_wait * 1000, 1),
+                "last_wait_ms": round(self._last_wait * 1000, 1),
+                "avg_run_ms": round(self._total_run / done * 1000, 1),
+            }
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)